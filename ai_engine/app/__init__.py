@@ -10,8 +10,13 @@ from fastapi.middleware.cors import CORSMiddleware
 
 from app.config import logger, settings
 from app.sdk import OPENHANDS_AVAILABLE, import_error
-from app.services.sessions import store, destroy_session
+from app.services.sessions import destroy_sessions, drain_sessions, store
+from app.services.chat_writer import chat_writer
+from app.services.reaper import session_reaper
+from app.services.agent_runner import agent_runner
+from app.services.agent_process import agent_processes
 from app.services.docker_workspace import docker_manager
+from app.services.routing import forward_to_owner, session_router
 from app.routers import health, sessions, ws, chat, files, integrations
 
 
@@ -20,12 +25,17 @@ async def lifespan(_app: FastAPI):
     """Verify Docker access on boot; clean up on shutdown."""
     logger.info("Lucid AI Engine starting …")
 
+    # Join the session registry before touching shared state (sandboxes)
+    await session_router.start()
+
     # Check Docker daemon availability
     docker_available = await asyncio.to_thread(docker_manager.is_docker_available)
     if docker_available:
         logger.info("Docker daemon is accessible — per-session sandboxing enabled")
-        # Clean up orphaned containers from previous runs
-        cleaned = await asyncio.to_thread(docker_manager.cleanup_orphaned_containers)
+        # Clean up orphaned containers from previous runs — not those of
+        # live workers sharing this daemon
+        live = frozenset(await session_router.live_session_ids())
+        cleaned = await asyncio.to_thread(docker_manager.cleanup_orphaned_containers, live)
         if cleaned:
             logger.info("Cleaned up %d orphaned sandbox containers", cleaned)
     else:
@@ -33,6 +43,11 @@ async def lifespan(_app: FastAPI):
             "Docker daemon not accessible — falling back to local workspace mode"
         )
 
+    # Resend chat history a previous run left in the local WAL
+    await chat_writer.start()
+    # Expire idle sessions and keep the node within its budget
+    await session_reaper.start()
+
     if not OPENHANDS_AVAILABLE:
         logger.warning("OpenHands SDK not installed: %s", import_error or "N/A")
     if not settings.LLM_API_KEY:
@@ -40,10 +55,17 @@ async def lifespan(_app: FastAPI):
     yield
 
     logger.info("Shutting down — cleaning up sessions …")
-    for sid in await store.snapshot_ids():
-        await destroy_session(sid)
+    await session_reaper.close()
+    # Already done by main.py's server before it closed the connections
+    await drain_sessions(settings.SHUTDOWN_DRAIN_SECONDS)
+    await destroy_sessions(store.snapshot_ids())
+    agent_runner.shutdown()
+    await asyncio.to_thread(agent_processes.shutdown)
+    # Write out chat history the sessions left queued
+    await chat_writer.close()
     # Destroy any remaining Docker containers
     await docker_manager.destroy_all()
+    await session_router.close()
     logger.info("All resources cleaned up.")
 
 
@@ -60,6 +82,10 @@ def create_app() -> FastAPI:
         lifespan=lifespan,
     )
 
+    # Requests for sessions another worker owns are forwarded there.
+    # Added before CORS, so CORS stays the outermost layer.
+    application.middleware("http")(forward_to_owner)
+
     application.add_middleware(
         CORSMiddleware,
         allow_origins=settings.ALLOWED_ORIGINS,
@@ -11,6 +11,7 @@ singleton instance created at the bottom of this module.
 """
 
 import logging
+import os
 
 from pydantic import Field, field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -91,6 +92,71 @@ class Settings(BaseSettings):
     # CONVERSATION_TIMEOUT env var (seconds until an idle session is reaped)
     CONVERSATION_TIMEOUT: int = 1800
 
+    # On shutdown, agent runs in progress get this long (seconds) to finish
+    # — new sessions and turns are refused meanwhile — before they are stopped
+    SHUTDOWN_DRAIN_SECONDS: int = 60
+
+    # Idle sessions are hibernated after this many seconds: the conversation
+    # is released and the sandbox stopped until the next turn (0 = never)
+    SESSION_HIBERNATE_AFTER_SECONDS: int = 300
+
+    # Disk for the bare repository mirrors sessions are checked out from,
+    # least recently used evicted first (0 = no limit)
+    REPO_CACHE_BUDGET_MB: int = 10240
+
+    # Agent runs executing at once, each on its own thread of a dedicated
+    # pool; further runs wait in a queue and are told their position
+    MAX_CONCURRENT_AGENT_RUNS: int = 16
+    # Where conversations run: "thread" — in this process, on the agent pool;
+    # "process" — in a pool of agent worker processes, so CPU-heavy agents
+    # don't contend for this process's GIL (see app.services.agent_process)
+    AGENT_RUNNER_MODE: str = "thread"
+    # Agent worker processes in "process" mode (0 = MAX_CONCURRENT_AGENT_RUNS)
+    AGENT_PROCESS_POOL_SIZE: int = 0
+
+    # ── Node capacity ────────────────────────────────────────
+    # Caps on what one engine process hosts (0 = no cap).  When a cap is
+    # reached the least recently active idle sessions are evicted first.
+    MAX_SESSIONS_PER_NODE: int = 0
+    MAX_CONTAINERS_PER_NODE: int = 0
+    # Sandbox memory limits plus a host-side estimate per session
+    NODE_MEMORY_BUDGET_MB: int = 0
+
+    # ── Workers / session registry ───────────────────────────
+    # Worker processes ``python main.py`` starts.  Each owns the sessions it
+    # creates; requests for another worker's session are forwarded to it.
+    ENGINE_WORKERS: int = 1
+    # Where workers record which sessions they own: "" keeps the registry
+    # in-process (single worker); "sqlite:////path/registry.db" shares it
+    # between the workers of a host.  Keep the file on a local disk: SQLite
+    # locking is not reliable over NFS, so it cannot span nodes.
+    # Defaults to a SQLite file under WORKSPACE_BASE_PATH when ENGINE_WORKERS > 1.
+    SESSION_REGISTRY_URL: str = ""
+    # Host other workers and nodes reach this one at
+    ENGINE_ADVERTISE_HOST: str = "127.0.0.1"
+    # Worker N also listens on this port + N, for forwarded requests
+    ENGINE_INTERNAL_PORT_BASE: int = 9100
+    # Interface the internal ports listen on: loopback, or a private
+    # interface when nodes forward to each other — never a public one
+    ENGINE_INTERNAL_BIND_HOST: str = "127.0.0.1"
+    # Set by main.py for each worker it starts — not meant to be set by hand
+    ENGINE_WORKER_INDEX: int | None = None
+
+    # ── Event buffer ─────────────────────────────────────────
+    # What to do with a non-state event when a session's event buffer is
+    # full: "spill" (append to a per-session file, drained later),
+    # "block" (stall the SDK thread, then spill), or "drop" (count and discard).
+    # Full buffers always coalesce superseded state events first.
+    EVENT_BUFFER_OVERFLOW_POLICY: str = "spill"
+
+    # File-tree refreshes requested within this window (ms) are merged into
+    # one workspace rescan; at most one rescan runs per session at a time.
+    FILE_TREE_REFRESH_WINDOW_MS: int = 250
+
+    # A session whose WebSocket drops is kept this long (seconds) so the
+    # client can reconnect with ``resumeFrom`` instead of starting over.
+    SESSION_RESUME_GRACE_SECONDS: int = 120
+
     # ── Validators ───────────────────────────────────────────
 
     @field_validator("SUPABASE_URL")
@@ -100,6 +166,22 @@ class Settings(BaseSettings):
             raise ValueError("SUPABASE_URL must start with https://")
         return v
 
+    @field_validator("EVENT_BUFFER_OVERFLOW_POLICY")
+    @classmethod
+    def overflow_policy_must_be_known(cls, v: str) -> str:
+        v = v.strip().lower()
+        if v not in ("spill", "block", "drop"):
+            raise ValueError("EVENT_BUFFER_OVERFLOW_POLICY must be spill, block or drop")
+        return v
+
+    @field_validator("AGENT_RUNNER_MODE")
+    @classmethod
+    def runner_mode_must_be_known(cls, v: str) -> str:
+        v = v.strip().lower()
+        if v not in ("thread", "process"):
+            raise ValueError("AGENT_RUNNER_MODE must be thread or process")
+        return v
+
     @field_validator("ALLOWED_ORIGINS", mode="before")
     @classmethod
     def parse_allowed_origins(cls, v: object) -> list[str]:
@@ -135,11 +217,60 @@ GEMINI_SAFETY_SETTINGS: list[dict] = [
 
 # ── Limits / magic numbers ──────────────────────────────────
 
-WS_EVENT_MAX_CHARS = 2000
+WS_EVENT_MAX_CHARS = 2000        # content sent inline; the full text goes to the blob store
 THOUGHT_MAX_CHARS = 1000
+BLOB_STORE_DIR = os.path.join(settings.WORKSPACE_BASE_PATH, ".blobs")
+BLOB_STORE_MAX_BYTES = 256 * 1024 * 1024    # large-payload blobs kept per session
+BLOB_READ_MAX_BYTES = 1024 * 1024           # largest range served by one blob fetch
+CHAT_CONTENT_CHUNK_CHARS = 32_000           # large outputs are stored as ordered rows of this size
+AGENT_DELTA_FLUSH_SECONDS = 0.05            # token streaming: send buffered tokens after this long …
+AGENT_DELTA_MAX_CHARS = 512                 # … or once this many characters are buffered
 WS_INIT_TIMEOUT_SECONDS = 30.0
+WS_STOP_FLUSH_SECONDS = 1.0      # on "stop", wait this long at most for the stream to deliver what is queued
+WS_BATCH_WINDOW_SECONDS = 0.05   # "batch" framing: collect events for this long …
+WS_BATCH_MAX_EVENTS = 64         # … or until this many are pending
+WS_COMPRESS_MIN_BYTES = 4096     # "deflate" compression: only for payloads this large
+WS_COMPRESS_LEVEL = 5
 MOCK_STEP_DELAY_SECONDS = 1.5
 EVENT_BUFFER_MAX_SIZE = 1000
+EVENT_BUFFER_BLOCK_TIMEOUT_SECONDS = 5.0   # "block" policy: max producer stall before spilling
+EVENT_SPILL_READ_CHUNK = 200               # spilled events loaded back per drain step
+EVENT_SPILL_DIR = os.path.join(settings.WORKSPACE_BASE_PATH, ".event-spill")
+REPLAY_BUFFER_SIZE = 2000         # recent agent events kept per session for resume
+MAX_OBSERVERS_PER_SESSION = 8     # read-only WebSocket subscribers per session
+WORKSPACE_WATCH_DEBOUNCE_MS = 200   # filesystem watcher: group changes within this window
 CONVERSATION_TIMEOUT_SECONDS: int = settings.CONVERSATION_TIMEOUT
-DB_BATCH_SIZE = 20          # flush events to DB after this many accumulate
-DB_BATCH_INTERVAL = 2.0     # … or after this many seconds, whichever comes first
+SESSION_REAPER_INTERVAL_SECONDS = 30.0       # idle / budget sweep period
+SESSION_HOST_MEMORY_ESTIMATE_MB = 64         # engine-side memory per session (buffers, SDK state)
+SESSION_TEARDOWN_CONCURRENCY = 8             # sessions / sandboxes torn down at once on shutdown
+CONVERSATION_STATE_DIR = os.path.join(settings.WORKSPACE_BASE_PATH, ".conversations")
+SESSION_REGISTRY_DEFAULT_PATH = os.path.join(settings.WORKSPACE_BASE_PATH, ".registry.db")
+REPO_CACHE_DIR = os.path.join(settings.WORKSPACE_BASE_PATH, ".repo-cache")
+WORKSPACE_TEMPLATES_DIR = os.path.join(settings.WORKSPACE_BASE_PATH, ".templates")
+REPO_CACHE_FETCH_INTERVAL_SECONDS = 30.0     # a mirror used more recently than this is not re-fetched
+GIT_COMMAND_TIMEOUT_SECONDS = 600            # clone / fetch of a large repository
+WORKER_HEARTBEAT_SECONDS = 10.0              # workers refresh their registry entry this often …
+WORKER_STALE_AFTER_SECONDS = 30.0            # … and one silent for this long is presumed dead
+WORKER_DEAD_AFTER_SECONDS = 600.0            # sandboxes of a stale worker on another host are removed after this
+SESSION_FORWARD_TIMEOUT_SECONDS = 30.0       # REST request forwarded to the session's owning worker
+AGENT_RUN_QUEUE_MAX = 200                    # agent runs waiting for a free slot before new ones are refused
+AGENT_RUN_STOP_GRACE_SECONDS = 10.0          # a stopped run that hasn't returned by then gives up its slot …
+AGENT_RUN_SPARE_THREADS = 8                  # … while its thread finishes on one of these
+AGENT_PROCESS_KILL_AFTER_SECONDS = 5.0       # "process" mode: a stopped run still going by then has its process killed
+AGENT_PROCESS_WARM_CONVERSATIONS = 4         # conversations an agent process keeps loaded between turns
+SANDBOX_INTERRUPT_GRACE_SECONDS = 1          # stopping a run: SIGINT sandbox commands, SIGKILL after this
+CHAT_WRITER_QUEUE_MAX = 10_000               # chat rows queued in memory, all sessions (rest wait in the WAL)
+CHAT_WRITER_BATCH_MIN = 20                   # adaptive multi-row insert size: floor …
+CHAT_WRITER_BATCH_MAX = 500                  # … and ceiling
+CHAT_WRITER_TARGET_LATENCY_SECONDS = 0.5     # halve the batch when an insert is slower
+CHAT_WRITER_MIN_LINGER_SECONDS = 0.05        # wait to fill a batch: at least …
+CHAT_WRITER_MAX_LINGER_SECONDS = 2.0         # … and at most
+CHAT_WAL_DIR = os.path.join(
+    settings.WORKSPACE_BASE_PATH, ".chat-wal",
+    # One WAL per worker — segment files are not shared between processes
+    *([f"worker-{settings.ENGINE_WORKER_INDEX}"] if settings.ENGINE_WORKER_INDEX is not None else []),
+)
+CHAT_WAL_SEGMENT_ROWS = 5000                 # rows per WAL segment file before it is sealed
+CHAT_WAL_RETRY_MIN_SECONDS = 1.0             # back-off after a failed insert …
+CHAT_WAL_RETRY_MAX_SECONDS = 60.0            # … doubling up to this (per JWT group)
+CHAT_WRITER_MAX_ATTEMPTS = 5                 # a row the database rejects this often goes to the dead-letter file
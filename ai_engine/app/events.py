@@ -3,154 +3,368 @@
 from __future__ import annotations
 
 import asyncio
+import threading
 import time
 from datetime import datetime, timezone
-from typing import Optional
-
-from fastapi import WebSocket
+from typing import Any, Callable, Optional
 
 from app.config import (
     WS_EVENT_MAX_CHARS,
     THOUGHT_MAX_CHARS,
-    DB_BATCH_SIZE,
-    DB_BATCH_INTERVAL,
+    CHAT_CONTENT_CHUNK_CHARS,
+    AGENT_DELTA_FLUSH_SECONDS,
+    AGENT_DELTA_MAX_CHARS,
     logger,
 )
 from app import sdk
-from app.services.chat import ChatService
+from app.routers.files import build_file_tree, should_refresh_file_tree
+from app.services.chat_writer import chat_writer
+from app.transport import WSEventWriter
+
+
+# ── Timestamps ──────────────────────────────────────────────
+
+# (whole second, "YYYY-MM-DDTHH:MM:SS") — formatting the date part once per
+# second keeps now_iso() cheap on the SDK callback path.
+_iso_second: tuple[int, str] = (-1, "")
 
 
 def now_iso() -> str:
     """Current UTC time as an ISO-8601 string."""
-    return datetime.now(timezone.utc).isoformat()
+    global _iso_second
+    now = time.time()
+    second = int(now)
+    cached_second, prefix = _iso_second
+    if second != cached_second:
+        prefix = datetime.fromtimestamp(second, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+        _iso_second = (second, prefix)
+    return f"{prefix}.{int((now - second) * 1_000_000):06d}+00:00"
 
 
-def format_sdk_event(event) -> Optional[dict]:
-    """Convert an OpenHands SDK event into a JSON-serialisable dict
-    suitable for WebSocket transmission to the frontend.
+# ── SDK event formatting ────────────────────────────────────
+
+EventFormatter = Callable[[Any], Optional[dict]]
+
+# Attribute that supplies "content", in priority order
+_CONTENT_ATTRS = ("content", "message", "text")
+# (SDK attribute, payload key, stringify?) attached when the class has them
+_OPTIONAL_FIELDS = (
+    ("command", "command", True),
+    ("exit_code", "exitCode", False),
+    ("path", "path", True),
+)
+
+# Formatters registered for specific event classes (matched along the MRO)
+_registered_formatters: dict[type, EventFormatter] = {}
+# Compiled formatter per concrete event class — filled lazily
+_formatter_cache: dict[type, EventFormatter] = {}
+
+
+def register_event_formatter(event_cls: type) -> Callable[[EventFormatter], EventFormatter]:
+    """Decorator: format events of *event_cls* (and subclasses) with a custom function.
+
+    The function receives the SDK event and returns the payload dict, or
+    ``None`` to suppress the event::
+
+        @register_event_formatter(SomeSDKEvent)
+        def _format_some_event(event) -> dict | None:
+            ...
     """
-    event_type = type(event).__name__
+    def decorator(func: EventFormatter) -> EventFormatter:
+        _registered_formatters[event_cls] = func
+        _formatter_cache.clear()
+        return func
+    return decorator
 
-    # Extract content from whichever attribute exists
-    content = ""
-    for attr in ("content", "message", "text"):
-        if hasattr(event, attr):
-            content = str(getattr(event, attr))
-            break
 
-    # Determine category from the class name
+def _event_category(event_type: str) -> str:
+    """Determine category from the class name."""
     if "Action" in event_type:
-        event_category = "action"
-    elif "Error" in event_type:
-        event_category = "error"
-    elif "State" in event_type or "Update" in event_type:
-        event_category = "state"
-    else:
-        event_category = "observation"
-
-    payload: dict = {
-        "type": "agent_event",
-        "event": event_category,
-        "eventType": event_type,
-        "content": content[:WS_EVENT_MAX_CHARS],
-        "timestamp": now_iso(),
-    }
-
-    # Attach optional fields when present
-    if hasattr(event, "command"):
-        payload["command"] = str(event.command)
-    if hasattr(event, "exit_code"):
-        payload["exitCode"] = event.exit_code
-    if hasattr(event, "path"):
-        payload["path"] = str(event.path)
-    if hasattr(event, "thought") and event.thought:
-        payload["thought"] = str(event.thought)[:THOUGHT_MAX_CHARS]
+        return "action"
+    if "Error" in event_type:
+        return "error"
+    if "State" in event_type or "Update" in event_type:
+        return "state"
+    return "observation"
+
+
+def _compile_formatter(event) -> EventFormatter:
+    """Build the formatter for ``type(event)`` by probing one instance.
+
+    Everything that depends only on the class — category, which attribute
+    holds the content, which optional fields exist — is resolved here once.
+    """
+    cls = type(event)
+    for klass in cls.__mro__:
+        registered = _registered_formatters.get(klass)
+        if registered is not None:
+            return registered
+
+    event_type = cls.__name__
+    category = _event_category(event_type)
+    content_attr = next((a for a in _CONTENT_ATTRS if hasattr(event, a)), None)
+    optional = tuple(f for f in _OPTIONAL_FIELDS if hasattr(event, f[0]))
+    has_thought = hasattr(event, "thought")
+
+    def format_event(event) -> dict:
+        content = str(getattr(event, content_attr, "")) if content_attr else ""
+        payload: dict = {
+            "type": "agent_event",
+            "event": category,
+            "eventType": event_type,
+            "content": content,
+            "timestamp": now_iso(),
+        }
+        for attr, key, stringify in optional:
+            value = getattr(event, attr, None)
+            payload[key] = str(value) if stringify else value
+        if has_thought:
+            thought = getattr(event, "thought", None)
+            if thought:
+                payload["thought"] = str(thought)
+        return payload
+
+    return format_event
+
+
+# (payload key, characters sent inline) for fields that can get huge
+_LARGE_FIELDS = (
+    ("content", WS_EVENT_MAX_CHARS),
+    ("thought", THOUGHT_MAX_CHARS),
+)
+
+
+def _offload_large_fields(payload: dict, blobs) -> None:
+    """Cut oversized fields down to a preview and keep the full text in *blobs*.
 
+    Every cut field is listed under ``truncated`` with its full length and
+    the ``blobId`` to fetch the rest from (``None`` if no blob could be
+    stored), so clients never mistake a preview for the whole output.
+    """
+    truncated = None
+    for key, limit in _LARGE_FIELDS:
+        value = payload.get(key)
+        if not isinstance(value, str) or len(value) <= limit:
+            continue
+        blob_id = blobs.put(value) if blobs is not None else None
+        if truncated is None:
+            truncated = payload["truncated"] = {}
+        truncated[key] = {"length": len(value), "blobId": blob_id}
+        payload[key] = value[:limit]
+
+
+def format_sdk_event(event, blobs=None) -> Optional[dict]:
+    """Convert an OpenHands SDK event into a JSON-serialisable dict
+    suitable for WebSocket transmission to the frontend.
+
+    Content and thoughts longer than what is sent inline are truncated
+    and stored whole in *blobs* (the session's ``SessionBlobStore``).
+
+    Runs on the SDK callback thread for every event, so the per-class work
+    is compiled once and cached by type.
+    """
+    formatter = _formatter_cache.get(type(event))
+    if formatter is None:
+        formatter = _formatter_cache[type(event)] = _compile_formatter(event)
+    payload = formatter(event)
+    if payload:
+        _offload_large_fields(payload, blobs)
     return payload
 
 
-async def _flush_batch(
-    batch: list[dict],
-    chat_session_id: str,
-    user_jwt: str | None,
-) -> None:
-    """Write a batch of event dicts to the database in a single insert."""
-    if not batch:
-        return
+# ── Token streaming ─────────────────────────────────────────
+
+class AgentDeltaCoalescer:
+    """Turns streamed LLM tokens into ``agent_delta`` frames.
+
+    ``feed`` is the conversation's token callback and runs on the SDK
+    worker thread.  Tokens are buffered and published as one frame every
+    ``AGENT_DELTA_FLUSH_SECONDS`` or ``AGENT_DELTA_MAX_CHARS``, whichever
+    comes first.  ``flush`` must be called before publishing a complete
+    event, so deltas never arrive after the event they lead up to.
+
+    Deltas are a preview only: they carry no ``seq``, are not replayed or
+    persisted, and the next ``agent_event`` replaces them.
+    """
+
+    def __init__(self, publish: Callable[[dict], bool], replay) -> None:
+        self._publish = publish
+        self._replay = replay
+        self._lock = threading.Lock()
+        self._parts: list[str] = []
+        self._chars = 0
+        self._first_at = 0.0
+        self._closed = False
+        self.frames = 0
+        self.tokens = 0
+
+    def feed(self, chunk) -> None:
+        """Token callback — takes a streamed completion chunk."""
+        text = delta_text(chunk)
+        if not text:
+            return
+        with self._lock:
+            if self._closed:
+                return
+            if not self._parts:
+                self._first_at = time.monotonic()
+            self._parts.append(text)
+            self._chars += len(text)
+            self.tokens += 1
+            due = (
+                self._chars >= AGENT_DELTA_MAX_CHARS
+                or time.monotonic() - self._first_at >= AGENT_DELTA_FLUSH_SECONDS
+            )
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        """Publish whatever is buffered as one ``agent_delta`` frame."""
+        with self._lock:
+            if not self._parts:
+                return
+            text = "".join(self._parts)
+            self._parts.clear()
+            self._chars = 0
+            self.frames += 1
+        self._publish({
+            "type": "agent_delta",
+            "content": text,
+            # The last agent event before this text — deltas belong after it
+            "afterSeq": self._replay.last_seq,
+            "timestamp": now_iso(),
+        })
+
+    def close(self) -> None:
+        """Drop buffered text; tokens still streaming in are ignored."""
+        with self._lock:
+            self._closed = True
+            self._parts.clear()
+            self._chars = 0
+
+    def stats(self) -> dict:
+        return {"tokens": self.tokens, "frames": self.frames}
+
+
+def delta_text(chunk) -> str:
+    """Text of a streamed completion chunk (LiteLLM / OpenAI shape)."""
+    if isinstance(chunk, str):
+        return chunk
     try:
-        await ChatService.add_messages(batch, chat_session_id, user_jwt=user_jwt)
-    except Exception as exc:
-        logger.warning("Failed to flush %d events to DB: %s", len(batch), exc)
+        return chunk.choices[0].delta.content or ""
+    except (AttributeError, IndexError, TypeError):
+        return ""
+
+
+async def send_file_tree(writer: WSEventWriter, session) -> None:
+    """Send the full workspace tree (on connect or client resync)."""
+    try:
+        tree = await build_file_tree(session)
+        await writer.send({
+            "type": "file_tree",
+            "tree": tree,
+            "timestamp": now_iso(),
+        })
+    except Exception as tree_err:
+        logger.warning("File tree refresh failed: %s", tree_err)
 
 
 async def stream_events_to_ws(
-    websocket: WebSocket,
+    writer: WSEventWriter,
     session,
-    *,
-    chat_session_id: str | None = None,
-    user_jwt: str | None = None,
+    subscription,
 ) -> None:
-    """Background task that drains the session's event buffer and
-    forwards each item to the WebSocket client.
+    """Background task that forwards one subscription's events to the
+    WebSocket client through *writer*.
 
-    When ``chat_session_id`` and ``user_jwt`` are provided, meaningful agent
-    events are batched and flushed to the database periodically (every
-    ``DB_BATCH_SIZE`` events or ``DB_BATCH_INTERVAL`` seconds).
+    The subscription starts at the cursor it was created with, so a
+    resumed or late-joining client first gets the agent events it missed
+    from the replay ring.  The task sleeps until an event is published.
     """
-    pending: list[dict] = []
-    last_flush = time.monotonic()
-
     try:
-        while session.is_alive:
-            try:
-                event_data = await asyncio.wait_for(
-                    session.event_buffer.get(), timeout=1.0,
-                )
-                await websocket.send_json(event_data)
-
-                # Auto-refresh file tree on file-changing events
-                from app.routers.files import should_refresh_file_tree, build_file_tree
-                if should_refresh_file_tree(event_data):
-                    try:
-                        tree = await build_file_tree(session)
-                        await websocket.send_json({
-                            "type": "file_tree",
-                            "tree": tree,
-                            "timestamp": now_iso(),
-                        })
-                    except Exception as tree_err:
-                        logger.warning("File tree refresh failed: %s", tree_err)
-
-                # Accumulate persistable events (only when JWT is available for RLS)
-                if (
-                    chat_session_id
-                    and user_jwt
-                    and event_data.get("content")
-                    and event_data.get("event") in ("action", "observation", "error")
-                ):
-                    pending.append(event_data)
-
-                # Flush when batch is full
-                if len(pending) >= DB_BATCH_SIZE:
-                    await _flush_batch(pending, chat_session_id, user_jwt)
-                    pending.clear()
-                    last_flush = time.monotonic()
-
-            except asyncio.TimeoutError:
-                pass
-            except Exception as exc:
-                logger.warning("Event stream error (session=%s): %s", getattr(session, "session_id", "?"), exc)
-                break
-
-            # Flush on time interval even if batch isn't full
-            if pending and (time.monotonic() - last_flush) >= DB_BATCH_INTERVAL:
-                await _flush_batch(pending, chat_session_id, user_jwt)
-                pending.clear()
-                last_flush = time.monotonic()
+        await send_file_tree(writer, session)
+
+        while True:
+            event_data = await subscription.get()
+            if event_data is None:
+                break  # Session closed
+            if event_data.get("type") == "agent_event":
+                await writer.send_event(event_data)
+            else:
+                await writer.send(event_data)  # status, file_tree_delta, …
 
     except asyncio.CancelledError:
         pass
+    except Exception as exc:
+        logger.warning("Event stream error (session=%s): %s", getattr(session, "session_id", "?"), exc)
     finally:
-        # Flush remaining events on shutdown
-        if pending and chat_session_id and user_jwt:
-            await _flush_batch(pending, chat_session_id, user_jwt)
+        session.events.unsubscribe(subscription)
+
+
+async def persist_session_events(session, subscription) -> None:
+    """Session-level consumer that records agent events in the chat history.
+
+    Runs once per session, whether or not a WebSocket is attached, so a
+    run keeps being recorded while the client is away.  It also drives the
+    command heuristic that refreshes the file tree when no filesystem
+    watcher is running — once per event, not once per viewer.
+
+    Meaningful agent events are handed to the shared ``chat_writer`` once
+    the session has a chat record and a JWT (needed for RLS); batching and
+    the database round trips happen there, never on this path.
+    """
+    while True:
+        event_data = await subscription.get()
+        if event_data is None:
+            break  # Session closed and drained
+
+        # Without a filesystem watcher, guess at file changes
+        # from the event; the scheduler coalesces the rescans
+        if (
+            session.tree_refresher is not None
+            and not session.file_tree.watched
+            and should_refresh_file_tree(event_data)
+        ):
+            session.tree_refresher.request()
+
+        if (
+            session.chat_session_id
+            and session.user_jwt
+            and event_data.get("content")
+            and event_data.get("event") in ("action", "observation", "error")
+        ):
+            for row_event in await _chat_row_events(session, event_data):
+                chat_writer.enqueue(
+                    session.chat_session_id, session.user_id, session.user_jwt, row_event,
+                )
+
+
+async def _chat_row_events(session, event_data: dict) -> list[dict]:
+    """The event as it goes into the chat history.
+
+    Content that was cut for the wire is read back from the blob store and
+    stored in full, split into ordered ``CHAT_CONTENT_CHUNK_CHARS`` rows so
+    no single row gets huge.  Each row's metadata carries its ``chunk``
+    position; content that could not be recovered keeps its ``truncated``
+    marker.
+    """
+    blob_id = event_data.get("truncated", {}).get("content", {}).get("blobId")
+    if blob_id is None or session.blobs is None:
+        return [event_data]
+    try:
+        content = await asyncio.to_thread(session.blobs.read_text, blob_id)
+    except (KeyError, OSError, UnicodeDecodeError) as exc:
+        logger.warning("Blob %s unreadable — storing the preview: %s", blob_id, exc)
+        return [event_data]
+
+    base = {k: v for k, v in event_data.items() if k != "truncated"}
+    chunks = [
+        content[i:i + CHAT_CONTENT_CHUNK_CHARS]
+        for i in range(0, len(content), CHAT_CONTENT_CHUNK_CHARS)
+    ]
+    if len(chunks) == 1:
+        return [{**base, "content": chunks[0]}]
+    return [
+        {**base, "content": chunk, "chunk": {"index": i, "count": len(chunks), "blobId": blob_id}}
+        for i, chunk in enumerate(chunks)
+    ]
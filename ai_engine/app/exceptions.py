@@ -9,6 +9,22 @@ class SessionNotFoundError(Exception):
     """Raised when a session ID does not exist in the store."""
 
 
+class NodeCapacityError(Exception):
+    """Raised when no session can be evicted to make room for a new one."""
+
+
+class EngineDrainingError(NodeCapacityError):
+    """Raised for new sessions while the engine drains before shutting down."""
+
+
+class RepoProvisionError(Exception):
+    """Raised when a session's repository cannot be checked out."""
+
+
+class WorkspaceTemplateError(ValueError):
+    """Raised for an unknown or invalid workspace template name."""
+
+
 class ProviderError(ValueError):
     """Raised for invalid / unsupported model provider."""
 
@@ -2,27 +2,20 @@
 
 from __future__ import annotations
 
+import asyncio
 import os
 import re
 
 from fastapi import APIRouter, Depends, HTTPException, Query, status
 
 from app.auth import AuthenticatedUser, get_current_user
-from app.config import logger, settings
+from app.config import settings
+from app.services.file_tree import scan_workspace, tree_from_index
 from app.services.sessions import store
 
 router = APIRouter(prefix="/api/v1/files", tags=["files"])
 
 
-# ── Exclude patterns for file listing ────────────────────────
-
-EXCLUDE_DIRS = {
-    ".git", "node_modules", "__pycache__", ".next",
-    ".venv", "venv", ".mypy_cache", ".pytest_cache",
-    "dist", "build", ".tox", ".eggs",
-}
-
-
 @router.get("/read")
 async def read_file(
     session_id: str = Query(...),
@@ -61,9 +54,16 @@ async def list_files(
     session_id: str = Query(...),
     user: AuthenticatedUser = Depends(get_current_user),
 ):
-    """List all files in the agent's workspace as a recursive tree."""
+    """List all files in the agent's workspace as a recursive tree.
+
+    Served from the session's watched snapshot when one is live;
+    otherwise the workspace is walked.
+    """
     workspace = await _resolve_workspace(session_id, user.user_id)
-    tree = _build_local_file_tree(workspace)
+    session = store.get_or_none(session_id)
+    if session is not None and session.file_tree is not None and session.file_tree.watched:
+        return {"tree": session.file_tree.tree()}
+    tree = await asyncio.to_thread(_build_local_file_tree, workspace)
     return {"tree": tree}
 
 
@@ -76,7 +76,7 @@ async def _resolve_workspace(session_id: str, user_id: str) -> str:
     destroyed), falls back to constructing the expected on-disk path so that
     file reads still work after the WebSocket closes.
     """
-    session = await store.get_or_none(session_id)
+    session = store.get_or_none(session_id)
     if session is not None:
         if session.user_id != user_id:
             raise HTTPException(
@@ -97,48 +97,33 @@ async def _resolve_workspace(session_id: str, user_id: str) -> str:
 
 
 async def build_file_tree(session) -> list[dict]:
-    """Build a file tree for the session's workspace."""
+    """Build a full file tree for the session's workspace.
+
+    Reads the session's snapshot without changing it: it is the baseline
+    of the ``file_tree_delta`` messages every attached viewer receives.
+    Unless a watcher keeps it current, a rescan is requested; its delta
+    goes to all subscribers, the new viewer included.
+    """
+    file_tree = getattr(session, "file_tree", None)
+    if file_tree is not None:
+        tree = await asyncio.to_thread(file_tree.tree)
+        if not file_tree.watched and getattr(session, "tree_refresher", None) is not None:
+            session.tree_refresher.request()
+        return tree
     if isinstance(session.workspace, str):
-        return _build_local_file_tree(session.workspace)
+        return await asyncio.to_thread(_build_local_file_tree, session.workspace)
     return []
 
 
 def _build_local_file_tree(root_dir: str) -> list[dict]:
     """Build a file tree from a local directory."""
+    return tree_from_index(scan_workspace(root_dir))
+
 
-    def walk_dir(dir_path: str) -> list[dict]:
-        entries = []
-        try:
-            items = sorted(os.listdir(dir_path))
-        except PermissionError:
-            return entries
-
-        for item in items:
-            full_path = os.path.join(dir_path, item)
-            rel_path = os.path.relpath(full_path, root_dir)
-
-            if os.path.isdir(full_path):
-                if item in EXCLUDE_DIRS or item.startswith("."):
-                    continue
-                entries.append({
-                    "name": item,
-                    "type": "folder",
-                    "path": "/" + rel_path,
-                    "children": walk_dir(full_path),
-                })
-            else:
-                entries.append({
-                    "name": item,
-                    "type": "file",
-                    "path": "/" + rel_path,
-                })
-
-        return entries
-
-    return walk_dir(root_dir)
-
-
-# ── File-change detection (used by WS streaming) ────────────
+# ── File-change detection (WS streaming fallback) ───────────
+#
+# Only used when no WorkspaceWatcher is running for the session; the
+# watcher reports exact paths instead of guessing from commands.
 
 _FILE_CHANGE_COMMANDS = re.compile(
     r"\b(touch|mkdir|rm|rmdir|mv|cp|git\s+clone|git\s+checkout|"
@@ -1,11 +1,19 @@
 """Health-check endpoints (no auth required)."""
 
 from fastapi import APIRouter
+from fastapi.responses import JSONResponse
 
 from app.config import settings, MODEL_CONFIGS
 from app.sdk import OPENHANDS_AVAILABLE
+from app.services.chat_writer import chat_writer
 from app.services.docker_workspace import docker_manager
+from app.services.reaper import session_reaper
+from app.services.agent_runner import agent_runner
+from app.services.agent_process import agent_processes
+from app.services.repo_cache import repo_cache
+from app.services.routing import session_router
 from app.services.sessions import store
+from app.services.workspace_templates import workspace_templates
 
 router = APIRouter(tags=["health"])
 
@@ -20,7 +28,15 @@ async def root():
         "openhands_available": OPENHANDS_AVAILABLE,
         "docker_available": docker_manager.is_docker_available(),
         "active_sandboxes": docker_manager.active_container_count,
-        "active_sessions": await store.count(),
+        "active_sessions": store.count(),
+        "sessions": store.stats(),
+        "reaper": session_reaper.stats(),
+        "agent_runs": agent_runner.stats(),
+        "agent_processes": agent_processes.stats(),
+        "worker": session_router.stats(),
+        "chat_writer": chat_writer.stats(),
+        "repo_cache": repo_cache.stats(),
+        "workspace_templates": workspace_templates.stats(),
         "llm_model": MODEL_CONFIGS.get(
             settings.DEFAULT_PROVIDER, {}
         ).get("model", "unknown"),
@@ -29,5 +45,7 @@ async def root():
 
 @router.get("/health")
 def health():
-    """Minimal health check for load balancers."""
+    """Minimal health check for load balancers — 503 while draining for shutdown."""
+    if store.draining:
+        return JSONResponse(status_code=503, content={"status": "draining"})
     return {"status": "ok"}
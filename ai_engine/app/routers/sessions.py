@@ -1,17 +1,27 @@
 """REST endpoints for agent session lifecycle."""
 
-from fastapi import APIRouter, Depends, HTTPException, status
+import asyncio
+import os
+import secrets
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 
 from app.auth import AuthenticatedUser, get_current_user
-from app.config import logger
-from app.schemas import InitSessionRequest, InitSessionResponse
+from app.config import logger, BLOB_READ_MAX_BYTES
+from app.schemas import InitSessionRequest, InitSessionResponse, SaveTemplateRequest
 from app.exceptions import (
     SessionNotFoundError,
     ProviderError,
     APIKeyMissingError,
+    NodeCapacityError,
+    RepoProvisionError,
+    WorkspaceTemplateError,
 )
 from app.sdk import OPENHANDS_AVAILABLE
+from app.services.routing import session_router
 from app.services.sessions import create_session, destroy_session, store
+from app.services.workspace_templates import workspace_templates
 
 router = APIRouter(prefix="/api/v1/sessions", tags=["sessions"])
 
@@ -31,9 +41,12 @@ async def init_session(
             branch=payload.branch,
             git_user_name=payload.gitUserName,
             git_user_email=payload.gitUserEmail,
+            user_jwt=user.raw_jwt,
+            template=payload.template,
             model_provider=payload.model_provider,
             api_key=payload.api_key,
             project_id=payload.projectId,
+            stream_tokens=payload.streamTokens,
         )
 
         return InitSessionResponse(
@@ -47,7 +60,19 @@ async def init_session(
             ),
         )
 
-    except (ProviderError, APIKeyMissingError) as exc:
+    except NodeCapacityError as exc:
+        logger.warning("Session init rejected: %s", exc)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail={"status": "error", "message": str(exc)},
+        )
+    except RepoProvisionError as exc:
+        logger.warning("Session init failed to check out the repository: %s", exc)
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail={"status": "error", "message": str(exc)},
+        )
+    except (ProviderError, APIKeyMissingError, WorkspaceTemplateError) as exc:
         logger.error("Session init validation error: %s", exc)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -69,30 +94,170 @@ async def init_session(
 
 @router.get("")
 async def list_sessions(user: AuthenticatedUser = Depends(get_current_user)):
-    """List active agent sessions for the authenticated user."""
-    sessions = await store.list_all()
+    """List active agent sessions for the authenticated user.
+
+    Sessions on other workers are listed from the registry, without the
+    live statistics only their own worker has.
+    """
+    sessions = store.list_for_user(user.user_id)
+    remote = await session_router.remote_sessions_for_user(user.user_id)
     return {
         "sessions": [
             {
                 "sessionId": s.session_id,
                 "userId": s.user_id,
+                "worker": session_router.worker_id,
                 "task": s.task[:80],
                 "isAlive": s.is_alive,
+                "hibernated": s.hibernated,
                 "createdAt": s.created_at.isoformat(),
+                "shareToken": s.share_token,
+                "events": s.events.stats(),
+                "blobs": s.blobs.stats(),
+                "tokenStream": s.deltas.stats() if s.deltas else None,
+                "fileTreeRefresh": s.tree_refresher.stats() if s.tree_refresher else None,
             }
             for s in sessions
-            if s.user_id == user.user_id
+        ] + [
+            {
+                "sessionId": owner.session_id,
+                "userId": owner.user_id,
+                "worker": owner.worker_id,
+                "task": owner.task[:80],
+                "isAlive": True,
+                "createdAt": owner.created_at,
+            }
+            for owner in remote
+            if not store.contains(owner.session_id)
         ]
     }
 
 
+@router.get("/templates")
+async def list_templates(user: AuthenticatedUser = Depends(get_current_user)):
+    """List the workspace templates the user can start sessions from."""
+    return {"templates": await asyncio.to_thread(workspace_templates.list_for_user, user.user_id)}
+
+
+@router.post("/{session_id}/template")
+async def save_template(
+    session_id: str,
+    payload: SaveTemplateRequest,
+    user: AuthenticatedUser = Depends(get_current_user),
+):
+    """Save the session's workspace as a template, replacing one of the same name.
+
+    New sessions started with ``template`` get a copy-on-write copy of it.
+    """
+    session = store.get_or_none(session_id)
+    if session is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Session {session_id} not found.",
+        )
+
+    if session.user_id != user.user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not authorized to save this session's workspace.",
+        )
+
+    if not isinstance(session.workspace, str):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="This session has no workspace.",
+        )
+    # A snapshot taken mid-run would catch the agent's edits half-done
+    if session.run_lock.locked():
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="The agent is running. Save the template once it has finished.",
+        )
+
+    try:
+        await asyncio.to_thread(workspace_templates.save, user.user_id, payload.name, session.workspace)
+    except WorkspaceTemplateError as exc:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail={"status": "error", "message": str(exc)},
+        )
+    except OSError as exc:
+        # Typically files the sandbox created that the engine can't read
+        path = exc.filename or ""
+        if path.startswith(session.workspace):
+            path = os.path.relpath(path, session.workspace)
+        where = f": {path}" if path else ""
+        logger.warning("Saving template %s from session %s failed: %s", payload.name, session_id, exc)
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail={
+                "status": "error",
+                "message": (
+                    f"Could not copy the workspace ({exc.strerror or exc}{where}). "
+                    "Fix or remove that file and try again."
+                ),
+            },
+        )
+
+    return {"status": "saved", "sessionId": session_id, "template": payload.name}
+
+
+@router.get("/{session_id}/blobs/{blob_id}")
+async def read_blob(
+    session_id: str,
+    blob_id: str,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(BLOB_READ_MAX_BYTES, ge=1, le=BLOB_READ_MAX_BYTES),
+    share_token: Optional[str] = Query(None, alias="shareToken"),
+    user: AuthenticatedUser = Depends(get_current_user),
+):
+    """Read a range of a large event field that was truncated on the wire.
+
+    ``offset`` and ``limit`` are in bytes of the UTF-8 text; the range is
+    widened or narrowed to whole characters.  Keep requesting from
+    ``nextOffset`` until it is ``null``.  Observers pass the session's
+    ``shareToken``.
+    """
+    session = store.get_or_none(session_id)
+    if session is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Session {session_id} not found.",
+        )
+
+    if session.user_id != user.user_id and not secrets.compare_digest(
+        share_token or "", session.share_token,
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not authorized to read this session.",
+        )
+
+    try:
+        data, start, size = await asyncio.to_thread(session.blobs.read, blob_id, offset, limit)
+    except KeyError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Blob {blob_id} not found.",
+        )
+
+    end = start + len(data)
+    return {
+        "blobId": blob_id,
+        "offset": start,
+        "size": size,
+        "nextOffset": end if end < size else None,
+        "content": data.decode("utf-8", errors="replace"),
+    }
+
+
 @router.delete("/{session_id}")
 async def stop_session(
     session_id: str,
     user: AuthenticatedUser = Depends(get_current_user),
 ):
     """Stop and destroy an agent session."""
-    session = await store.get_or_none(session_id)
+    session = store.get_or_none(session_id)
     if session is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -3,6 +3,9 @@
 from __future__ import annotations
 
 import asyncio
+import secrets
+import time
+import uuid
 from typing import Optional
 
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
@@ -12,17 +15,35 @@ from app.config import (
     logger,
     settings,
     WS_INIT_TIMEOUT_SECONDS,
+    WS_STOP_FLUSH_SECONDS,
+    WS_BATCH_WINDOW_SECONDS,
+    MAX_OBSERVERS_PER_SESSION,
     MOCK_STEP_DELAY_SECONDS,
     CONVERSATION_TIMEOUT_SECONDS,
 )
 from app import sdk
-from app.events import now_iso, stream_events_to_ws
+from app.events import now_iso, send_file_tree, stream_events_to_ws
+from app.exceptions import (
+    EngineDrainingError,
+    NodeCapacityError,
+    RepoProvisionError,
+    WorkspaceTemplateError,
+)
+from app.services.agent_runner import AgentRunQueueFull, AgentRunStopped, agent_runner
+from app.services.agent_process import AgentProcessError
+from app.services.bringup import PhaseCallback
 from app.services.chat import ChatService
+from app.services.event_hub import Subscription
+from app.services.routing import session_router
 from app.services.sessions import (
     AgentSession,
     create_session,
     destroy_session,
+    restore_session,
+    stop_conversation,
+    store,
 )
+from app.transport import WSEventWriter
 
 router = APIRouter()
 
@@ -33,10 +54,21 @@ async def websocket_agent(websocket: WebSocket):
 
     Protocol
     --------
-    1. Client sends initial config ``{ "task": "...", ... }``
-    2. Server creates a session and streams agent events back
+    1. Client sends initial config ``{ "task": "...", ... }`` — may include
+       ``"framing"``, ``"encoding"`` and ``"compression"`` (see app.transport),
+       and ``"streamTokens": true`` for partial LLM output as ``agent_delta``.
+       To reattach after a dropped connection it sends
+       ``{ "sessionId": "...", "resumeFrom": <last seq seen> }`` instead,
+       and a read-only observer sends ``{ "sessionId": "...", "observe": true }``.
+    2. Server creates (or resumes) a session and streams agent events back
     3. Client may send follow-ups ``{ "type": "message", "content": "..." }``
-    4. On disconnect the sandbox is cleaned up
+       or ``{ "type": "file_tree_resync" }`` to get a full ``file_tree``
+       A resume or observe for a session another worker owns is relayed
+       to that worker.
+    4. ``{ "type": "stop" }`` cancels a run in progress at once.  On stop
+       or error the sandbox is cleaned up.  On disconnect the
+       session is kept for ``SESSION_RESUME_GRACE_SECONDS`` so the client
+       can resume; after that it is cleaned up.
     """
     await websocket.accept()
     logger.info("WebSocket connection accepted")
@@ -47,8 +79,12 @@ async def websocket_agent(websocket: WebSocket):
         return  # closed by authenticate_websocket due to invalid token
 
     session: Optional[AgentSession] = None
+    writer: Optional[WSEventWriter] = None
     streaming_task: Optional[asyncio.Task] = None
-    chat_session_id: Optional[str] = None
+    reader_task: Optional[asyncio.Task] = None
+    inbox: asyncio.Queue = asyncio.Queue()
+    connection_id = str(uuid.uuid4())
+    keep_for_resume = False
 
     try:
         # ── 1. Receive initial config ────────────────────
@@ -70,156 +106,231 @@ async def websocket_agent(websocket: WebSocket):
             await websocket.close(code=4010, reason="Authentication required")
             return
 
-        task = raw.get("task", "")
-        if not task:
-            await websocket.send_json({
-                "type": "error",
-                "message": "Missing required field: 'task'",
-            })
-            await websocket.close(code=4001, reason="Missing task")
-            return
-
-        await websocket.send_json({
-            "type": "status",
-            "status": "initializing",
-            "message": "Setting up agent workspace...",
-        })
-
         user_id = ws_user.user_id
-
-        # ── 2. Create session ────────────────────────────
-        session = await create_session(
-            task=task,
-            user_id=user_id,
-            repo_url=raw.get("repoUrl", ""),
-            git_token=raw.get("gitToken", ""),
-            branch=raw.get("branch", ""),
-            git_user_name=raw.get("gitUserName", ""),
-            git_user_email=raw.get("gitUserEmail", ""),
-            model_provider=raw.get(
-                "modelProvider",
-                raw.get("model_provider", settings.DEFAULT_PROVIDER),
-            ),
-            api_key=raw.get("apiKey", raw.get("api_key", "")),
-            project_id=raw.get("projectId", ""),
-        )
-
         user_jwt = ws_user.raw_jwt
 
-        # ── Persist chat session to DB ───────────────────
-        try:
-            chat_sess = await ChatService.create_session(
-                user_id=user_id,
-                user_jwt=user_jwt,
-                agent_session_id=session.session_id,
-                project_id=raw.get("projectId"),
-                title=task[:255],
-                model_provider=raw.get(
-                    "modelProvider",
-                    raw.get("model_provider", settings.DEFAULT_PROVIDER),
-                ),
-            )
-            chat_session_id = chat_sess["id"]
-            logger.info("Chat session %s created for user %s", chat_session_id, user_id)
-        except Exception as exc:
-            logger.warning("Failed to create chat session in DB: %s", exc)
-
-        # Save user's initial message
-        if chat_session_id:
-            try:
-                await ChatService.add_message(
-                    session_id=chat_session_id, role="user",
-                    content=task, event_type="InitialTask",
-                    user_jwt=user_jwt,
-                )
-            except Exception as exc:
-                logger.warning("Failed to persist user message: %s", exc)
+        # ── Another worker's session → relay it there ────
+        target = raw.get("sessionId")
+        if target and not store.contains(target) and (
+            raw.get("observe") or raw.get("resumeFrom") is not None
+        ):
+            owner = await session_router.remote_owner(target, websocket.headers)
+            if owner is not None:
+                await session_router.relay_websocket(websocket, owner, raw)
+                return
+
+        # ── 1a. Read-only observer ───────────────────────
+        if raw.get("observe"):
+            await _observe_session(websocket, raw, ws_user)
+            return
 
-        # ── 3. Mock path ─────────────────────────────────
-        if not sdk.OPENHANDS_AVAILABLE:
-            await websocket.send_json({
+        # ── 1b. Resume an existing session ───────────────
+        if raw.get("resumeFrom") is not None:
+            resumed = await _resume_session(websocket, raw, user_id)
+            if resumed is None:
+                return
+            session, resume_from = resumed
+            session.touch()
+            session.connection_id = connection_id
+            session.user_jwt = user_jwt
+            writer = WSEventWriter.from_handshake(websocket, raw)
+
+            # Subscribe before announcing, so nothing published meanwhile is missed
+            subscription = session.events.subscribe(
+                "owner",
+                policy=settings.EVENT_BUFFER_OVERFLOW_POLICY,
+                after_seq=resume_from,
+            )
+            await writer.send_plain({
                 "type": "status",
-                "status": "mock_mode",
+                "status": "resumed",
                 "sessionId": session.session_id,
-                "message": (
-                    "Running in MOCK mode — OpenHands SDK not installed. "
-                    "Install openhands-sdk, openhands-tools, openhands-workspace "
-                    "to enable real agent execution."
-                ),
+                "lastSeq": session.replay.last_seq,
+                "running": session.run_lock.locked(),
+                "protocol": writer.describe(),
             })
-            await _run_mock_loop(websocket, session)
-            return
+            await _send_replay_gap(writer, subscription)
+            streaming_task = _attach_stream(writer, session, subscription)
+            reader_task = asyncio.create_task(_read_client(websocket, session, inbox))
+            _wake_session(session)
+            logger.info("Session %s resumed from seq %d", session.session_id, resume_from)
+
+        # ── 2. Create a new session ──────────────────────
+        else:
+            task = raw.get("task", "")
+            if not task:
+                await websocket.send_json({
+                    "type": "error",
+                    "message": "Missing required field: 'task'",
+                })
+                await websocket.close(code=4001, reason="Missing task")
+                return
 
-        # ── 4. Real agent loop ───────────────────────────
-        await websocket.send_json({
-            "type": "status",
-            "status": "ready",
-            "sessionId": session.session_id,
-            "message": "Agent session ready. Starting task...",
-        })
+            writer = WSEventWriter.from_handshake(websocket, raw)
+            await writer.send_plain({
+                "type": "status",
+                "status": "initializing",
+                "message": "Setting up agent workspace...",
+                "protocol": writer.describe(),
+            })
 
-        streaming_task = asyncio.create_task(
-            stream_events_to_ws(
-                websocket, session,
-                chat_session_id=chat_session_id,
-                user_jwt=user_jwt,
-            ),
-        )
+            async def report_phase(phase: str, state: str, elapsed: float) -> None:
+                frame = {
+                    "type": "status",
+                    "status": "initializing",
+                    "phase": phase,
+                    "phaseStatus": state,
+                }
+                if state != "started":
+                    frame["elapsedMs"] = round(elapsed * 1000)
+                await writer.send(frame)
+
+            # The chat record only needs the session id — write it while
+            # the sandbox and agent come up instead of after
+            session_id = str(uuid.uuid4())
+            created, chat_session_id = await asyncio.gather(
+                create_session(
+                    task=task,
+                    user_id=user_id,
+                    repo_url=raw.get("repoUrl", ""),
+                    git_token=raw.get("gitToken", ""),
+                    branch=raw.get("branch", ""),
+                    git_user_name=raw.get("gitUserName", ""),
+                    git_user_email=raw.get("gitUserEmail", ""),
+                    user_jwt=user_jwt,
+                    template=raw.get("template") or None,
+                    model_provider=raw.get(
+                        "modelProvider",
+                        raw.get("model_provider", settings.DEFAULT_PROVIDER),
+                    ),
+                    api_key=raw.get("apiKey", raw.get("api_key", "")),
+                    project_id=raw.get("projectId", ""),
+                    stream_tokens=bool(raw.get("streamTokens")),
+                    session_id=session_id,
+                    on_phase=report_phase,
+                ),
+                _create_chat_record(session_id, raw, task, ws_user, report_phase),
+                return_exceptions=True,
+            )
+            if isinstance(created, BaseException):
+                if chat_session_id and not isinstance(chat_session_id, BaseException):
+                    await _deactivate_chat(chat_session_id, ws_user)
+                if isinstance(created, EngineDrainingError):
+                    # Standard "service restart" code — clients reconnect, reaching another worker
+                    await writer.send_plain({"type": "error", "message": str(created)})
+                    await websocket.close(code=1012, reason="Server restarting")
+                    return
+                if isinstance(created, NodeCapacityError):
+                    await writer.send_plain({"type": "error", "message": str(created)})
+                    await websocket.close(code=4503, reason="Node at capacity")
+                    return
+                if isinstance(created, WorkspaceTemplateError):
+                    await writer.send_plain({"type": "error", "message": str(created)})
+                    await websocket.close(code=4001, reason="Unknown workspace template")
+                    return
+                if isinstance(created, RepoProvisionError):
+                    await writer.send_plain({"type": "error", "message": str(created)})
+                    await websocket.close(code=4502, reason="Repository checkout failed")
+                    return
+                raise created
+            session = created
+            session.connection_id = connection_id
+            session.user_jwt = user_jwt
+            if not isinstance(chat_session_id, BaseException):
+                session.chat_session_id = chat_session_id
+
+            # ── 3. Mock path ─────────────────────────────
+            if not sdk.OPENHANDS_AVAILABLE:
+                await writer.send({
+                    "type": "status",
+                    "status": "mock_mode",
+                    "sessionId": session.session_id,
+                    "message": (
+                        "Running in MOCK mode — OpenHands SDK not installed. "
+                        "Install openhands-sdk, openhands-tools, openhands-workspace "
+                        "to enable real agent execution."
+                    ),
+                })
+                await _run_mock_loop(websocket, writer, session)
+                return
 
-        await websocket.send_json({
-            "type": "agent_event",
-            "event": "task_start",
-            "content": f"Agent starting task: {task}",
-        })
+            # ── 4. Real agent loop ───────────────────────
+            await writer.send({
+                "type": "status",
+                "status": "ready",
+                "sessionId": session.session_id,
+                "message": "Agent session ready. Starting task...",
+                "timings": {
+                    phase: round(seconds * 1000)
+                    for phase, seconds in session.startup_timings.items()
+                },
+            })
 
-        session.conversation.send_message(task)
-        await _run_conversation_with_timeout(websocket, session)
+            subscription = session.events.subscribe(
+                "owner", policy=settings.EVENT_BUFFER_OVERFLOW_POLICY, after_seq=0,
+            )
+            streaming_task = _attach_stream(writer, session, subscription)
+            reader_task = asyncio.create_task(_read_client(websocket, session, inbox))
+            await _run_turn(session, task, f"Agent starting task: {task}")
 
         # ── 5. Follow-up loop ────────────────────────────
         while True:
-            data = await websocket.receive_json()
+            data = await inbox.get()
+            if isinstance(data, BaseException):
+                raise data
+            session.touch()
+            if not session.is_alive:
+                await writer.send({"type": "error", "message": "Session expired."})
+                break
+            if session.connection_id != connection_id:
+                await writer.send({
+                    "type": "error",
+                    "message": "Session was resumed on another connection.",
+                })
+                break
+
             msg_type = data.get("type", "message")
             content = data.get("content", "")
 
-            if not content:
-                await websocket.send_json({"type": "error", "message": "Empty content"})
+            if msg_type == "file_tree_resync":
+                await send_file_tree(writer, session)
                 continue
 
             if msg_type == "stop":
-                await websocket.send_json({
+                # The stopped run's last events and "cancelled" status go first
+                await _flush_stream(subscription, streaming_task)
+                await writer.send({
                     "type": "status",
                     "status": "stopping",
                     "message": "Stopping agent...",
                 })
                 break
 
+            if not content:
+                await writer.send({"type": "error", "message": "Empty content"})
+                continue
+
             logger.info("[%s] Follow-up: %s", session.session_id, content[:80])
 
             # Persist follow-up message
-            if chat_session_id:
+            if session.chat_session_id:
                 try:
                     await ChatService.add_message(
-                        session_id=chat_session_id, role="user",
+                        session_id=session.chat_session_id, role="user",
                         content=content, event_type="FollowUp",
                         user_jwt=user_jwt,
                     )
                 except Exception as exc:
                     logger.warning("Failed to persist follow-up message: %s", exc)
 
-            await websocket.send_json({
-                "type": "agent_event",
-                "event": "task_start",
-                "content": f"Processing: {content[:80]}...",
-            })
-
-            session.conversation.send_message(content)
-            await _run_conversation_with_timeout(websocket, session)
+            await _run_turn(session, content, f"Processing: {content[:80]}...")
 
     except WebSocketDisconnect:
         logger.info(
             "WebSocket disconnected%s",
             f" — session {session.session_id}" if session else "",
         )
+        keep_for_resume = True
     except asyncio.TimeoutError:
         logger.warning("WebSocket initial config timeout")
         try:
@@ -232,64 +343,373 @@ async def websocket_agent(websocket: WebSocket):
     except Exception as exc:
         logger.error("WebSocket error (session=%s): %s", getattr(session, "session_id", "?"), exc, exc_info=True)
         try:
-            await websocket.send_json({
+            await (writer.send if writer else websocket.send_json)({
                 "type": "error",
                 "message": "An internal error occurred. Please try again.",
             })
         except Exception:
             pass
     finally:
+        if reader_task:
+            reader_task.cancel()
         if streaming_task:
             streaming_task.cancel()
             try:
                 await streaming_task
             except asyncio.CancelledError:
                 pass
-        if session:
-            await destroy_session(session.session_id)
+        if writer:
+            await writer.close()
 
-        # Mark chat session as inactive
-        if chat_session_id and ws_user:
-            try:
-                await ChatService.deactivate_session(
-                    chat_session_id, user_id=ws_user.user_id, user_jwt=ws_user.raw_jwt
-                )
-            except Exception as exc:
-                logger.warning("Failed to mark chat session inactive: %s", exc)
+        # Only the connection currently attached decides the session's fate
+        if session and session.connection_id == connection_id:
+            session.connection_id = None
+            if keep_for_resume and sdk.OPENHANDS_AVAILABLE and session.is_alive:
+                _detach_session(session, ws_user)
+            else:
+                await _end_session(session, ws_user)
 
         logger.info("WebSocket session cleaned up")
 
 
-async def _run_conversation_with_timeout(
+# ── Session attachment helpers ───────────────────────────────
+
+async def _read_client(websocket: WebSocket, session: AgentSession, inbox: asyncio.Queue) -> None:
+    """Receive client messages into *inbox* for the follow-up loop.
+
+    Reading goes on while a turn runs, so a ``stop`` cancels the run at
+    once instead of waiting behind it.  A receive error (disconnect) is
+    put into the inbox as well and ends the reader.
+    """
+    while True:
+        try:
+            data = await websocket.receive_json()
+        except Exception as exc:
+            inbox.put_nowait(exc)
+            return
+        if isinstance(data, dict) and data.get("type") == "stop" and session.run_lock.locked():
+            session.stop_requested.set()
+        inbox.put_nowait(data)
+
+
+# Strong references to fire-and-forget tasks (asyncio only keeps weak ones)
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def _resume_session(
     websocket: WebSocket,
+    raw: dict,
+    user_id: str,
+) -> Optional[tuple[AgentSession, int]]:
+    """Validate a resume handshake and take the session over.
+
+    Closes the socket and returns ``None`` when the session cannot be resumed.
+    """
+    session = store.get_or_none(str(raw.get("sessionId") or ""))
+    if session is None or not session.is_alive:
+        await websocket.send_json({"type": "error", "message": "Session not found or expired."})
+        await websocket.close(code=4004, reason="Session not found")
+        return None
+    if session.user_id != user_id:
+        await websocket.send_json({"type": "error", "message": "Not authorized to resume this session."})
+        await websocket.close(code=4003, reason="Forbidden")
+        return None
+    try:
+        resume_from = max(0, int(raw["resumeFrom"]))
+    except (TypeError, ValueError):
+        await websocket.send_json({"type": "error", "message": "'resumeFrom' must be an integer."})
+        await websocket.close(code=4001, reason="Invalid resumeFrom")
+        return None
+
+    if session.detach_handle is not None:
+        session.detach_handle.cancel()
+        session.detach_handle = None
+
+    # Stop the previous connection's streamer so it cannot steal events
+    previous = session.stream_task
+    if previous is not None and not previous.done():
+        previous.cancel()
+        await asyncio.gather(previous, return_exceptions=True)
+
+    return session, resume_from
+
+
+def _attach_stream(
+    writer: WSEventWriter,
     session: AgentSession,
+    subscription: Subscription,
+) -> asyncio.Task:
+    """Start streaming the owner's subscription to *writer*."""
+    task = asyncio.create_task(stream_events_to_ws(writer, session, subscription))
+    session.stream_task = task
+    return task
+
+
+def _wake_session(session: AgentSession) -> None:
+    """Restore a hibernated session ahead of the client's next message."""
+    if not session.hibernated:
+        return
+
+    async def wake() -> None:
+        async with session.run_lock:
+            try:
+                await restore_session(session)
+            except Exception as exc:
+                logger.warning("Restoring session %s failed: %s", session.session_id, exc)
+
+    task = asyncio.create_task(wake())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _flush_stream(subscription: Subscription, streaming_task: asyncio.Task) -> None:
+    """Give the owner's stream up to ``WS_STOP_FLUSH_SECONDS`` to send what is queued."""
+    deadline = time.monotonic() + WS_STOP_FLUSH_SECONDS
+    while subscription.pending and not streaming_task.done() and time.monotonic() < deadline:
+        await asyncio.sleep(WS_BATCH_WINDOW_SECONDS)
+
+
+async def _send_replay_gap(writer: WSEventWriter, subscription: Subscription) -> None:
+    """Tell the client about agent events the replay ring no longer holds."""
+    if subscription.gap is None:
+        return
+    missed_from, replay_from = subscription.gap
+    await writer.send({
+        "type": "status",
+        "status": "replay_gap",
+        "missedFrom": missed_from,
+        "replayFrom": replay_from,
+        "message": "Some events are no longer buffered; reload the chat history for the gap.",
+    })
+
+
+async def _observe_session(
+    websocket: WebSocket,
+    raw: dict,
+    ws_user: AuthenticatedUser,
 ) -> None:
-    """Run ``conversation.run()`` with a timeout.
+    """Stream a session's events to a read-only observer until it disconnects.
 
-    Sends a "completed" or "timeout" status to the client when done.
+    The session owner may always observe (e.g. a second tab); anyone else
+    needs the session's ``shareToken``.  Observers share the agent's events
+    with the owner's connection — no extra sandbox or LLM calls — but their
+    buffers drop on overflow and catch up from the replay ring instead.
     """
+    session = store.get_or_none(str(raw.get("sessionId") or ""))
+    if session is None or not session.is_alive:
+        await websocket.send_json({"type": "error", "message": "Session not found or expired."})
+        await websocket.close(code=4004, reason="Session not found")
+        return
+    share_token = str(raw.get("shareToken") or "")
+    if session.user_id != ws_user.user_id and not secrets.compare_digest(share_token, session.share_token):
+        await websocket.send_json({"type": "error", "message": "Not authorized to observe this session."})
+        await websocket.close(code=4003, reason="Forbidden")
+        return
+    if len(session.events.subscribers("observer")) >= MAX_OBSERVERS_PER_SESSION:
+        await websocket.send_json({"type": "error", "message": "Too many observers on this session."})
+        await websocket.close(code=4029, reason="Too many observers")
+        return
+
     try:
-        await asyncio.wait_for(
-            asyncio.to_thread(session.conversation.run),
-            timeout=CONVERSATION_TIMEOUT_SECONDS,
-        )
+        after_seq = max(0, int(raw.get("resumeFrom") or 0))
+    except (TypeError, ValueError):
+        after_seq = 0
+
+    writer = WSEventWriter.from_handshake(websocket, raw)
+    subscription = session.events.subscribe("observer", policy="drop", after_seq=after_seq)
+    streaming_task = asyncio.create_task(stream_events_to_ws(writer, session, subscription))
+    logger.info("Observer %s attached to session %s", ws_user.user_id, session.session_id)
+    try:
+        await writer.send_plain({
+            "type": "status",
+            "status": "observing",
+            "sessionId": session.session_id,
+            "lastSeq": session.replay.last_seq,
+            "running": session.run_lock.locked(),
+            "protocol": writer.describe(),
+        })
+        await _send_replay_gap(writer, subscription)
+
+        while True:
+            data = await websocket.receive_json()
+            if data.get("type") == "file_tree_resync":
+                await send_file_tree(writer, session)
+            else:
+                await writer.send({"type": "error", "message": "Observers are read-only."})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        streaming_task.cancel()
         try:
-            await websocket.send_json({
-                "type": "status",
-                "status": "completed",
-                "message": "Agent task completed.",
+            await streaming_task
+        except asyncio.CancelledError:
+            pass
+        await writer.close()
+        logger.info("Observer %s left session %s", ws_user.user_id, session.session_id)
+
+
+def _detach_session(session: AgentSession, ws_user: Optional[AuthenticatedUser]) -> None:
+    """Keep a session without a WebSocket alive for the resume grace period."""
+
+    def expire() -> None:
+        session.detach_handle = None
+        if session.connection_id is None:
+            task = asyncio.create_task(_end_session(session, ws_user))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+
+    loop = asyncio.get_running_loop()
+    session.detach_handle = loop.call_later(settings.SESSION_RESUME_GRACE_SECONDS, expire)
+    logger.info(
+        "Session %s detached — resumable for %ds",
+        session.session_id, settings.SESSION_RESUME_GRACE_SECONDS,
+    )
+
+
+async def _end_session(session: AgentSession, ws_user: Optional[AuthenticatedUser]) -> None:
+    """Destroy the session and mark its chat inactive."""
+    await destroy_session(session.session_id)
+
+    if session.chat_session_id and ws_user:
+        await _deactivate_chat(session.chat_session_id, ws_user)
+
+
+async def _deactivate_chat(chat_session_id: str, ws_user: AuthenticatedUser) -> None:
+    try:
+        await ChatService.deactivate_session(
+            chat_session_id, user_id=ws_user.user_id, user_jwt=ws_user.raw_jwt
+        )
+    except Exception as exc:
+        logger.warning("Failed to mark chat session inactive: %s", exc)
+
+
+async def _create_chat_record(
+    session_id: str,
+    raw: dict,
+    task: str,
+    ws_user: AuthenticatedUser,
+    report_phase: PhaseCallback,
+) -> Optional[str]:
+    """Create the chat session row and save the initial task; returns its id.
+
+    A bring-up phase like the others.  Failures are logged, not raised —
+    the agent runs without history rather than not at all.
+    """
+    await report_phase("chat_record", "started", 0.0)
+    started = time.monotonic()
+    try:
+        chat_sess = await ChatService.create_session(
+            user_id=ws_user.user_id,
+            user_jwt=ws_user.raw_jwt,
+            agent_session_id=session_id,
+            project_id=raw.get("projectId"),
+            title=task[:255],
+            model_provider=raw.get(
+                "modelProvider",
+                raw.get("model_provider", settings.DEFAULT_PROVIDER),
+            ),
+        )
+        chat_session_id = chat_sess["id"]
+        logger.info("Chat session %s created for user %s", chat_session_id, ws_user.user_id)
+    except Exception as exc:
+        logger.warning("Failed to create chat session in DB: %s", exc)
+        await report_phase("chat_record", "failed", time.monotonic() - started)
+        return None
+
+    # Save user's initial message
+    try:
+        await ChatService.add_message(
+            session_id=chat_session_id, role="user",
+            content=task, event_type="InitialTask",
+            user_jwt=ws_user.raw_jwt,
+        )
+    except Exception as exc:
+        logger.warning("Failed to persist user message: %s", exc)
+    await report_phase("chat_record", "done", time.monotonic() - started)
+    return chat_session_id
+
+
+async def _run_turn(session: AgentSession, content: str, banner: str) -> None:
+    """Send one user message to the agent and run it to completion.
+
+    Turns are serialised per session, so a resumed connection's follow-up
+    waits for a run still owned by the previous connection.
+    """
+    async with session.run_lock:
+        if store.draining:
+            session.publish({
+                "type": "error",
+                "message": "The server is restarting. Reconnect to continue in a moment.",
             })
-        except (RuntimeError, Exception):
-            pass  # Client already disconnected — normal race condition
-    except asyncio.TimeoutError:
-        logger.warning("Session %s timed out after %ds", session.session_id, CONVERSATION_TIMEOUT_SECONDS)
-        try:
-            await websocket.send_json({
+            return
+        session.stop_requested.clear()
+        await restore_session(session)
+        session.publish({
+            "type": "agent_event",
+            "event": "task_start",
+            "content": banner,
+        })
+        session.conversation.send_message(content)
+        await _run_conversation_with_timeout(session)
+
+
+async def _run_conversation_with_timeout(session: AgentSession) -> None:
+    """Run ``conversation.run()`` on the agent pool with a timeout.
+
+    While the run waits for a free slot, "queued" statuses carry its
+    position and an ETA.  A timeout or ``session.stop_requested`` stops the
+    run for real (see ``stop_conversation``), within a bounded time.
+
+    Publishes a "completed", "cancelled" or timeout status on the
+    session's event buffer, so it reaches whichever connection is
+    attached, after the run's own events.
+    """
+    def report_queued(position: int, eta: Optional[float]) -> None:
+        session.publish({
+            "type": "status",
+            "status": "queued",
+            "position": position,
+            "etaSeconds": round(eta) if eta is not None else None,
+            "message": f"Waiting for a free agent slot (position {position}).",
+        })
+
+    try:
+        await agent_runner.run(
+            session.conversation.run,
+            timeout=CONVERSATION_TIMEOUT_SECONDS,
+            on_queued=report_queued,
+            cancel=session.stop_requested,
+            stop=lambda: stop_conversation(session),
+        )
+        session.publish({
+            "type": "status",
+            "status": "completed",
+            "message": "Agent task completed.",
+        })
+    except AgentRunQueueFull as exc:
+        session.publish({"type": "error", "message": str(exc)})
+    except AgentProcessError as exc:
+        # The session survives — the next turn reloads the conversation
+        logger.error("Session %s: agent process run failed: %s", session.session_id, exc)
+        session.publish({"type": "error", "message": f"Agent run failed: {exc}"})
+    except AgentRunStopped as exc:
+        logger.warning(
+            "Session %s: run stopped (%s) in %.1fs%s", session.session_id, exc.reason,
+            exc.stop_seconds, " — abandoned, still running" if exc.abandoned else "",
+        )
+        if exc.reason == "timeout":
+            session.publish({
                 "type": "error",
                 "message": f"Agent timed out after {CONVERSATION_TIMEOUT_SECONDS}s.",
+                "stopMs": round(exc.stop_seconds * 1000),
+            })
+        else:
+            session.publish({
+                "type": "status",
+                "status": "cancelled",
+                "message": "Agent run cancelled.",
+                "stopMs": round(exc.stop_seconds * 1000),
             })
-        except (RuntimeError, Exception):
-            pass  # Client already disconnected
 
 
 # ── Mock agent loop ──────────────────────────────────────────
@@ -348,7 +768,11 @@ _MOCK_STEPS: list[dict] = [
 ]
 
 
-async def _run_mock_loop(websocket: WebSocket, session: AgentSession) -> None:
+async def _run_mock_loop(
+    websocket: WebSocket,
+    writer: WSEventWriter,
+    session: AgentSession,
+) -> None:
     """Simulate agent behaviour when the SDK is not installed."""
     for step in _MOCK_STEPS:
         # Copy before mutating — _MOCK_STEPS is module-level; concurrent
@@ -357,15 +781,21 @@ async def _run_mock_loop(websocket: WebSocket, session: AgentSession) -> None:
         step_copy["timestamp"] = now_iso()
         if step_copy.get("eventType") == "ThinkAction":
             step_copy["content"] = f'Analyzing task: "{session.task}"'
-        await websocket.send_json(step_copy)
+        if step_copy["type"] == "agent_event":
+            await writer.send_event(session.replay.stamp(step_copy))
+        else:
+            await writer.send(step_copy)
+        # Sent straight to the writer, not published — keep the reaper informed
+        session.touch()
         await asyncio.sleep(MOCK_STEP_DELAY_SECONDS)
 
     try:
         while True:
             data = await websocket.receive_json()
+            session.touch()
             content = data.get("content", "")
             if content:
-                await websocket.send_json({
+                await writer.send_event(session.replay.stamp({
                     "type": "agent_event",
                     "event": "observation",
                     "eventType": "MockResponse",
@@ -374,6 +804,6 @@ async def _run_mock_loop(websocket: WebSocket, session: AgentSession) -> None:
                         "The agent would process this in production mode."
                     ),
                     "timestamp": now_iso(),
-                })
+                }))
     except (WebSocketDisconnect, Exception):
         pass
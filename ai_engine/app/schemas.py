@@ -21,6 +21,14 @@ class InitSessionRequest(BaseModel):
     api_key: Optional[str] = None
     gitUserName: Optional[str] = None
     gitUserEmail: Optional[str] = None
+    template: Optional[str] = None
+    streamTokens: bool = False
+
+
+class SaveTemplateRequest(BaseModel):
+    """Save a session's workspace as a named workspace template."""
+
+    name: str
 
 
 # ── Responses ───────────────────────────────────────────────
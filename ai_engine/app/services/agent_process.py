@@ -0,0 +1,508 @@
+"""Agent conversations in worker processes (``AGENT_RUNNER_MODE=process``).
+
+An agent's own work — formatting events, the SDK's bookkeeping, tool
+output handling — is Python and holds the GIL.  With many agents busy in
+one engine process they take turns on one core, and the event loop
+serving every WebSocket waits behind them.  In "process" mode each run
+executes in a separate process instead:
+
+- ``AgentProcessPool`` keeps up to ``AGENT_PROCESS_POOL_SIZE`` spawned
+  processes.  A run leases one for its duration, so one process runs one
+  conversation at a time.
+- ``ProcessConversation`` stands in for the SDK conversation on the
+  session — same ``send_message`` / ``run`` / ``pause`` / ``close`` — so
+  the agent runner and WebSocket code are unchanged.  ``run`` blocks its
+  agent-pool thread on the pipe (not holding the GIL) while the process
+  streams formatted events and token deltas back; they are published on
+  the session as in thread mode.
+- The process builds the conversation from the session's persisted state
+  (``persistence_dir``), so follow-ups work wherever they run.  It keeps
+  up to ``AGENT_PROCESS_WARM_CONVERSATIONS`` loaded between turns, and the
+  pool sends a session's next run to the process that has it loaded when
+  that one is free.  Only one process ever holds a session's conversation.
+
+Stopping works as in thread mode (pause, interrupt the sandbox), with a
+last resort a thread doesn't have: ``terminate`` kills the process if the
+run hasn't returned in time.  The pool replaces it, and the next turn
+reloads the conversation from disk.
+"""
+
+from __future__ import annotations
+
+import multiprocessing
+import os
+import signal
+import threading
+from collections import OrderedDict
+from typing import Any, NamedTuple, Optional
+
+from app.config import (
+    logger,
+    settings,
+    BLOB_STORE_DIR,
+    BLOB_STORE_MAX_BYTES,
+    AGENT_PROCESS_WARM_CONVERSATIONS,
+)
+
+# Seconds to wait for processes to exit on shutdown before killing them
+_EXIT_TIMEOUT = 2.0
+
+
+class AgentProcessError(Exception):
+    """A conversation run failed in, or lost, its agent process."""
+
+
+class ConversationSpec(NamedTuple):
+    """What an agent process needs to build a session's conversation."""
+
+    session_id: str
+    workspace: str
+    container_id: Optional[str]
+    provider: str
+    api_key: Optional[str]
+    stream_tokens: bool
+
+
+class _AgentProcess:
+    """The parent's handle on one agent process."""
+
+    __slots__ = ("process", "conn", "send_lock", "dead", "killed")
+
+    def __init__(self, process: multiprocessing.process.BaseProcess, conn: Any) -> None:
+        self.process = process
+        self.conn = conn
+        self.send_lock = threading.Lock()
+        self.dead = False     # the pipe broke — the process is gone
+        self.killed = False   # killed on purpose by terminate()
+
+    def send(self, message: tuple) -> None:
+        with self.send_lock:
+            self.conn.send(message)
+
+
+class AgentProcessPool:
+    """Spawned processes that conversation runs lease one at a time."""
+
+    def __init__(self, size: int, *, warm_per_process: int) -> None:
+        self.size = size
+        self._warm_per_process = warm_per_process
+        self._context = multiprocessing.get_context("spawn")
+        self._cond = threading.Condition()
+        self._count = 0   # processes alive or being started
+        self._idle: list[_AgentProcess] = []
+        self._busy: set[_AgentProcess] = set()
+        # session id → the process that has its conversation loaded
+        self._warm: dict[str, _AgentProcess] = {}
+        self._closed = False
+
+        self.spawned = 0
+        self.killed = 0
+        self.crashed = 0
+        self.warm_hits = 0
+
+    def lease(self, session_id: str) -> _AgentProcess:
+        """A process for the next run of *session_id*; waits if all are busy.
+
+        Blocking — called from the run's agent-pool thread.
+        """
+        spawn = False
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise AgentProcessError("Agent processes are shut down")
+                self._reap_idle()
+                warm = self._warm.get(session_id)
+                if warm is not None and warm in self._idle:
+                    self._idle.remove(warm)
+                    self._busy.add(warm)
+                    self.warm_hits += 1
+                    return warm
+                if self._idle:
+                    worker = self._idle.pop()
+                    self._busy.add(worker)
+                    break
+                if self._count < self.size:
+                    self._count += 1
+                    spawn = True
+                    break
+                self._cond.wait()
+            # The session moves: its old process must let go of its copy
+            previous = self._warm.pop(session_id, None)
+        if previous is not None:
+            self._send_quietly(previous, ("drop", session_id))
+
+        if spawn:
+            try:
+                worker = self._spawn()
+            except BaseException:
+                with self._cond:
+                    self._count -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._busy.add(worker)
+        return worker
+
+    def release(self, worker: _AgentProcess, session_id: str, *, keep: bool) -> None:
+        """Return *worker* after a run; with *keep* it stays warm for *session_id*."""
+        retire = worker.dead or worker.killed or not worker.process.is_alive()
+        with self._cond:
+            self._busy.discard(worker)
+            if retire or self._closed:
+                self._forget(worker)
+            else:
+                self._idle.append(worker)
+                if keep:
+                    self._warm[session_id] = worker
+            self._cond.notify()
+        if retire or self._closed:
+            self._retire(worker)
+        elif not keep:
+            self._send_quietly(worker, ("drop", session_id))
+
+    def drop(self, session_id: str) -> None:
+        """Unload *session_id*'s conversation from whichever process has it."""
+        with self._cond:
+            worker = self._warm.pop(session_id, None)
+        if worker is not None:
+            self._send_quietly(worker, ("drop", session_id))
+
+    def kill(self, worker: _AgentProcess) -> None:
+        """End a run that won't stop by killing its process."""
+        worker.killed = True
+        self.killed += 1
+        logger.warning("Killing agent process %s — its run did not stop", worker.process.pid)
+        worker.process.kill()
+
+    def shutdown(self) -> None:
+        """Stop every process; runs still going end with an error."""
+        with self._cond:
+            self._closed = True
+            workers = self._idle + list(self._busy)
+            self._idle = []
+            self._warm.clear()
+            self._cond.notify_all()
+        for worker in workers:
+            self._send_quietly(worker, ("exit",))
+        for worker in workers:
+            self._retire(worker)
+
+    def stats(self) -> dict:
+        """Counters for health/metrics endpoints."""
+        return {
+            "mode": settings.AGENT_RUNNER_MODE,
+            "size": self.size,
+            "processes": self._count,
+            "idle": len(self._idle),
+            "warmConversations": len(self._warm),
+            "spawned": self.spawned,
+            "warmHits": self.warm_hits,
+            "killed": self.killed,
+            "crashed": self.crashed,
+        }
+
+    # ── Internals ────────────────────────────────────────────
+
+    def _spawn(self) -> _AgentProcess:
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_process_main,
+            args=(child_conn, self._warm_per_process),
+            name="agent-process",
+            daemon=True,
+        )
+        process.start()
+        # Only the child holds its end, so the parent sees EOF when it dies
+        child_conn.close()
+        self.spawned += 1
+        logger.info("Started agent process %s", process.pid)
+        return _AgentProcess(process, parent_conn)
+
+    def _reap_idle(self) -> None:
+        # Called with the lock held: drop idle processes that died meanwhile
+        for worker in [w for w in self._idle if not w.process.is_alive()]:
+            self._idle.remove(worker)
+            self._forget(worker)
+            worker.conn.close()
+            self.crashed += 1
+            logger.warning(
+                "Idle agent process %s exited (code %s)", worker.process.pid, worker.process.exitcode,
+            )
+
+    def _forget(self, worker: _AgentProcess) -> None:
+        # Called with the lock held
+        self._count -= 1
+        for session_id in [sid for sid, w in self._warm.items() if w is worker]:
+            del self._warm[session_id]
+
+    def _retire(self, worker: _AgentProcess) -> None:
+        worker.process.join(_EXIT_TIMEOUT)
+        if worker.process.is_alive():
+            worker.process.kill()
+            worker.process.join(_EXIT_TIMEOUT)
+        worker.conn.close()
+
+    @staticmethod
+    def _send_quietly(worker: _AgentProcess, message: tuple) -> None:
+        try:
+            worker.send(message)
+        except (OSError, ValueError):
+            worker.dead = True
+
+
+class ProcessConversation:
+    """Stands in for the SDK conversation of a session run in agent processes.
+
+    Offers what the engine uses of ``LocalConversation``: ``send_message``
+    queues a message for the next ``run``; ``run`` blocks until the agent
+    process finishes, publishing its events on *session* meanwhile;
+    ``pause`` and ``close`` are passed on.  ``terminate`` kills the process
+    of a run that won't stop.
+    """
+
+    def __init__(self, pool: AgentProcessPool, spec: ConversationSpec, session: Any) -> None:
+        self._pool = pool
+        self._spec = spec
+        self._session = session
+        self._pending: list[str] = []
+        self._worker: Optional[_AgentProcess] = None
+        self._finished = threading.Event()
+        self._finished.set()
+        self._closed = False
+
+    def send_message(self, text: str) -> None:
+        self._pending.append(text)
+
+    def run(self) -> None:
+        messages, self._pending = self._pending, []
+        worker = self._pool.lease(self._spec.session_id)
+        self._finished.clear()
+        self._worker = worker
+        try:
+            try:
+                worker.send(("run", self._spec, messages))
+            except (OSError, ValueError) as exc:
+                worker.dead = True
+                raise AgentProcessError(f"Agent process unavailable: {exc}") from exc
+            self._relay(worker)
+        finally:
+            self._worker = None
+            self._finished.set()
+            self._pool.release(worker, self._spec.session_id, keep=not self._closed)
+
+    def pause(self) -> None:
+        worker = self._worker
+        if worker is not None:
+            AgentProcessPool._send_quietly(worker, ("pause", self._spec.session_id))
+
+    def terminate(self, timeout: float) -> None:
+        """Kill the running process unless the run returns within *timeout* seconds.
+
+        Blocking.
+        """
+        worker = self._worker
+        if worker is None or self._finished.wait(timeout):
+            return
+        if self._worker is worker:
+            self._pool.kill(worker)
+
+    def close(self) -> None:
+        self._closed = True
+        if self._worker is None:
+            self._pool.drop(self._spec.session_id)
+        # else run() unloads it from its process when it returns
+
+    def _relay(self, worker: _AgentProcess) -> None:
+        """Publish what the process sends until its run is done."""
+        session = self._session
+        while True:
+            try:
+                kind, payload = worker.conn.recv()
+            except (EOFError, OSError):
+                worker.dead = True
+                if worker.killed:
+                    return   # terminate() ended the run
+                worker.process.join(_EXIT_TIMEOUT)
+                self._pool.crashed += 1
+                raise AgentProcessError(
+                    f"Agent process exited unexpectedly (code {worker.process.exitcode})"
+                ) from None
+            if kind == "event":
+                if session.deltas is not None:
+                    session.deltas.flush()  # Partial text first, then the event
+                session.publish(payload)
+            elif kind == "delta":
+                if session.deltas is not None:
+                    session.deltas.feed(payload)
+            elif kind == "done":
+                if payload:
+                    raise AgentProcessError(payload)
+                return
+
+
+# ── Agent process side ──────────────────────────────────────
+
+class _ConversationHost:
+    """Runs conversations in an agent process, one at a time, as the parent asks.
+
+    Messages from the parent: ``("run", spec, messages)``,
+    ``("pause", session_id)``, ``("drop", session_id)``, ``("exit",)``.
+    To the parent: ``("event", data)`` and ``("delta", text)`` while a run
+    goes on, then ``("done", error or None)``.
+    """
+
+    def __init__(self, conn: Any, warm_max: int) -> None:
+        self._conn = conn
+        self._warm_max = warm_max
+        self._send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        # session id → (spec, conversation) loaded and idle, oldest first
+        self._warm: OrderedDict[str, tuple[ConversationSpec, Any]] = OrderedDict()
+        self._running: Optional[tuple[str, Any]] = None
+        # Session whose conversation is still being loaded for a run, and
+        # whether a pause arrived meanwhile — applied once it is built
+        self._starting: Optional[str] = None
+        self._pause_pending = False
+
+    def serve(self) -> None:
+        while True:
+            try:
+                message = self._conn.recv()
+            except (EOFError, OSError):
+                break   # The engine process is gone
+            kind = message[0]
+            if kind == "run":
+                with self._lock:
+                    self._starting = message[1].session_id
+                    self._pause_pending = False
+                threading.Thread(
+                    target=self._run, args=message[1:], name="agent-run", daemon=True,
+                ).start()
+            elif kind == "pause":
+                with self._lock:
+                    running = self._running
+                    if self._starting == message[1]:
+                        self._pause_pending = True
+                if running is not None and running[0] == message[1]:
+                    _pause(running[1], message[1])
+            elif kind == "drop":
+                with self._lock:
+                    entry = self._warm.pop(message[1], None)
+                if entry is not None:
+                    _close(entry[1])
+            elif kind == "exit":
+                break
+        with self._lock:
+            entries = list(self._warm.values())
+            self._warm.clear()
+        for _spec, conversation in entries:
+            _close(conversation)
+
+    def _run(self, spec: ConversationSpec, messages: list[str]) -> None:
+        error = None
+        conversation = None
+        try:
+            conversation = self._conversation(spec)
+            with self._lock:
+                self._running = (spec.session_id, conversation)
+                self._starting = None
+                paused = self._pause_pending
+            for text in messages:
+                conversation.send_message(text)
+            if paused:
+                # Stopped while the conversation was loading — don't start it
+                _pause(conversation, spec.session_id)
+            else:
+                conversation.run()
+        except Exception as exc:
+            logger.exception("Conversation %s failed", spec.session_id)
+            error = f"{type(exc).__name__}: {exc}"
+        finally:
+            with self._lock:
+                self._running = None
+                self._starting = None
+        if conversation is not None:
+            self._keep(spec, conversation)
+        self._send(("done", error))
+
+    def _conversation(self, spec: ConversationSpec) -> Any:
+        from app.events import format_sdk_event, delta_text
+        from app.services.blob_store import SessionBlobStore
+        from app.services.llm import resolve_llm
+        from app.services.sessions import build_agent, build_conversation
+
+        with self._lock:
+            entry = self._warm.pop(spec.session_id, None)
+        if entry is not None:
+            if entry[0] == spec:
+                return entry[1]
+            _close(entry[1])   # The session changed (new sandbox) — reload it
+
+        blobs = SessionBlobStore(
+            os.path.join(BLOB_STORE_DIR, spec.session_id), max_bytes=BLOB_STORE_MAX_BYTES,
+        )
+
+        def on_event(event):
+            try:
+                event_data = format_sdk_event(event, blobs)
+                if event_data:
+                    self._send(("event", event_data))
+            except Exception as exc:
+                logger.error("Event callback error: %s", exc)
+
+        def on_token(chunk):
+            text = delta_text(chunk)
+            if text:
+                self._send(("delta", text))
+
+        llm = resolve_llm(spec.provider, spec.api_key, stream=spec.stream_tokens)
+        return build_conversation(
+            spec.session_id,
+            workspace=spec.workspace,
+            container_id=spec.container_id,
+            agent=build_agent(llm),
+            callbacks=[on_event],
+            token_callbacks=[on_token] if spec.stream_tokens else None,
+        )
+
+    def _keep(self, spec: ConversationSpec, conversation: Any) -> None:
+        with self._lock:
+            self._warm[spec.session_id] = (spec, conversation)
+            evicted = []
+            while len(self._warm) > self._warm_max:
+                evicted.append(self._warm.popitem(last=False)[1][1])
+        for old in evicted:
+            _close(old)
+
+    def _send(self, message: tuple) -> None:
+        with self._send_lock:
+            self._conn.send(message)
+
+
+def _pause(conversation: Any, session_id: str) -> None:
+    try:
+        conversation.pause()
+    except Exception as exc:
+        logger.warning("Could not pause conversation %s: %s", session_id, exc)
+
+
+def _close(conversation: Any) -> None:
+    try:
+        conversation.close()
+    except Exception as exc:
+        logger.warning("Error closing conversation: %s", exc)
+
+
+def _process_main(conn: Any, warm_max: int) -> None:
+    """Entry point of an agent process."""
+    # Shutdown is the engine's call — Ctrl-C reaches the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _ConversationHost(conn, warm_max).serve()
+
+
+# Module-level singleton — processes are started on first use (process
+# mode only) and stopped by the app lifespan
+agent_processes = AgentProcessPool(
+    settings.AGENT_PROCESS_POOL_SIZE or settings.MAX_CONCURRENT_AGENT_RUNS,
+    warm_per_process=AGENT_PROCESS_WARM_CONVERSATIONS,
+)
@@ -0,0 +1,315 @@
+"""Dedicated executor and admission queue for agent runs.
+
+``conversation.run()`` blocks a thread for as long as the agent works —
+minutes, not milliseconds.  Running it through ``asyncio.to_thread``
+would park those threads in the loop's default executor, which also
+serves every short blocking call (Docker, file-tree scans, WAL reads), so
+with enough agents busy, container teardown and new sessions would wait
+behind them with no sign of why.
+
+``AgentRunner`` owns a separate pool of ``MAX_CONCURRENT_AGENT_RUNS``
+threads.  Runs beyond that wait in an explicit FIFO queue; each waiter is
+told its position and an ETA (from the average run time) whenever the
+queue moves.  A slot is freed when the run's thread really finishes —
+not when its caller stops waiting — so the pool is never oversubscribed
+by runs that timed out but are still working.
+
+Stopping a run
+--------------
+A thread can't be killed, so a run that times out or is cancelled (the
+*cancel* event) is asked to stop: the caller's *stop* function signals
+the work to wind down (the conversation pauses at its next step, the
+sandbox's running commands are killed).  The runner then gives the thread
+``AGENT_RUN_STOP_GRACE_SECONDS`` to return.  If it still hasn't, the run
+is abandoned: its slot goes to the next waiter and the thread finishes
+on one of ``AGENT_RUN_SPARE_THREADS`` spare threads.  Once every spare
+thread is taken by a stuck run, further stuck runs keep their slot.
+Either way the caller gets ``AgentRunStopped`` within the grace period,
+with how long stopping took.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import math
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from app.config import (
+    logger,
+    settings,
+    AGENT_RUN_QUEUE_MAX,
+    AGENT_RUN_STOP_GRACE_SECONDS,
+    AGENT_RUN_SPARE_THREADS,
+)
+
+# (position in queue — 1 is next, estimated seconds until admitted)
+QueueCallback = Callable[[int, Optional[float]], None]
+
+# Weight of the newest sample in the run-duration moving average
+_DURATION_EWMA_ALPHA = 0.2
+
+
+class AgentRunQueueFull(Exception):
+    """Raised when the admission queue is at ``AGENT_RUN_QUEUE_MAX``."""
+
+
+class AgentRunStopped(Exception):
+    """A run was stopped before it finished — it timed out or was cancelled."""
+
+    def __init__(self, reason: str, stop_seconds: float, abandoned: bool) -> None:
+        super().__init__(f"Agent run stopped ({reason}) in {stop_seconds:.1f}s")
+        self.reason = reason              # "timeout" or "cancelled"
+        self.stop_seconds = stop_seconds  # from the stop request until the run ended or was abandoned
+        self.abandoned = abandoned        # the thread was still running when its slot was handed on
+
+
+class _Slot:
+    __slots__ = ("held", "stopping")
+
+    def __init__(self) -> None:
+        self.held = True        # counts towards max_workers
+        self.stopping = False   # its duration says nothing about normal runs
+
+
+class _Waiter:
+    __slots__ = ("future", "on_queued")
+
+    def __init__(self, future: asyncio.Future, on_queued: Optional[QueueCallback]) -> None:
+        self.future = future
+        self.on_queued = on_queued
+
+
+class AgentRunner:
+    """Runs blocking agent loops on their own bounded thread pool."""
+
+    def __init__(
+        self,
+        max_workers: int,
+        *,
+        queue_max: int,
+        stop_grace: float,
+        spare_threads: int,
+    ) -> None:
+        self.max_workers = max_workers
+        self._queue_max = queue_max
+        self._stop_grace = stop_grace
+        self._spare_threads = spare_threads
+        # Spare threads let abandoned runs finish without taking a slot
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers + spare_threads, thread_name_prefix="agent-run",
+        )
+        self._running = 0
+        self._stuck = 0   # abandoned runs whose thread is still going
+        self._waiters: deque[_Waiter] = deque()
+        self._avg_duration: Optional[float] = None
+        self._last_stop: Optional[float] = None
+
+        self.started = 0
+        self.queued_total = 0
+        self.rejected = 0
+        self.stopped = 0
+        self.abandoned = 0
+
+    async def run(
+        self,
+        func: Callable[[], Any],
+        *,
+        timeout: float,
+        on_queued: Optional[QueueCallback] = None,
+        cancel: Optional[asyncio.Event] = None,
+        stop: Optional[Callable[[], None]] = None,
+    ) -> Any:
+        """Wait for a free slot, then run *func* on the agent pool.
+
+        After *timeout* seconds of running (time spent queued doesn't
+        count), or once *cancel* is set, the blocking *stop* is called to
+        make *func* return early, and ``AgentRunStopped`` is raised within
+        the stop grace period.  Raises ``AgentRunQueueFull`` if the queue
+        is full.
+        """
+        await self._admit(on_queued, cancel)
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        slot = _Slot()
+        try:
+            future = loop.run_in_executor(self._executor, func)
+        except BaseException:
+            self._release(None)
+            raise
+        future.add_done_callback(lambda _f: self._finish(slot, time.monotonic() - started))
+        self.started += 1
+
+        cancelled = asyncio.ensure_future(cancel.wait()) if cancel is not None else None
+        try:
+            # asyncio.wait never cancels the future: giving up on the result
+            # must not look like the run ended
+            await asyncio.wait(
+                [f for f in (future, cancelled) if f is not None],
+                timeout=timeout,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+        except asyncio.CancelledError:
+            # Nobody is waiting any more — still make the thread wind down
+            if stop is not None and not future.done():
+                loop.run_in_executor(None, stop)
+            raise
+        finally:
+            if cancelled is not None:
+                cancelled.cancel()
+
+        if future.done():
+            return future.result()
+        reason = "cancelled" if cancel is not None and cancel.is_set() else "timeout"
+        raise await self._stop(future, slot, stop, reason)
+
+    def shutdown(self) -> None:
+        """Stop accepting work; running agent threads are not waited for."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        """Counters for health/metrics endpoints."""
+        return {
+            "workers": self.max_workers,
+            "running": self._running,
+            "queued": len(self._waiters),
+            "started": self.started,
+            "queuedTotal": self.queued_total,
+            "rejected": self.rejected,
+            "avgRunSeconds": round(self._avg_duration, 1) if self._avg_duration is not None else None,
+            "stopped": self.stopped,
+            "abandoned": self.abandoned,
+            "stuck": self._stuck,
+            "lastStopMs": round(self._last_stop * 1000) if self._last_stop is not None else None,
+        }
+
+    # ── Stopping ─────────────────────────────────────────────
+
+    async def _stop(
+        self,
+        future: asyncio.Future,
+        slot: _Slot,
+        stop: Optional[Callable[[], None]],
+        reason: str,
+    ) -> AgentRunStopped:
+        begun = time.monotonic()
+        slot.stopping = True
+        if stop is not None:
+            try:
+                await asyncio.wait_for(asyncio.to_thread(stop), self._stop_grace)
+            except Exception as exc:
+                logger.warning("Stopping an agent run failed: %s", exc)
+        remaining = self._stop_grace - (time.monotonic() - begun)
+        if remaining > 0 and not future.done():
+            await asyncio.wait([future], timeout=remaining)
+
+        abandoned = False
+        if not future.done():
+            abandoned = self._abandon(slot)
+        elapsed = time.monotonic() - begun
+        self.stopped += 1
+        self._last_stop = elapsed
+        return AgentRunStopped(reason, elapsed, abandoned)
+
+    def _abandon(self, slot: _Slot) -> bool:
+        """Hand a stuck run's slot on; ``False`` if no spare thread is left."""
+        if self._stuck >= self._spare_threads:
+            logger.warning("Agent run did not stop and no spare thread is left — it keeps its slot")
+            return False
+        slot.held = False
+        self._stuck += 1
+        self.abandoned += 1
+        self._release(None)
+        return True
+
+    def _finish(self, slot: _Slot, duration: float) -> None:
+        if slot.held:
+            self._release(None if slot.stopping else duration)
+        else:
+            self._stuck -= 1   # an abandoned run finally returned
+
+    # ── Admission ────────────────────────────────────────────
+
+    async def _admit(
+        self,
+        on_queued: Optional[QueueCallback],
+        cancel: Optional[asyncio.Event],
+    ) -> None:
+        if cancel is not None and cancel.is_set():
+            raise AgentRunStopped("cancelled", 0.0, False)
+        if self._running < self.max_workers and not self._waiters:
+            self._running += 1
+            return
+        if len(self._waiters) >= self._queue_max:
+            self.rejected += 1
+            raise AgentRunQueueFull("Too many agent runs are waiting. Try again later.")
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), on_queued)
+        self._waiters.append(waiter)
+        self.queued_total += 1
+        self._notify(waiter, len(self._waiters))
+        try:
+            await self._wait_admitted(waiter, cancel)
+        except BaseException:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release(None)   # admitted just as we gave up
+            else:
+                waiter.future.cancel()
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                self._notify_all()
+            raise
+
+    async def _wait_admitted(self, waiter: _Waiter, cancel: Optional[asyncio.Event]) -> None:
+        if cancel is None:
+            await waiter.future   # resolved by _release with the slot taken over
+            return
+        cancelled = asyncio.ensure_future(cancel.wait())
+        try:
+            await asyncio.wait([waiter.future, cancelled], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            cancelled.cancel()
+        if not waiter.future.done():
+            raise AgentRunStopped("cancelled", 0.0, False)
+
+    def _release(self, duration: Optional[float]) -> None:
+        if duration is not None:
+            if self._avg_duration is None:
+                self._avg_duration = duration
+            else:
+                self._avg_duration += _DURATION_EWMA_ALPHA * (duration - self._avg_duration)
+
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.future.done():
+                waiter.future.set_result(None)   # the slot passes straight on
+                self._notify_all()
+                return
+        self._running -= 1
+
+    def _notify_all(self) -> None:
+        for position, waiter in enumerate(self._waiters, start=1):
+            self._notify(waiter, position)
+
+    def _notify(self, waiter: _Waiter, position: int) -> None:
+        if waiter.on_queued is None:
+            return
+        eta = None
+        if self._avg_duration is not None:
+            # Runs ahead of this one, spread over all workers
+            eta = math.ceil(position / self.max_workers) * self._avg_duration
+        try:
+            waiter.on_queued(position, eta)
+        except Exception as exc:
+            logger.debug("Agent queue callback failed: %s", exc)
+
+
+# Module-level singleton — shut down by the app lifespan
+agent_runner = AgentRunner(
+    settings.MAX_CONCURRENT_AGENT_RUNS,
+    queue_max=AGENT_RUN_QUEUE_MAX,
+    stop_grace=AGENT_RUN_STOP_GRACE_SECONDS,
+    spare_threads=AGENT_RUN_SPARE_THREADS,
+)
@@ -0,0 +1,125 @@
+"""Per-session store for event payloads too large to send inline.
+
+When an event's content (or thought) exceeds what goes out in one frame,
+the formatter keeps a preview in the event and writes the full text here
+once.  The event references it by ``blobId``; clients fetch the rest in
+ranges through ``GET /api/v1/sessions/{id}/blobs/{blob_id}`` and the
+chat persister reads it back to store the complete output.
+
+Layout: ``BLOB_STORE_DIR/<session id>/<blob id>.txt`` (UTF-8).  The
+directory is removed with the session.  ``put`` runs on the SDK callback
+thread; reads are blocking and meant for ``asyncio.to_thread``.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import shutil
+import threading
+import uuid
+from typing import Optional
+
+from app.config import logger
+
+_BLOB_ID_RE = re.compile(r"[0-9a-f]{32}")
+
+
+def _is_continuation(byte: int) -> bool:
+    """True for a UTF-8 continuation byte (``10xxxxxx``)."""
+    return byte & 0xC0 == 0x80
+
+
+class SessionBlobStore:
+    """Write-once text blobs for one session, capped at *max_bytes* in total."""
+
+    def __init__(self, directory: str, *, max_bytes: int) -> None:
+        self._dir = directory
+        self._max_bytes = max_bytes
+        self._used = 0
+        self._lock = threading.Lock()
+        self.stored = 0
+        self.rejected = 0
+
+    def put(self, text: str) -> Optional[str]:
+        """Store *text* and return its blob id, or ``None`` if it doesn't fit.
+
+        Thread-safe.
+        """
+        data = text.encode("utf-8")
+        with self._lock:
+            if self._used + len(data) > self._max_bytes:
+                self.rejected += 1
+                return None
+            self._used += len(data)
+
+        blob_id = uuid.uuid4().hex
+        try:
+            os.makedirs(self._dir, exist_ok=True)
+            with open(self._path(blob_id), "xb") as f:
+                f.write(data)
+        except OSError as exc:
+            logger.warning("Blob store write failed (%s): %s", self._dir, exc)
+            with self._lock:
+                self._used -= len(data)
+                self.rejected += 1
+            return None
+        with self._lock:
+            self.stored += 1
+        return blob_id
+
+    def read(self, blob_id: str, offset: int, limit: int) -> tuple[bytes, int, int]:
+        """``(data, start, size)``: about *limit* bytes of a blob from *offset*.
+
+        The range is moved to UTF-8 character boundaries, so every chunk
+        decodes on its own; *start* is where it really begins, and the next
+        range starts at ``start + len(data)``.  Raises ``KeyError`` for an
+        unknown blob.
+        """
+        path = self._path(blob_id)
+        try:
+            with open(path, "rb") as f:
+                total = os.fstat(f.fileno()).st_size
+                # A UTF-8 character is at most 4 bytes: read that much slack
+                # on both sides to find the nearest boundaries
+                offset = min(offset, total)
+                start = max(0, offset - 3)
+                f.seek(start)
+                window = f.read(offset - start + limit + 8)
+        except FileNotFoundError:
+            raise KeyError(blob_id) from None
+
+        head = offset - start
+        while head < len(window) and _is_continuation(window[head]):
+            head += 1
+        end = min(head + limit, len(window))
+        while head < end < len(window) and _is_continuation(window[end]):
+            end -= 1
+        if end == head < len(window):
+            # limit is smaller than the next character — return it whole
+            end += 1
+            while end < len(window) and _is_continuation(window[end]):
+                end += 1
+        return window[head:end], start + head, total
+
+    def read_text(self, blob_id: str) -> str:
+        """The whole blob as text.  Raises ``KeyError`` for an unknown blob."""
+        try:
+            with open(self._path(blob_id), "rb") as f:
+                return f.read().decode("utf-8")
+        except FileNotFoundError:
+            raise KeyError(blob_id) from None
+
+    def clear(self) -> None:
+        """Delete every blob of the session."""
+        shutil.rmtree(self._dir, ignore_errors=True)
+        with self._lock:
+            self._used = 0
+
+    def stats(self) -> dict:
+        return {"stored": self.stored, "rejected": self.rejected, "bytes": self._used}
+
+    def _path(self, blob_id: str) -> str:
+        if not _BLOB_ID_RE.fullmatch(blob_id):
+            raise KeyError(blob_id)
+        return os.path.join(self._dir, f"{blob_id}.txt")
@@ -0,0 +1,98 @@
+"""Dependency-ordered, concurrent bring-up of a session.
+
+Session start-up is a handful of slow, mostly independent steps —
+building the agent, starting the sandbox, scanning the workspace, the
+chat-record writes.  A ``BringUpPlan`` declares them with their
+dependencies and runs every step as soon as the steps it needs are done,
+so independent ones overlap instead of queueing::
+
+    plan = BringUpPlan(on_phase=report)
+    plan.step("agent", build_agent)
+    plan.step("sandbox", start_sandbox)
+    plan.step("conversation", build_conversation, after=("agent", "sandbox"))
+    results = await plan.run()
+
+Step functions are coroutine functions taking no arguments; they read
+what they need from ``plan.results``.  ``on_phase(name, state, elapsed)``
+is awaited as each step starts (``"started"``), ends (``"done"``) or
+fails (``"failed"``) — used to send progress frames to the client.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from app.config import logger
+
+PhaseCallback = Callable[[str, str, float], Awaitable[None]]
+
+
+class BringUpPlan:
+    """A small DAG of async steps, run with maximum overlap."""
+
+    def __init__(self, on_phase: Optional[PhaseCallback] = None) -> None:
+        self._steps: dict[str, tuple[Callable[[], Awaitable[Any]], tuple[str, ...]]] = {}
+        self._on_phase = on_phase
+        self.results: dict[str, Any] = {}
+        # Seconds each step took
+        self.timings: dict[str, float] = {}
+
+    def step(
+        self,
+        name: str,
+        func: Callable[[], Awaitable[Any]],
+        *,
+        after: tuple[str, ...] = (),
+    ) -> None:
+        """Add a step that runs once every step in *after* has finished."""
+        for dep in after:
+            if dep not in self._steps:
+                raise ValueError(f"Bring-up step {name!r} depends on unknown step {dep!r}")
+        self._steps[name] = (func, after)
+
+    async def run(self) -> dict[str, Any]:
+        """Run all steps; returns their results by name.
+
+        The first failing step cancels the others and its exception is
+        re-raised.
+        """
+        tasks: dict[str, asyncio.Task] = {}
+
+        async def run_step(name: str) -> Any:
+            func, after = self._steps[name]
+            if after:
+                await asyncio.gather(*(tasks[dep] for dep in after))
+            await self._report(name, "started", 0.0)
+            started = time.monotonic()
+            try:
+                result = await func()
+            except Exception:
+                self.timings[name] = time.monotonic() - started
+                await self._report(name, "failed", self.timings[name])
+                raise
+            self.timings[name] = time.monotonic() - started
+            self.results[name] = result
+            await self._report(name, "done", self.timings[name])
+            return result
+
+        # Steps are declared after their dependencies, so tasks[dep] exists
+        for name in self._steps:
+            tasks[name] = asyncio.create_task(run_step(name))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        return self.results
+
+    async def _report(self, name: str, state: str, elapsed: float) -> None:
+        if self._on_phase is None:
+            return
+        try:
+            await self._on_phase(name, state, elapsed)
+        except Exception as exc:
+            logger.debug("Bring-up phase callback failed (%s): %s", name, exc)
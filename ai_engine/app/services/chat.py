@@ -173,6 +173,24 @@ class ChatService:
             logger.error("Unexpected error in add_message: %s", exc)
             raise HTTPException(status_code=500, detail="Internal server error") from exc
 
+    @staticmethod
+    def event_row(session_id: str, event: dict) -> dict:
+        """Build the ``chat_messages`` row for one agent event dict.
+
+        The row id is generated client-side, so the same row can be
+        written again without creating a duplicate.  A ``truncated``
+        marker or ``chunk`` position on the event goes into the metadata.
+        """
+        metadata = {key: event[key] for key in ("truncated", "chunk") if key in event}
+        return {
+            "id": str(uuid.uuid4()),
+            "session_id": session_id,
+            "role": "assistant",
+            "content": event["content"],
+            "event_type": event.get("eventType", ""),
+            "metadata_json": metadata or None,
+        }
+
     @staticmethod
     async def add_messages(
         events: list[dict],
@@ -182,20 +200,32 @@ class ChatService:
         """Batch-insert a list of event dicts as assistant messages."""
         if not events:
             return
-        rows = [
-            {
-                "id": str(uuid.uuid4()),
-                "session_id": session_id,
-                "role": "assistant",
-                "content": e["content"],
-                "event_type": e.get("eventType", ""),
-                "metadata_json": None,
-            }
-            for e in events
-        ]
+        await ChatService.add_message_rows(
+            [ChatService.event_row(session_id, e) for e in events], user_jwt,
+        )
+
+    @staticmethod
+    async def add_message_rows(
+        rows: list[dict],
+        user_jwt: str | None,
+        *,
+        ignore_duplicates: bool = False,
+    ) -> None:
+        """Insert prepared ``chat_messages`` rows in a single request.
+
+        With ``ignore_duplicates`` rows whose id already exists are skipped,
+        which makes resending the same rows safe.
+        """
+        if not rows:
+            return
         try:
             async with db_client(user_jwt) as client:
-                await client.table("chat_messages").insert(rows).execute()
+                table = client.table("chat_messages")
+                if ignore_duplicates:
+                    query = table.upsert(rows, on_conflict="id", ignore_duplicates=True)
+                else:
+                    query = table.insert(rows)
+                await query.execute()
         except APIError as exc:
             logger.error("Supabase error in add_messages: code=%s msg=%s", exc.code, exc.message)
             raise HTTPException(status_code=500, detail="Database error") from exc
@@ -0,0 +1,279 @@
+"""Local write-ahead log for chat-history rows.
+
+Every row the ``ChatEventWriter`` is asked to persist is appended here
+*before* it is queued for the database, and stays until an insert
+containing it succeeds.  When Supabase is slow or down nothing is lost:
+the writer ships the pending rows again later, and rows left over by a
+previous process are shipped on startup.
+
+Layout: ``CHAT_WAL_DIR/<segment id>.wal``, one JSON record per line::
+
+    {"u": "<user id>", "r": {<chat_messages row, with its client-side id>}}
+
+Appends are flushed to the OS on every write (they survive a process
+crash) and fsynced when a segment is sealed after
+``CHAT_WAL_SEGMENT_ROWS`` rows.  A sealed segment whose rows have all
+been acknowledged is deleted — that is the whole compaction story.
+Rows the database keeps rejecting are moved to ``dead-letter.jsonl``.
+
+Only the event loop touches a ``ChatWAL``'s bookkeeping.  The file work
+— writes, fsyncs, deletes, reads — runs on one dedicated I/O thread, in
+the order it was asked for, so the event-persist path never waits on the
+disk and a read always sees the appends queued before it.  ``recover``
+is blocking and meant for ``asyncio.to_thread``, before the first append.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+from app.config import logger
+
+_DEAD_LETTER_FILE = "dead-letter.jsonl"
+
+
+class _Segment:
+    __slots__ = ("segment_id", "path", "file", "rows", "pending")
+
+    def __init__(self, segment_id: int, path: str) -> None:
+        self.segment_id = segment_id
+        self.path = path
+        self.file = None        # open for append while active — I/O thread only
+        self.rows = 0
+        self.pending: set[str] = set()   # row ids not yet in the database
+
+
+class ChatWAL:
+    """Append-only segment files holding chat rows until the DB has them."""
+
+    def __init__(self, directory: str, *, segment_rows: int) -> None:
+        self._dir = directory
+        self._segment_rows = segment_rows
+        self._segments: dict[int, _Segment] = {}
+        self._active: Optional[_Segment] = None
+        self._next_id = 1
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-wal")
+        # Where failed writes are reported back to — set by the first append
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.write_errors = 0
+        self.dead_lettered = 0
+
+    @property
+    def pending_count(self) -> int:
+        return sum(len(seg.pending) for seg in self._segments.values())
+
+    def segment_count(self) -> int:
+        return len(self._segments)
+
+    def is_pending(self, segment_id: int, row_id: str) -> bool:
+        seg = self._segments.get(segment_id)
+        return seg is not None and row_id in seg.pending
+
+    # ── Writing ──────────────────────────────────────────────
+
+    def append(self, user_id: str, row: dict) -> int:
+        """Log *row* and return the id of the segment holding it.
+
+        The write happens on the I/O thread.  If it fails the row stops
+        counting as pending — it only lives in memory from then on.
+        """
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        seg = self._active
+        if seg is None or seg.rows >= self._segment_rows:
+            if seg is not None:
+                self._seal(seg)
+            seg = self._open_segment()
+
+        line = json.dumps({"u": user_id, "r": row}, separators=(",", ":"), default=str)
+        seg.rows += 1
+        seg.pending.add(row["id"])
+        self._io.submit(self._write, seg, line.encode("utf-8") + b"\n").add_done_callback(
+            lambda future: self._on_write_done(future, seg, row["id"]),
+        )
+        return seg.segment_id
+
+    def dead_letter(self, segment_id: int, user_id: str, row: dict, reason: str) -> None:
+        """Move a row the database keeps rejecting out of the WAL, into the dead-letter file."""
+        line = json.dumps(
+            {"u": user_id, "r": row, "error": reason}, separators=(",", ":"), default=str,
+        )
+        self._io.submit(self._append_dead_letter, line.encode("utf-8") + b"\n")
+        self.dead_lettered += 1
+        self.ack(segment_id, [row["id"]])
+
+    def ack(self, segment_id: int, row_ids: list[str]) -> None:
+        """Mark rows as stored; drop the segment once it is sealed and empty."""
+        seg = self._segments.get(segment_id)
+        if seg is None:
+            return
+        seg.pending.difference_update(row_ids)
+        if not seg.pending and seg is not self._active:
+            self._delete(seg)
+
+    def close(self) -> None:
+        """Seal the active segment (fsync) and finish the queued file work.
+
+        Blocking — call it through ``asyncio.to_thread``.
+        """
+        if self._active is not None:
+            self._seal(self._active)
+        self._io.shutdown(wait=True)
+
+    def _open_segment(self) -> _Segment:
+        segment_id = self._next_id
+        self._next_id += 1
+        seg = _Segment(segment_id, os.path.join(self._dir, f"{segment_id:010d}.wal"))
+        self._segments[segment_id] = seg
+        self._active = seg
+        return seg
+
+    def _seal(self, seg: _Segment) -> None:
+        self._io.submit(self._sync_and_close, seg)
+        if seg is self._active:
+            self._active = None
+        if not seg.pending:
+            self._delete(seg)
+
+    def _delete(self, seg: _Segment) -> None:
+        self._segments.pop(seg.segment_id, None)
+        self._io.submit(self._remove, seg)
+
+    def _on_write_done(self, future: Future, seg: _Segment, row_id: str) -> None:
+        # Runs on the I/O thread — hand the bookkeeping back to the loop
+        exc = future.exception()
+        if exc is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._write_failed, seg, row_id, exc)
+            except RuntimeError:
+                pass  # Loop already closed — shutting down
+
+    def _write_failed(self, seg: _Segment, row_id: str, exc: BaseException) -> None:
+        self.write_errors += 1
+        if self.write_errors == 1 or self.write_errors % 100 == 0:
+            logger.error(
+                "Chat WAL append failed (%s) — %d row(s) kept in memory only so far: %s",
+                seg.path, self.write_errors, exc,
+            )
+        self.ack(seg.segment_id, [row_id])
+
+    # ── File work (I/O thread) ───────────────────────────────
+
+    def _write(self, seg: _Segment, data: bytes) -> None:
+        if seg.file is None:
+            os.makedirs(self._dir, exist_ok=True)
+            seg.file = open(seg.path, "ab")
+        seg.file.write(data)
+        seg.file.flush()
+
+    def _sync_and_close(self, seg: _Segment) -> None:
+        if seg.file is None:
+            return
+        try:
+            os.fsync(seg.file.fileno())
+            seg.file.close()
+        except OSError as exc:
+            logger.warning("Chat WAL seal failed (%s): %s", seg.path, exc)
+        seg.file = None
+
+    def _remove(self, seg: _Segment) -> None:
+        self._sync_and_close(seg)
+        try:
+            os.remove(seg.path)
+        except OSError:
+            pass
+
+    def _append_dead_letter(self, data: bytes) -> None:
+        path = os.path.join(self._dir, _DEAD_LETTER_FILE)
+        try:
+            os.makedirs(self._dir, exist_ok=True)
+            with open(path, "ab") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as exc:
+            logger.error("Chat dead-letter write failed (%s): %s", path, exc)
+
+    # ── Reading ──────────────────────────────────────────────
+
+    def recover(self) -> int:
+        """Load segments left by a previous process; returns pending rows.
+
+        Must run before the first ``append``.  Every row found counts as
+        pending — whether it reached the database is unknown, and replays
+        are idempotent.
+        """
+        try:
+            names = sorted(n for n in os.listdir(self._dir) if n.endswith(".wal"))
+        except FileNotFoundError:
+            return 0
+
+        for name in names:
+            try:
+                segment_id = int(name[:-4])
+            except ValueError:
+                continue
+            seg = _Segment(segment_id, os.path.join(self._dir, name))
+            for _user_id, row in self._iter_records(seg.path):
+                seg.rows += 1
+                seg.pending.add(row["id"])
+            self._next_id = max(self._next_id, segment_id + 1)
+            if seg.pending:
+                self._segments[segment_id] = seg
+            else:
+                self._delete(seg)
+        return self.pending_count
+
+    def pending_snapshot(self, exclude: set[str]) -> list[tuple[int, frozenset[str]]]:
+        """``(segment id, pending ids)`` for rows not in *exclude* — loop side."""
+        result = []
+        for seg in self._segments.values():
+            ids = frozenset(seg.pending - exclude)
+            if ids:
+                result.append((seg.segment_id, ids))
+        return result
+
+    async def read_pending(
+        self,
+        segment_id: int,
+        row_ids: frozenset[str],
+        limit: int,
+    ) -> list[tuple[str, dict]]:
+        """Up to *limit* ``(user id, row)`` records of *row_ids* from one segment."""
+        seg = self._segments.get(segment_id)
+        if seg is None:
+            return []
+        return await asyncio.wrap_future(
+            self._io.submit(self._read_records, seg, row_ids, limit),
+        )
+
+    def _read_records(
+        self,
+        seg: _Segment,
+        row_ids: frozenset[str],
+        limit: int,
+    ) -> list[tuple[str, dict]]:
+        records = []
+        for user_id, row in self._iter_records(seg.path):
+            if row["id"] in row_ids:
+                records.append((user_id, row))
+                if len(records) >= limit:
+                    break
+        return records
+
+    @staticmethod
+    def _iter_records(path: str):
+        try:
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        yield record["u"], record["r"]
+                    except (ValueError, KeyError, TypeError):
+                        continue  # Torn write at the tail of a crashed segment
+        except OSError as exc:
+            logger.error("Chat WAL read failed (%s): %s", path, exc)
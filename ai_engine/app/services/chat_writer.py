@@ -0,0 +1,514 @@
+"""Shared write-behind pipeline for chat-history events.
+
+Session persisters hand rows to ``chat_writer.enqueue()``, which never
+waits on the database.  One background task drains the queue for the
+whole process:
+
+- rows that arrive while an insert is in flight pile up and go out
+  together, so batches grow on their own when the database slows down;
+- rows are grouped by the JWT they must be written under (RLS), so one
+  multi-row insert covers every session of a user, and the groups of
+  different users are inserted concurrently;
+- the batch cap and the linger before a flush follow observed insert
+  latency instead of a fixed size and interval.  While full batches
+  finish under ``CHAT_WRITER_TARGET_LATENCY_SECONDS`` the cap doubles
+  (up to ``CHAT_WRITER_BATCH_MAX``).  Past the target it hill-climbs on
+  rows/second: keep resizing the same way while throughput improves,
+  turn around when it drops, and shrink when size makes no difference —
+  so a slow round trip gets amortised by bigger inserts, while a
+  database that chokes on big inserts gets smaller ones.
+
+Durability
+----------
+Each row is appended to the local ``ChatWAL`` before it is queued, and
+acknowledged there once an insert containing it succeeds.  A failed
+insert no longer loses its batch: its rows are shipped again from the
+WAL after a back-off (``CHAT_WAL_RETRY_MIN_SECONDS`` doubling to
+``CHAT_WAL_RETRY_MAX_SECONDS``).  The back-off is kept per JWT group, so
+one user's failing inserts never hold up or throttle anyone else's.
+Inserts are idempotent — rows carry client-side ids and duplicates are
+ignored — so a row that reached the database just before a crash is
+harmless to resend.
+
+Failures no single row can cause (connection errors, timeouts, 5xx,
+schema errors) are retried for as long as it takes.  An insert refused
+for its JWT (expired, or RLS denied it) is resent at once under the
+user's newer JWT, or else with the service role.  Only a rejection one
+bad row can cause — a data exception or constraint violation — is
+bisected, one half at a time, to find the offending rows and let the
+rest through; a row rejected ``CHAT_WRITER_MAX_ATTEMPTS`` times goes to
+the WAL's dead-letter file instead of being retried.
+
+The in-memory queue is bounded by ``CHAT_WRITER_QUEUE_MAX``; when it is
+full the oldest rows are left to the WAL and shipped from disk later.
+Rows recovered from a previous process are written with the service
+role, since the JWTs they were queued under are gone.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import deque
+from typing import Optional
+
+import httpx
+from fastapi import HTTPException
+from postgrest.exceptions import APIError
+
+from app.config import (
+    logger,
+    CHAT_WAL_DIR,
+    CHAT_WAL_SEGMENT_ROWS,
+    CHAT_WAL_RETRY_MIN_SECONDS,
+    CHAT_WAL_RETRY_MAX_SECONDS,
+    CHAT_WRITER_QUEUE_MAX,
+    CHAT_WRITER_BATCH_MIN,
+    CHAT_WRITER_BATCH_MAX,
+    CHAT_WRITER_TARGET_LATENCY_SECONDS,
+    CHAT_WRITER_MIN_LINGER_SECONDS,
+    CHAT_WRITER_MAX_LINGER_SECONDS,
+    CHAT_WRITER_MAX_ATTEMPTS,
+)
+from app.services.chat import ChatService
+from app.services.chat_wal import ChatWAL
+
+# Weight of the newest sample in the insert-latency moving average
+_LATENCY_EWMA_ALPHA = 0.2
+# Throughput ratio between two batches that counts as a real change
+_RATE_CHANGE = 1.1
+# SQLSTATE classes a single row can cause: data exception, integrity
+# constraint violation
+_ROW_SQLSTATE_CLASSES = ("22", "23")
+# SQLSTATE for an RLS / grant denial, and PostgREST's JWT error codes
+_INSUFFICIENT_PRIVILEGE = "42501"
+_AUTH_POSTGREST_PREFIX = "PGRST30"
+# JWTs remembered as refused before the set starts over
+_REJECTED_JWTS_MAX = 1024
+
+
+class _QueuedRow:
+    __slots__ = ("user_id", "user_jwt", "row", "segment_id")
+
+    def __init__(
+        self,
+        user_id: str,
+        user_jwt: Optional[str],
+        row: dict,
+        segment_id: int,
+    ) -> None:
+        self.user_id = user_id
+        self.user_jwt = user_jwt
+        self.row = row
+        self.segment_id = segment_id
+
+
+class ChatEventWriter:
+    """Process-wide, batching writer for ``chat_messages`` rows.
+
+    Must be used from the event loop.  ``start()`` recovers rows a previous
+    process left in the WAL; the worker task also starts on the first
+    ``enqueue()``.  ``close()`` drains what is queued and stops it.
+    """
+
+    def __init__(self, wal: ChatWAL) -> None:
+        self._wal = wal
+        self._queue: deque[_QueuedRow] = deque()
+        # Row ids in _queue — the WAL replay skips them
+        self._queued_ids: set[str] = set()
+        # Latest JWT seen per user, for resending that user's rows
+        self._jwt_by_user: dict[str, str] = {}
+        # JWTs the database refused — their rows go out with the service role
+        self._rejected_jwts: set[str] = set()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+        self._batch_limit = CHAT_WRITER_BATCH_MIN
+        self._latency: float | None = None
+        self._rate: float | None = None   # rows/second of the last full batch
+        self._growing = True
+        self._replay_next = False
+        # Per JWT group: current back-off (seconds) and when it may insert again
+        self._group_backoff: dict[Optional[str], float] = {}
+        self._group_retry_at: dict[Optional[str], float] = {}
+        # Per failed row id: rejections by the database so far, and when it is due again
+        self._attempts: dict[str, int] = {}
+        self._retry_at: dict[str, float] = {}
+
+        self.enqueued = 0
+        self.written = 0
+        self.replayed = 0
+        self.failed = 0
+        self.deferred = 0
+        self.lost = 0
+        self.inserts = 0
+
+    async def start(self) -> None:
+        """Pick up rows left in the WAL by a previous process."""
+        pending = await asyncio.to_thread(self._wal.recover)
+        if pending:
+            logger.info("Chat WAL: %d row(s) from a previous run to resend", pending)
+            self._ensure_worker()
+
+    def enqueue(
+        self,
+        chat_session_id: str,
+        user_id: str,
+        user_jwt: Optional[str],
+        event: dict,
+    ) -> bool:
+        """Log *event* to the WAL and queue it for *chat_session_id*.  Never blocks."""
+        if self._closing:
+            return False
+        row = ChatService.event_row(chat_session_id, event)
+        if user_jwt in self._rejected_jwts:
+            user_jwt = None
+        if user_jwt:
+            self._jwt_by_user[user_id] = user_jwt
+        segment_id = self._wal.append(user_id, row)
+
+        retry_at = self._group_retry_at.get(user_jwt, 0.0)
+        if retry_at > time.monotonic():
+            # The group is backing off — the row waits in the WAL with it
+            self._retry_at[row["id"]] = retry_at
+            self.deferred += 1
+            self.enqueued += 1
+            return True
+
+        if len(self._queue) >= CHAT_WRITER_QUEUE_MAX:
+            evicted = self._queue.popleft()
+            self._queued_ids.discard(evicted.row["id"])
+            if self._wal.is_pending(evicted.segment_id, evicted.row["id"]):
+                self.deferred += 1   # still in the WAL — resent from disk later
+            else:
+                self.lost += 1
+
+        self._queue.append(_QueuedRow(user_id, user_jwt, row, segment_id))
+        self._queued_ids.add(row["id"])
+        self.enqueued += 1
+        self._ensure_worker()
+        self._wakeup.set()
+        return True
+
+    async def close(self) -> None:
+        """Try to write everything still queued, then stop the worker.
+
+        Rows the database did not take stay in the WAL for the next start.
+        """
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await asyncio.to_thread(self._wal.close)
+
+    def stats(self) -> dict:
+        """Counters for health/metrics endpoints."""
+        now = time.monotonic()
+        return {
+            "queued": len(self._queue),
+            "walPending": self._wal.pending_count,
+            "walSegments": self._wal.segment_count(),
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "replayed": self.replayed,
+            "failed": self.failed,
+            "deferred": self.deferred,
+            "lost": self.lost,
+            "deadLettered": self._wal.dead_lettered,
+            "walWriteErrors": self._wal.write_errors,
+            "retrying": len(self._retry_at),
+            "backingOffGroups": sum(1 for t in self._group_retry_at.values() if t > now),
+            "inserts": self.inserts,
+            "batchLimit": self._batch_limit,
+            "insertLatencyMs": round(self._latency * 1000, 1) if self._latency is not None else None,
+        }
+
+    # ── Worker ───────────────────────────────────────────────
+
+    def _ensure_worker(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            replay = [] if self._closing else self._replay_due()
+            if replay and (self._replay_next or not self._queue):
+                self._replay_next = False
+                await self._replay_from_wal(replay)
+            elif self._queue:
+                # Alternate with the replay so a busy queue can't starve it
+                self._replay_next = True
+                await self._write_queued()
+            elif self._closing:
+                return
+            else:
+                # Sleep until woken, or until the next row backing off is due
+                self._wakeup.clear()
+                timeout = None
+                if self._retry_at:
+                    timeout = max(0.0, min(self._retry_at.values()) - time.monotonic())
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _replay_due(self) -> list[tuple[int, frozenset[str]]]:
+        """WAL rows to resend: pending, not queued, and not backing off."""
+        if self._wal.pending_count <= len(self._queued_ids):
+            return []
+        now = time.monotonic()
+        waiting = {row_id for row_id, due in self._retry_at.items() if due > now}
+        return self._wal.pending_snapshot(exclude=self._queued_ids | waiting)
+
+    async def _write_queued(self) -> None:
+        # Linger about one insert's worth of time to gather a fuller
+        # batch — a short moment on a fast database.
+        if len(self._queue) < self._batch_limit and not self._closing:
+            await asyncio.sleep(min(
+                CHAT_WRITER_MAX_LINGER_SECONDS,
+                max(CHAT_WRITER_MIN_LINGER_SECONDS, self._latency or 0.0),
+            ))
+
+        count = min(len(self._queue), self._batch_limit)
+        batch = [self._queue.popleft() for _ in range(count)]
+        for item in batch:
+            self._queued_ids.discard(item.row["id"])
+
+        started = time.monotonic()
+        self.written += await self._insert_grouped(batch)
+        self._adapt(time.monotonic() - started, count)
+
+    async def _replay_from_wal(self, snapshot: list[tuple[int, frozenset[str]]]) -> None:
+        """Resend rows the WAL still holds but no queue entry covers."""
+        segment_id, row_ids = snapshot[0]
+        records = await self._wal.read_pending(segment_id, row_ids, self._batch_limit)
+        if not records:
+            # Pending ids with no readable record — nothing left to resend
+            self._wal.ack(segment_id, list(row_ids))
+            return
+
+        batch = [
+            _QueuedRow(user_id, self._jwt_by_user.get(user_id), row, segment_id)
+            for user_id, row in records
+        ]
+        self.replayed += await self._insert_grouped(batch)
+
+    async def _insert_grouped(self, batch: list[_QueuedRow]) -> int:
+        """One multi-row insert per JWT, concurrently; returns rows stored."""
+        groups: dict[Optional[str], list[_QueuedRow]] = {}
+        for item in batch:
+            groups.setdefault(item.user_jwt, []).append(item)
+        results = await asyncio.gather(*(
+            self._insert(items, user_jwt) for user_jwt, items in groups.items()
+        ))
+        return sum(results)
+
+    async def _insert(self, items: list[_QueuedRow], user_jwt: Optional[str]) -> int:
+        exc = await self._try_insert(items, user_jwt)
+        if exc is None:
+            self._stored(items, user_jwt)
+            return len(items)
+
+        kind = _failure_kind(exc)
+        if kind == "auth" and user_jwt is not None:
+            return await self._insert_reauthorized(items, user_jwt)
+        if kind == "row" and len(items) > 1:
+            # One bad row fails the whole insert — find it, let the rest through
+            stored, rejected, held, last = await self._bisect(items, user_jwt)
+            exc = last or exc
+        elif kind == "row":
+            stored, rejected, held = 0, items, []
+        else:
+            stored, rejected, held = 0, [], items
+        if rejected or held:
+            self._insert_failed(rejected, held, user_jwt, exc)
+        return stored
+
+    async def _try_insert(self, items: list[_QueuedRow], user_jwt: Optional[str]) -> Optional[Exception]:
+        self.inserts += 1
+        try:
+            await ChatService.add_message_rows(
+                [item.row for item in items], user_jwt, ignore_duplicates=True,
+            )
+        except Exception as exc:
+            return exc
+        return None
+
+    async def _bisect(
+        self,
+        items: list[_QueuedRow],
+        user_jwt: Optional[str],
+    ) -> tuple[int, list[_QueuedRow], list[_QueuedRow], Exception]:
+        """Split a rejected batch until the rejected rows are alone.
+
+        Halves go out one after the other.  Returns the rows stored, the
+        rows the database rejected, the rows that failed for another
+        reason (they wait with the group) and the last error.
+        """
+        stored, rejected, held = 0, [], []
+        last: Optional[Exception] = None
+        half = len(items) // 2
+        for part in (items[:half], items[half:]):
+            if held:
+                held.extend(part)   # The group is failing — stop probing
+                continue
+            exc = await self._try_insert(part, user_jwt)
+            if exc is None:
+                self._stored(part, user_jwt)
+                stored += len(part)
+            elif _failure_kind(exc) != "row":
+                held.extend(part)
+                last = exc
+            elif len(part) > 1:
+                part_stored, part_rejected, part_held, last = await self._bisect(part, user_jwt)
+                stored += part_stored
+                rejected.extend(part_rejected)
+                held.extend(part_held)
+            else:
+                rejected.extend(part)
+                last = exc
+        return stored, rejected, held, last
+
+    async def _insert_reauthorized(self, items: list[_QueuedRow], user_jwt: str) -> int:
+        """Resend rows refused under *user_jwt* (expired, not allowed).
+
+        Each row goes out under its user's latest JWT if that is a
+        different one, else with the service role — the rows are the
+        engine's own record of the user's session, not client input.
+        """
+        self._rejected_jwts.add(user_jwt)
+        if len(self._rejected_jwts) > _REJECTED_JWTS_MAX:
+            self._rejected_jwts = {user_jwt}
+        groups: dict[Optional[str], list[_QueuedRow]] = {}
+        for item in items:
+            latest = self._jwt_by_user.get(item.user_id)
+            if latest == user_jwt:
+                del self._jwt_by_user[item.user_id]
+                latest = None
+            item.user_jwt = latest
+            groups.setdefault(latest, []).append(item)
+        results = await asyncio.gather(*(
+            self._insert(group, jwt) for jwt, group in groups.items()
+        ))
+        return sum(results)
+
+    def _stored(self, items: list[_QueuedRow], user_jwt: Optional[str]) -> None:
+        self._group_backoff.pop(user_jwt, None)
+        self._group_retry_at.pop(user_jwt, None)
+        by_segment: dict[int, list[str]] = {}
+        for item in items:
+            row_id = item.row["id"]
+            self._attempts.pop(row_id, None)
+            self._retry_at.pop(row_id, None)
+            by_segment.setdefault(item.segment_id, []).append(row_id)
+        for segment_id, row_ids in by_segment.items():
+            self._wal.ack(segment_id, row_ids)
+
+    def _insert_failed(
+        self,
+        rejected: list[_QueuedRow],
+        held: list[_QueuedRow],
+        user_jwt: Optional[str],
+        exc: Exception,
+    ) -> None:
+        """Back the JWT group off once; dead-letter rows rejected too often.
+
+        *rejected* rows were refused by the database themselves (a bad
+        value, a constraint) and count towards ``CHAT_WRITER_MAX_ATTEMPTS``;
+        *held* rows failed with the whole group (outage, auth, schema) and
+        are retried for as long as it takes.
+        """
+        self.failed += len(rejected) + len(held)
+        backoff = min(
+            CHAT_WAL_RETRY_MAX_SECONDS,
+            max(CHAT_WAL_RETRY_MIN_SECONDS, self._group_backoff.get(user_jwt, 0.0) * 2),
+        )
+        retry_at = time.monotonic() + backoff
+        self._group_backoff[user_jwt] = backoff
+        self._group_retry_at[user_jwt] = retry_at
+
+        dead = 0
+        for item in (*rejected, *held):
+            row_id = item.row["id"]
+            if not self._wal.is_pending(item.segment_id, row_id):
+                self.lost += 1   # Its WAL write failed — nowhere to resend it from
+                continue
+            self._retry_at[row_id] = retry_at
+        for item in rejected:
+            row_id = item.row["id"]
+            if row_id not in self._retry_at:
+                continue
+            attempts = self._attempts.get(row_id, 0) + 1
+            if attempts >= CHAT_WRITER_MAX_ATTEMPTS:
+                self._attempts.pop(row_id, None)
+                self._retry_at.pop(row_id, None)
+                self._wal.dead_letter(item.segment_id, item.user_id, item.row, str(exc.__cause__ or exc))
+                dead += 1
+            else:
+                self._attempts[row_id] = attempts
+
+        # Rows of this group already queued would only fail again meanwhile
+        waiting = [item for item in self._queue if item.user_jwt == user_jwt]
+        if waiting:
+            self._queue = deque(item for item in self._queue if item.user_jwt != user_jwt)
+            for item in waiting:
+                self._queued_ids.discard(item.row["id"])
+                self._retry_at[item.row["id"]] = retry_at
+            self.deferred += len(waiting)
+
+        logger.warning(
+            "Failed to write %d chat event(s) to DB (%d rejected) — kept in WAL, retrying in %.0fs%s: %s",
+            len(rejected) + len(held), len(rejected), backoff,
+            f", {dead} moved to the dead-letter file" if dead else "", exc.__cause__ or exc,
+        )
+
+    def _adapt(self, elapsed: float, count: int) -> None:
+        if self._latency is None:
+            self._latency = elapsed
+        else:
+            self._latency += _LATENCY_EWMA_ALPHA * (elapsed - self._latency)
+
+        if count < self._batch_limit:
+            return  # Not limited by the cap — nothing to learn about it
+        rate = count / max(elapsed, 1e-3)
+        if elapsed <= CHAT_WRITER_TARGET_LATENCY_SECONDS:
+            self._growing = True
+        elif self._rate is not None:
+            if rate * _RATE_CHANGE < self._rate:
+                self._growing = not self._growing    # last resize hurt — turn around
+            elif rate < self._rate * _RATE_CHANGE:
+                self._growing = False                # size doesn't matter — keep latency low
+        self._rate = rate
+
+        if self._growing:
+            self._batch_limit = min(CHAT_WRITER_BATCH_MAX, self._batch_limit * 2)
+        else:
+            self._batch_limit = max(CHAT_WRITER_BATCH_MIN, self._batch_limit // 2)
+
+
+def _failure_kind(exc: Exception) -> str:
+    """Why an insert failed: ``"row"``, ``"auth"`` or ``"group"``.
+
+    ``"row"`` — the database refused a value or constraint, which one bad
+    row can cause; ``"auth"`` — the JWT expired or RLS denied the write;
+    ``"group"`` — anything else (outage, timeout, schema), which no row of
+    the batch can be blamed for.
+    """
+    cause = exc.__cause__ if isinstance(exc, HTTPException) and exc.__cause__ else exc
+    if isinstance(cause, APIError):
+        code = str(cause.code or "")
+        if code.startswith(_AUTH_POSTGREST_PREFIX) or code == _INSUFFICIENT_PRIVILEGE:
+            return "auth"
+        if not code.startswith("PGRST") and code[:2] in _ROW_SQLSTATE_CLASSES:
+            return "row"
+        return "group"
+    if isinstance(cause, httpx.HTTPStatusError) and cause.response.status_code in (401, 403):
+        return "auth"
+    return "group"
+
+
+# Module-level singleton — used by session persisters, started and
+# closed by the app lifespan
+chat_writer = ChatEventWriter(ChatWAL(CHAT_WAL_DIR, segment_rows=CHAT_WAL_SEGMENT_ROWS))
@@ -9,7 +9,10 @@ Each agent session gets its own Docker container (the "sandbox") with:
 This module owns the full container lifecycle:
   - create_sandbox()               — spin up a fresh container for a session
   - destroy_container()            — stop + remove a specific container
+  - stop_container() / start_container() — park a hibernating session's sandbox
+  - interrupt_processes()          — kill the commands a stopped run left running
   - cleanup_orphaned_containers()  — remove leftover containers on startup
+  - remove_session_container()     — remove the sandbox of a dead worker's session
   - destroy_all()                  — remove all tracked containers on shutdown
 """
 
@@ -22,7 +25,37 @@ from typing import Optional
 import docker
 from docker.errors import NotFound
 
-from app.config import logger, settings
+from app.config import (
+    logger,
+    settings,
+    SANDBOX_INTERRUPT_GRACE_SECONDS,
+    SESSION_TEARDOWN_CONCURRENCY,
+)
+
+
+# POSIX sh over /proc (the sandbox image has no procps guarantee).  Per
+# process, after the ")" closing the command name: state ppid pgrp session.
+_INTERRUPT_JOBS_SCRIPT = r"""
+signal_jobs() {
+    sig=$1
+    read -r line < /proc/$$/stat
+    set -- ${line##*) }
+    keep=" $3 " jobs=" "
+    for stat in /proc/[0-9]*/stat; do
+        read -r line < "$stat" 2>/dev/null || continue
+        pid=${line%% *}
+        set -- ${line##*) }
+        if [ "$pid" = 1 ] || [ "$2" -le 1 ] || [ "$pid" = "$4" ]; then
+            keep="$keep$3 "
+        fi
+        case "$jobs" in *" $3 "*) ;; *) jobs="$jobs$3 " ;; esac
+    done
+    for pgrp in $jobs; do
+        case "$keep" in *" $pgrp "*) ;; *) kill -"$sig" -"$pgrp" 2>/dev/null ;; esac
+    done
+}
+signal_jobs INT; sleep "$1"; signal_jobs KILL
+"""
 
 
 class DockerSessionManager:
@@ -127,9 +160,38 @@ class DockerSessionManager:
         await asyncio.to_thread(self._remove_container, container_id)
         logger.info("Sandbox container destroyed for session %s", session_id)
 
-    def cleanup_orphaned_containers(self) -> int:
+    async def stop_container(self, container_id: str, session_id: str) -> None:
+        """Stop a sandbox but keep it, for a hibernating session."""
+        await asyncio.to_thread(self._stop_container, container_id)
+        logger.info("Sandbox container stopped for session %s", session_id)
+
+    async def start_container(self, container_id: str, session_id: str) -> None:
+        """Start a sandbox stopped by ``stop_container`` again."""
+        await asyncio.to_thread(self._start_container, container_id)
+        logger.info("Sandbox container started for session %s", session_id)
+
+    def interrupt_processes(self, container_id: str) -> None:
+        """Kill the commands running in a sandbox, but not the workspace itself (blocking).
+
+        Only the process groups of jobs are signalled — what a shell with
+        job control (the agent's terminal) runs a command line in.  The
+        groups of init, of processes started by init or ``docker exec``
+        (the workspace's tool server, tmux) and of session leaders (the
+        shells themselves) are left alone, so the next turn finds its
+        terminal intact.  Jobs get SIGINT first, like Ctrl-C, and whatever
+        ignores it is killed a second later.
+        """
+        container = self.client.containers.get(container_id)
+        container.exec_run(
+            ["sh", "-c", _INTERRUPT_JOBS_SCRIPT, "sh", str(SANDBOX_INTERRUPT_GRACE_SECONDS)],
+            user="root",
+        )
+
+    def cleanup_orphaned_containers(self, keep: frozenset[str] = frozenset()) -> int:
         """Remove any leftover containers from previous runs.
 
+        Containers of the sessions in *keep* — owned by other live workers
+        sharing this Docker daemon — are left alone.
         Returns the number of containers cleaned up.
         """
         try:
@@ -139,8 +201,9 @@ class DockerSessionManager:
             )
             count = 0
             for container in containers:
+                if container.labels.get("lucid.session_id") in keep:
+                    continue
                 try:
-                    container.stop(timeout=3)
                     container.remove(force=True)
                     count += 1
                 except Exception:
@@ -151,22 +214,35 @@ class DockerSessionManager:
             return 0
 
     async def destroy_all(self) -> None:
-        """Destroy all tracked containers (called on shutdown)."""
-        for session_id in list(self._containers.keys()):
-            container_id = self._containers.pop(session_id, None)
-            if not container_id:
-                continue
-            try:
-                await asyncio.to_thread(self._remove_container, container_id)
-                logger.info("Container destroyed for session %s", session_id)
-            except Exception as exc:
-                logger.error("Failed to destroy container %s: %s", session_id, exc)
+        """Destroy all tracked containers (called on shutdown), several at a time."""
+        containers, self._containers = self._containers, {}
+        limit = asyncio.Semaphore(SESSION_TEARDOWN_CONCURRENCY)
+
+        async def destroy(session_id: str, container_id: str) -> None:
+            async with limit:
+                try:
+                    await asyncio.to_thread(self._remove_container, container_id)
+                    logger.info("Container destroyed for session %s", session_id)
+                except Exception as exc:
+                    logger.error("Failed to destroy container %s: %s", session_id, exc)
+
+        await asyncio.gather(*(destroy(sid, cid) for sid, cid in containers.items()))
+
+    def remove_session_container(self, session_id: str) -> None:
+        """Remove a session's sandbox by its name, if it is on this daemon (blocking)."""
+        self._remove_container(f"{settings.SANDBOX_CONTAINER_PREFIX}{session_id}")
+
+    def _stop_container(self, container_id: str) -> None:
+        self.client.containers.get(container_id).stop(timeout=5)
+
+    def _start_container(self, container_id: str) -> None:
+        self.client.containers.get(container_id).start()
 
     def _remove_container(self, container_id: str) -> None:
         try:
-            container = self.client.containers.get(container_id)
-            container.stop(timeout=5)
-            container.remove(force=True)
+            # force kills right away: PID 1 ("sleep infinity") ignores
+            # SIGTERM, so a graceful stop would always sit out its timeout
+            self.client.containers.get(container_id).remove(force=True)
         except NotFound:
             pass
         except Exception as exc:
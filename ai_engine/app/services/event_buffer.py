@@ -0,0 +1,363 @@
+"""Cross-thread event buffer between the SDK worker thread and the event loop.
+
+``conversation.run`` executes on an ``asyncio.to_thread`` worker, so the
+SDK's ``on_event`` callback fires *off* the event loop.  ``asyncio.Queue``
+is not thread-safe, and polling it with a timeout wastes a wakeup per
+session per second.
+
+``SessionEventBuffer`` keeps the items in a ``deque`` guarded by a
+``threading.Lock`` (safe from any thread) and wakes the single async
+consumer through ``loop.call_soon_threadsafe`` the moment an item lands.
+The consumer sleeps on a plain future with no timeout unless it asks
+for one.
+
+Overflow
+--------
+The in-memory deque is bounded.  When it is full:
+
+1. A ``state`` event replaces the newest queued state event of the same
+   ``eventType`` — only the latest state matters to the UI.
+2. Anything else is handled by the configured policy:
+
+   ``spill``  append to a per-session JSONL file; the consumer loads it
+              back in order once memory drains.  While spilled events are
+              pending, new events go to the file too, preserving order.
+   ``block``  stall the producer thread (never the loop) until there is
+              room, up to ``EVENT_BUFFER_BLOCK_TIMEOUT_SECONDS``, then spill.
+   ``drop``   discard the event.
+
+Every coalesced, spilled and dropped event is counted in ``stats()``.
+
+``EventReplayLog`` numbers agent events per session and keeps the most
+recent ones so a reconnecting client can resume from a ``seq``.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import threading
+from collections import deque
+from typing import Optional
+
+from app.config import (
+    logger,
+    EVENT_BUFFER_BLOCK_TIMEOUT_SECONDS,
+    EVENT_SPILL_READ_CHUNK,
+)
+
+
+class SessionEventBuffer:
+    """Bounded, thread-safe, single-consumer buffer for formatted events.
+
+    Must be constructed while the owning event loop is running.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        *,
+        policy: str = "drop",
+        spill_path: str | None = None,
+    ) -> None:
+        self._maxsize = maxsize
+        self._policy = policy
+        self._items: deque[dict] = deque()
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        # Future the consumer is parked on — only touched on the loop thread
+        self._waiter: Optional[asyncio.Future] = None
+        self._closed = False
+
+        # Spill file state — guarded by _lock
+        self._spill_path = spill_path
+        self._spill_file = None
+        self._spill_read_offset = 0
+        self._spill_written = 0
+        self._spill_read = 0
+
+        self._published = 0
+        self._coalesced = 0
+        self._spilled = 0
+        self._dropped = 0
+
+    # ── Producer side (any thread) ───────────────────────────
+
+    def publish(self, item: dict) -> bool:
+        """Enqueue *item* and wake the consumer.  Safe from any thread.
+
+        Returns ``False`` if the item was lost (buffer closed or dropped).
+        """
+        on_loop = threading.get_ident() == self._loop_thread_id
+        with self._lock:
+            if self._closed:
+                return False
+            self._published += 1
+            accepted = self._enqueue_locked(item, can_block=not on_loop)
+        if accepted:
+            self._wake()
+        return accepted
+
+    def _enqueue_locked(self, item: dict, *, can_block: bool) -> bool:
+        # Keep order: once events are on disk, newer ones must follow them.
+        if self._spill_pending:
+            return self._spill_locked(item)
+
+        if len(self._items) < self._maxsize:
+            self._items.append(item)
+            return True
+
+        if item.get("event") == "state" and self._coalesce_locked(item):
+            return True
+
+        if self._policy == "block" and can_block:
+            self._not_full.wait_for(
+                lambda: self._closed or len(self._items) < self._maxsize,
+                timeout=EVENT_BUFFER_BLOCK_TIMEOUT_SECONDS,
+            )
+            if self._closed:
+                return False
+            if len(self._items) < self._maxsize and not self._spill_pending:
+                self._items.append(item)
+                return True
+
+        if self._policy in ("spill", "block"):
+            return self._spill_locked(item)
+
+        return self._drop_locked()
+
+    def _coalesce_locked(self, item: dict) -> bool:
+        event_type = item.get("eventType")
+        for idx in range(len(self._items) - 1, -1, -1):
+            queued = self._items[idx]
+            if queued.get("event") == "state" and queued.get("eventType") == event_type:
+                self._items[idx] = item
+                self._coalesced += 1
+                return True
+        return False
+
+    def _spill_locked(self, item: dict) -> bool:
+        if not self._spill_path:
+            return self._drop_locked()
+        try:
+            if self._spill_file is None:
+                os.makedirs(os.path.dirname(self._spill_path), exist_ok=True)
+                self._spill_file = open(self._spill_path, "ab")
+            self._spill_file.write(json.dumps(item, default=str).encode("utf-8") + b"\n")
+            self._spill_file.flush()
+        except OSError as exc:
+            logger.error("Event spill failed (%s): %s", self._spill_path, exc)
+            return self._drop_locked()
+        self._spill_written += 1
+        self._spilled += 1
+        return True
+
+    def _drop_locked(self) -> bool:
+        self._dropped += 1
+        if self._dropped == 1 or self._dropped % 100 == 0:
+            logger.warning(
+                "Event buffer full — %d event(s) dropped so far (%s)",
+                self._dropped, self._spill_path or "no spill file",
+            )
+        return False
+
+    def close(self) -> None:
+        """Stop accepting items and release waiters.
+
+        What is already queued — spilled events included — can still be
+        read; ``get`` returns ``None`` once it has all been taken.
+        """
+        with self._lock:
+            self._closed = True
+            self._not_full.notify_all()
+            if self._spill_file is not None:
+                try:
+                    self._spill_file.close()
+                except OSError:
+                    pass
+                self._spill_file = None
+        self._wake()
+
+    def discard(self) -> None:
+        """Close and throw away what is still queued, spill file included."""
+        with self._lock:
+            self._closed = True
+            self._not_full.notify_all()
+            self._items.clear()
+            self._discard_spill_locked()
+        self._wake()
+
+    def _wake(self) -> None:
+        if threading.get_ident() == self._loop_thread_id:
+            self._wake_waiter()
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._wake_waiter)
+        except RuntimeError:
+            pass  # Loop already closed — nobody left to wake
+
+    def _wake_waiter(self) -> None:
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    # ── Spill file ───────────────────────────────────────────
+
+    @property
+    def _spill_pending(self) -> bool:
+        return self._spill_read < self._spill_written
+
+    def _load_spill_chunk(self) -> None:
+        """Move the next spilled events back into memory (worker thread)."""
+        with self._lock:
+            if not self._spill_pending or self._items:
+                return
+            try:
+                with open(self._spill_path, "rb") as f:
+                    f.seek(self._spill_read_offset)
+                    for _ in range(min(EVENT_SPILL_READ_CHUNK, self._maxsize)):
+                        line = f.readline()
+                        if not line:
+                            break
+                        self._items.append(json.loads(line))
+                        self._spill_read += 1
+                    self._spill_read_offset = f.tell()
+            except (OSError, ValueError) as exc:
+                logger.error("Event spill read failed (%s): %s", self._spill_path, exc)
+                self._dropped += self._spill_written - self._spill_read
+                self._spill_read = self._spill_written
+
+            # Fully drained — start the next spill from an empty file
+            if not self._spill_pending:
+                self._discard_spill_locked()
+
+    def _discard_spill_locked(self) -> None:
+        if self._spill_file is not None:
+            try:
+                self._spill_file.close()
+            except OSError:
+                pass
+            self._spill_file = None
+        if self._spill_path and self._spill_written:
+            try:
+                os.remove(self._spill_path)
+            except OSError:
+                pass
+        self._spill_read_offset = 0
+        self._spill_written = 0
+        self._spill_read = 0
+
+    # ── Consumer side (event loop only) ──────────────────────
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def drained(self) -> bool:
+        """Closed, and everything queued has been taken."""
+        with self._lock:
+            return self._closed and not self._items and not self._spill_pending
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def stats(self) -> dict:
+        """Counters for health/metrics endpoints."""
+        with self._lock:
+            return {
+                "queued": len(self._items),
+                "spillPending": self._spill_written - self._spill_read,
+                "published": self._published,
+                "coalesced": self._coalesced,
+                "spilled": self._spilled,
+                "dropped": self._dropped,
+            }
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+    def get_nowait(self) -> Optional[dict]:
+        """Pop the oldest in-memory item, or return ``None`` if there is none."""
+        with self._lock:
+            if self._items:
+                item = self._items.popleft()
+                self._not_full.notify()
+                return item
+        return None
+
+    async def get(self, timeout: float | None = None) -> Optional[dict]:
+        """Wait for the next item, reading spilled events back as needed.
+
+        Returns ``None`` when the buffer is closed and drained, or when
+        *timeout* (seconds) elapses first.  With no timeout the consumer
+        sleeps until a producer wakes it — there is no periodic polling.
+        """
+        while True:
+            item = self.get_nowait()
+            if item is not None:
+                return item
+            if self._spill_pending:
+                await asyncio.to_thread(self._load_spill_chunk)
+                continue
+            if self._closed:
+                return None
+
+            self._waiter = self._loop.create_future()
+            # Re-check after arming the waiter: a producer on another
+            # thread may have appended between get_nowait() and now.
+            if self._items or self._spill_pending or self._closed:
+                self._waiter = None
+                continue
+            try:
+                if timeout is None:
+                    await self._waiter
+                else:
+                    try:
+                        await asyncio.wait_for(self._waiter, timeout)
+                    except asyncio.TimeoutError:
+                        return None
+            finally:
+                self._waiter = None
+
+
+class EventReplayLog:
+    """Per-session sequence numbers plus a ring of the most recent agent events.
+
+    ``stamp()`` runs on whichever thread produced the event (usually the
+    SDK worker), *before* the event enters the ``SessionEventBuffer``, so
+    every agent event has a monotonically increasing ``seq`` and a copy a
+    reconnecting client can be replayed from.
+    """
+
+    def __init__(self, maxlen: int) -> None:
+        self._events: deque[dict] = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+        self._seq = 0
+
+    @property
+    def last_seq(self) -> int:
+        return self._seq
+
+    def stamp(self, event: dict) -> dict:
+        """Assign the next ``seq`` to *event* and remember it."""
+        with self._lock:
+            self._seq += 1
+            event["seq"] = self._seq
+            self._events.append(event)
+        return event
+
+    def since(self, seq: int) -> tuple[list[dict], int]:
+        """Events after *seq*, and the oldest seq still held.
+
+        If the returned oldest seq is greater than ``seq + 1`` the ring has
+        already evicted some of the events the caller missed.
+        """
+        with self._lock:
+            oldest = self._events[0]["seq"] if self._events else self._seq + 1
+            missed = [e for e in self._events if e["seq"] > seq]
+        return missed, oldest
@@ -0,0 +1,246 @@
+"""Per-session pub/sub for formatted events.
+
+Each SDK event is formatted once and published to the session's
+``SessionEventHub``, which numbers agent events through the session's
+``EventReplayLog`` and hands the *same* dict to every subscriber — the
+owning WebSocket, read-only observers, the chat-history persister.
+Subscribers must treat events as read-only.
+
+Every subscription has its own ``SessionEventBuffer``, so overflow is
+handled per subscriber: the persister spills to disk and never loses an
+event, observers drop, and one slow tab never holds back the others
+(only the ``block`` policy stalls the producer, by design).
+
+A subscription also keeps a cursor — the ``seq`` of the last agent event
+it delivered.  Agent events its buffer dropped are re-read from the
+replay ring when the gap shows up, as long as the ring still holds them,
+and a new subscriber can start from any ``seq`` still in the ring.
+"""
+
+from __future__ import annotations
+
+import threading
+import uuid
+from collections import deque
+from typing import Optional
+
+from app.services.event_buffer import EventReplayLog, SessionEventBuffer
+
+
+class Subscription:
+    """One consumer's view of a session's events."""
+
+    def __init__(
+        self,
+        kind: str,
+        buffer: SessionEventBuffer,
+        replay: EventReplayLog,
+        *,
+        subscription_id: str,
+        cursor: int,
+        types: frozenset[str] | None = None,
+    ) -> None:
+        self.subscription_id = subscription_id
+        self.kind = kind
+        # Frame types delivered to this subscriber (None → all)
+        self.types = types
+        # seq of the last agent event handed to the consumer
+        self.cursor = cursor
+        # (first missing seq, oldest seq available) if the replay ring had
+        # already evicted events this subscriber asked for
+        self.gap: tuple[int, int] | None = None
+        self._buffer = buffer
+        self._replay = replay
+        self._backlog: deque[dict] = deque()
+        self._refilled = 0
+
+    @property
+    def closed(self) -> bool:
+        return self._buffer.drained and not self._backlog
+
+    @property
+    def pending(self) -> int:
+        """Events published but not yet taken by the consumer."""
+        return len(self._backlog) + len(self._buffer)
+
+    async def get(self, timeout: float | None = None) -> Optional[dict]:
+        """Next event for this subscriber, in ``seq`` order.
+
+        Same contract as ``SessionEventBuffer.get``: ``None`` on timeout or
+        once the subscription is closed and drained.
+        """
+        while True:
+            if (
+                not self._backlog
+                and self._buffer.dropped
+                and not len(self._buffer)
+                and self._replay.last_seq > self.cursor
+            ):
+                # Drained, yet the ring is ahead: the newest events were dropped
+                self._refill(self._replay.last_seq + 1)
+            if self._backlog:
+                return self._advance(self._backlog.popleft())
+
+            item = await self._buffer.get(timeout)
+            if item is None:
+                return None
+            seq = item.get("seq")
+            if seq is None:
+                return item  # status, file_tree_delta, … — not numbered
+            if seq <= self.cursor:
+                continue  # already delivered from the replay ring
+            if seq > self.cursor + 1:
+                self._refill(seq)
+                if self._backlog:
+                    self._backlog.append(item)
+                    continue
+            return self._advance(item)
+
+    def _refill(self, upto: int) -> None:
+        """Queue the ring's events between the cursor and *upto* (exclusive)."""
+        missed, _ = self._replay.since(self.cursor)
+        missed = [e for e in missed if e["seq"] <= upto]
+        # Only the latest state of each kind matters, as with coalescing
+        latest_state = {e.get("eventType"): e["seq"] for e in missed if e.get("event") == "state"}
+        refill = [
+            e for e in missed
+            if e["seq"] < upto
+            and (e.get("event") != "state" or latest_state[e.get("eventType")] == e["seq"])
+        ]
+        self._backlog.extend(refill)
+        self._refilled += len(refill)
+
+    def _advance(self, item: dict) -> dict:
+        seq = item.get("seq")
+        if seq is not None and seq > self.cursor:
+            self.cursor = seq
+        return item
+
+    def stats(self) -> dict:
+        return {
+            "id": self.subscription_id,
+            "kind": self.kind,
+            "cursor": self.cursor,
+            "refilled": self._refilled,
+            **self._buffer.stats(),
+        }
+
+
+class SessionEventHub:
+    """Fan-out point for one session's events.  ``publish`` is thread-safe."""
+
+    def __init__(
+        self,
+        replay: EventReplayLog,
+        *,
+        maxsize: int,
+        spill_prefix: str | None = None,
+    ) -> None:
+        self.replay = replay
+        self._maxsize = maxsize
+        self._spill_prefix = spill_prefix
+        self._lock = threading.Lock()
+        # Replaced, never mutated, so publishers can iterate it unlocked
+        self._subscribers: tuple[Subscription, ...] = ()
+        self._closed = False
+        self._published = 0
+
+    # ── Producer side (any thread) ───────────────────────────
+
+    def publish(self, item: dict) -> bool:
+        """Number *item* if it is an agent event and deliver it to every subscriber.
+
+        Returns ``True`` if at least one subscriber accepted it.
+        """
+        with self._lock:
+            if self._closed:
+                return False
+            if item.get("type") == "agent_event":
+                self.replay.stamp(item)
+            self._published += 1
+            subscribers = self._subscribers
+
+        # Delivered outside the lock: a ``block`` subscriber may stall this
+        # thread, and loop-side publishers must never wait behind it.
+        # Out-of-order arrival between publishers is fixed up by the cursor.
+        delivered = False
+        item_type = item.get("type")
+        for sub in subscribers:
+            if sub.types is not None and item_type not in sub.types:
+                continue
+            if sub._buffer.publish(item):
+                delivered = True
+        return delivered
+
+    # ── Subscribers (event loop only) ────────────────────────
+
+    def subscribe(
+        self,
+        kind: str,
+        *,
+        policy: str = "drop",
+        after_seq: int | None = None,
+        types: frozenset[str] | None = None,
+    ) -> Subscription:
+        """Add a subscriber with its own buffer and overflow *policy*.
+
+        With ``after_seq`` the agent events after it that are still in the
+        replay ring are delivered first; without it the subscriber starts
+        at the next event.  ``types`` limits delivery to those frame types.
+        """
+        subscription_id = uuid.uuid4().hex[:8]
+        spill_path = None
+        if policy != "drop" and self._spill_prefix:
+            spill_path = f"{self._spill_prefix}-{subscription_id}.jsonl"
+        buffer = SessionEventBuffer(self._maxsize, policy=policy, spill_path=spill_path)
+
+        with self._lock:
+            if after_seq is None:
+                cursor, backlog, oldest = self.replay.last_seq, [], None
+            else:
+                cursor = max(0, after_seq)
+                backlog, oldest = self.replay.since(cursor)
+            sub = Subscription(
+                kind, buffer, self.replay,
+                subscription_id=subscription_id, cursor=cursor, types=types,
+            )
+            sub._backlog.extend(backlog)
+            if oldest is not None and oldest > cursor + 1:
+                sub.gap = (cursor + 1, oldest)
+            if self._closed:
+                buffer.close()
+            else:
+                self._subscribers += (sub,)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self._lock:
+            self._subscribers = tuple(s for s in self._subscribers if s is not sub)
+        sub._buffer.discard()
+
+    def subscribers(self, kind: str | None = None) -> list[Subscription]:
+        return [s for s in self._subscribers if kind is None or s.kind == kind]
+
+    def close(self) -> None:
+        """Stop publishing.
+
+        Subscribers drain what they hold, spilled events included, then see
+        ``None``.
+        """
+        with self._lock:
+            self._closed = True
+            subscribers, self._subscribers = self._subscribers, ()
+        for sub in subscribers:
+            sub._buffer.close()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def stats(self) -> dict:
+        """Counters for health/metrics endpoints."""
+        return {
+            "published": self._published,
+            "lastSeq": self.replay.last_seq,
+            "subscribers": [s.stats() for s in self._subscribers],
+        }
@@ -0,0 +1,294 @@
+"""Workspace file-tree snapshots, deltas and refresh scheduling.
+
+``FileTreeSnapshot`` keeps a flat ``{"/rel/path": entry}`` index of a
+session workspace.  A rescan diffs the new index against the previous one
+so the WebSocket can send a small ``file_tree_delta`` instead of the whole
+tree; the nested tree for a full refresh is rebuilt from the index without
+touching the disk again.
+
+``FileTreeRefreshScheduler`` is the single entry point for refreshes: the
+workspace watcher and the command heuristic both call ``request()``, and
+the scheduler coalesces bursts into one off-loop refresh at a time.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import os
+import stat
+import threading
+from datetime import datetime, timezone
+from typing import Callable, Iterable, NamedTuple, Optional
+
+from app.config import logger
+
+
+# ── Exclude patterns for file listing ────────────────────────
+
+EXCLUDE_DIRS = {
+    ".git", "node_modules", "__pycache__", ".next",
+    ".venv", "venv", ".mypy_cache", ".pytest_cache",
+    "dist", "build", ".tox", ".eggs",
+}
+
+
+def is_excluded_dir(name: str) -> bool:
+    """Directories that are never shown (or descended into) in the tree."""
+    return name in EXCLUDE_DIRS or name.startswith(".")
+
+
+class TreeEntry(NamedTuple):
+    type: str           # "file" | "folder"
+    size: int
+    mtime_ns: int
+
+
+def scan_workspace(root_dir: str, rel_prefix: str = "") -> dict[str, TreeEntry]:
+    """Walk *root_dir* once and return the flat index.
+
+    Keys are ``rel_prefix`` + the path relative to *root_dir*, so a
+    sub-directory can be scanned straight into a parent's index.
+    """
+    index: dict[str, TreeEntry] = {}
+
+    def walk_dir(dir_path: str, rel_prefix: str) -> None:
+        try:
+            entries = list(os.scandir(dir_path))
+        except (PermissionError, FileNotFoundError, NotADirectoryError):
+            return
+
+        for entry in entries:
+            rel_path = f"{rel_prefix}/{entry.name}"
+            try:
+                if entry.is_dir():
+                    if is_excluded_dir(entry.name):
+                        continue
+                    index[rel_path] = TreeEntry("folder", 0, 0)
+                    walk_dir(entry.path, rel_path)
+                else:
+                    st = entry.stat()
+                    index[rel_path] = TreeEntry("file", st.st_size, st.st_mtime_ns)
+            except OSError:
+                continue  # Vanished mid-walk
+
+    walk_dir(root_dir, rel_prefix)
+    return index
+
+
+def tree_from_index(index: dict[str, TreeEntry]) -> list[dict]:
+    """Rebuild the nested ``[{name, type, path, children}]`` tree from an index."""
+    root: list[dict] = []
+    folders: dict[str, list[dict]] = {"": root}
+
+    # Sorted paths guarantee a parent folder is created before its children
+    for path in sorted(index):
+        entry = index[path]
+        parent, _, name = path.rpartition("/")
+        siblings = folders.get(parent)
+        if siblings is None:
+            continue  # Parent excluded or missing
+        node: dict = {"name": name, "type": entry.type, "path": path}
+        if entry.type == "folder":
+            node["children"] = folders[path] = []
+        siblings.append(node)
+
+    for children in folders.values():
+        children.sort(key=lambda n: n["name"])
+    return root
+
+
+def diff_indexes(
+    old: dict[str, TreeEntry],
+    new: dict[str, TreeEntry],
+) -> dict[str, list]:
+    """Compute the ``added`` / ``removed`` / ``changed`` delta between indexes."""
+    added = [
+        {"path": p, "type": e.type}
+        for p, e in new.items() if p not in old
+    ]
+    removed = [p for p in old if p not in new]
+    changed = [
+        {"path": p, "type": e.type}
+        for p, e in new.items()
+        if p in old and old[p] != e
+    ]
+    added.sort(key=lambda d: d["path"])
+    removed.sort()
+    changed.sort(key=lambda d: d["path"])
+    return {"added": added, "removed": removed, "changed": changed}
+
+
+class FileTreeSnapshot:
+    """Last-known file tree of one session workspace.
+
+    Safe to update from worker threads; all index access holds ``_lock``.
+    ``watched`` is set while a ``WorkspaceWatcher`` keeps the index current,
+    in which case readers can trust ``tree()`` without walking the disk.
+    """
+
+    def __init__(self, root_dir: str) -> None:
+        self.root_dir = root_dir
+        self.watched = False
+        self._index: dict[str, TreeEntry] = {}
+        self._lock = threading.Lock()
+
+    def tree(self) -> list[dict]:
+        """Nested tree of the current snapshot (no disk access)."""
+        with self._lock:
+            return tree_from_index(self._index)
+
+    def reset(self) -> list[dict]:
+        """Rescan from scratch and return the full tree (session bring-up)."""
+        new_index = scan_workspace(self.root_dir)
+        with self._lock:
+            self._index = new_index
+            return tree_from_index(new_index)
+
+    def rescan(self) -> dict[str, list]:
+        """Rescan and return what changed since the previous snapshot."""
+        new_index = scan_workspace(self.root_dir)
+        with self._lock:
+            delta = diff_indexes(self._index, new_index)
+            self._index = new_index
+        return delta
+
+    def apply_changes(self, rel_paths: Iterable[str]) -> dict[str, list]:
+        """Update only *rel_paths* (``/a/b.py`` form) and return the delta.
+
+        Used with exact paths from the filesystem watcher: each path is
+        stat-ed once; a new directory is scanned, a vanished one drops its
+        whole subtree.
+        """
+        with self._lock:
+            old_sub: dict[str, TreeEntry] = {}
+            new_sub: dict[str, TreeEntry] = {}
+
+            for rel in sorted(set(rel_paths)):
+                parent_parts = rel.strip("/").split("/")[:-1]
+                if any(is_excluded_dir(part) for part in parent_parts):
+                    continue
+
+                previous = self._index.get(rel)
+                if previous is not None:
+                    old_sub[rel] = previous
+
+                full_path = os.path.join(self.root_dir, rel.lstrip("/"))
+                try:
+                    st = os.stat(full_path)
+                except OSError:
+                    st = None
+
+                is_dir = st is not None and stat.S_ISDIR(st.st_mode)
+                if previous is not None and previous.type == "folder" and not is_dir:
+                    # Folder removed (or replaced by a file) — drop its subtree
+                    prefix = rel + "/"
+                    old_sub.update(
+                        (p, e) for p, e in self._index.items() if p.startswith(prefix)
+                    )
+
+                if st is None:
+                    continue
+                # A path can be reported before its freshly created parents
+                parent = rel.rpartition("/")[0]
+                while parent and parent not in self._index and parent not in new_sub:
+                    new_sub[parent] = TreeEntry("folder", 0, 0)
+                    parent = parent.rpartition("/")[0]
+                if is_dir:
+                    if is_excluded_dir(os.path.basename(rel)):
+                        continue
+                    new_sub[rel] = TreeEntry("folder", 0, 0)
+                    if previous is None or previous.type != "folder":
+                        new_sub.update(scan_workspace(full_path, rel))
+                else:
+                    new_sub[rel] = TreeEntry("file", st.st_size, st.st_mtime_ns)
+
+            for p in old_sub:
+                self._index.pop(p, None)
+            self._index.update(new_sub)
+
+        return diff_indexes(old_sub, new_sub)
+
+
+def delta_is_empty(delta: dict[str, list]) -> bool:
+    return not (delta["added"] or delta["removed"] or delta["changed"])
+
+
+def delta_message(delta: dict[str, list]) -> dict:
+    """Wrap a delta as a ``file_tree_delta`` WebSocket message."""
+    return {
+        "type": "file_tree_delta",
+        **delta,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+# ── Refresh scheduling ──────────────────────────────────────
+
+class FileTreeRefreshScheduler:
+    """Coalesce file-tree refresh requests for one session.
+
+    ``request()`` is cheap and may be called for every event: requests that
+    arrive within ``window`` seconds are merged, at most one refresh runs at
+    a time (on a worker thread, so event delivery never waits on the walk),
+    and requests landing mid-refresh are folded into the next one.  Exact
+    paths are applied incrementally; a request without paths forces a full
+    rescan.  Must be used from the event loop.
+    """
+
+    def __init__(
+        self,
+        snapshot: FileTreeSnapshot,
+        publish: Callable[[dict], object],
+        *,
+        window: float,
+    ) -> None:
+        self._snapshot = snapshot
+        self._publish = publish
+        self._window = window
+        self._paths: set[str] = set()
+        self._full = False
+        self._task: Optional[asyncio.Task] = None
+        self.requested = 0
+        self.performed = 0
+
+    def request(self, paths: Iterable[str] | None = None) -> None:
+        """Ask for a refresh of *paths*, or of the whole tree if ``None``."""
+        self.requested += 1
+        if paths is None:
+            self._full = True
+        else:
+            self._paths.update(paths)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {"requested": self.requested, "performed": self.performed}
+
+    async def _run(self) -> None:
+        while self._full or self._paths:
+            await asyncio.sleep(self._window)
+            full, paths = self._full, self._paths
+            self._full, self._paths = False, set()
+
+            if full:
+                refresh = self._snapshot.rescan
+            else:
+                refresh = functools.partial(self._snapshot.apply_changes, paths)
+            try:
+                delta = await asyncio.to_thread(refresh)
+            except Exception as exc:
+                logger.warning("File tree refresh failed: %s", exc)
+                continue
+            self.performed += 1
+            if not delta_is_empty(delta):
+                self._publish(delta_message(delta))
@@ -12,6 +12,7 @@ from __future__ import annotations
 import hashlib
 import os
 from typing import Optional
+from urllib.parse import urlsplit
 
 import httpx
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
@@ -163,6 +164,34 @@ async def get_integration(
     }
 
 
+async def token_for_repo(
+    *,
+    user_id: str,
+    repo_url: str,
+    user_jwt: str | None,
+) -> Optional[str]:
+    """Stored token of the integration *repo_url* belongs to, if any.
+
+    github.com uses the GitHub integration; any other host the GitLab one
+    when it is the host of its ``gitlabUrl``.
+    """
+    host = (urlsplit(repo_url).hostname or "").lower()
+    if not host:
+        return None
+    try:
+        if host in ("github.com", "www.github.com"):
+            integration = await get_integration(user_id=user_id, provider="GITHUB", user_jwt=user_jwt)
+        else:
+            integration = await get_integration(user_id=user_id, provider="GITLAB", user_jwt=user_jwt)
+            if integration and (urlsplit(integration["gitlabUrl"]).hostname or "").lower() != host:
+                integration = None
+    except (HTTPException, ValueError) as exc:
+        # Public repositories still clone without one
+        logger.warning("Could not load the integration token for %s: %s", host, exc)
+        return None
+    return integration["token"] if integration else None
+
+
 async def delete_integration(
     *,
     user_id: str,
@@ -21,9 +21,12 @@ from app.sdk import LLM
 from app.exceptions import ProviderError, APIKeyMissingError
 
 
-def resolve_llm(provider: str, user_api_key: str | None = None):
+def resolve_llm(provider: str, user_api_key: str | None = None, *, stream: bool = False):
     """Return a configured ``LLM`` instance for *provider*.
 
+    With ``stream`` the LLM streams completions, so the conversation's
+    token callbacks receive partial output.
+
     Raises:
         ProviderError: if *provider* is not in ``MODEL_CONFIGS``.
         APIKeyMissingError: if no key can be found.
@@ -58,6 +61,9 @@ def resolve_llm(provider: str, user_api_key: str | None = None):
     if settings.LLM_BASE_URL:
         llm_kwargs["base_url"] = settings.LLM_BASE_URL
 
+    if stream:
+        llm_kwargs["stream"] = True
+
     if provider == "google":
         llm_kwargs["safety_settings"] = GEMINI_SAFETY_SETTINGS
         logger.info("Using Gemini (%s) with safety_settings=BLOCK_NONE", model_name)
@@ -0,0 +1,273 @@
+"""Idle-session reaper and per-node capacity budget.
+
+Every ``AgentSession`` records when it was last active (an event
+published, a client message, a WebSocket attaching).  ``SessionReaper``
+runs in the background and:
+
+- hibernates sessions idle for ``SESSION_HIBERNATE_AFTER_SECONDS``
+  (conversation released, sandbox stopped — see ``hibernate_session``);
+- destroys sessions idle for longer than ``CONVERSATION_TIMEOUT`` —
+  including sessions created over REST that never got a WebSocket;
+- keeps the node within ``MAX_SESSIONS_PER_NODE``,
+  ``MAX_CONTAINERS_PER_NODE`` and ``NODE_MEMORY_BUDGET_MB``, handling
+  the least recently used sessions first.  Running containers and memory
+  are freed by hibernating; only the session cap forces destroying.
+
+``make_room`` applies the same budget before a session is created, so a
+full node evicts its stalest session instead of overcommitting.  A
+session in the middle of an agent run is never evicted; if only busy
+sessions are left, creation fails with ``NodeCapacityError``.  The room
+it makes stays reserved until the session is in the store (or its
+bring-up failed — ``release_room``), and concurrent creations take
+their turn, so two bring-ups can't both claim the last slot.
+
+Attached clients get an ``expired`` status before the session goes.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import re
+import time
+from typing import Optional
+
+from app.config import (
+    logger,
+    settings,
+    SESSION_REAPER_INTERVAL_SECONDS,
+    SESSION_HOST_MEMORY_ESTIMATE_MB,
+)
+from app.exceptions import NodeCapacityError
+from app.services.chat import ChatService
+from app.services.sessions import AgentSession, destroy_session, hibernate_session, store
+
+_MEMORY_UNITS = {"": 1, "b": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+
+def _parse_memory(value: str) -> int:
+    """Bytes in a Docker-style memory limit such as ``"2g"`` or ``"512m"``."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([bkmg]?)b?\s*", str(value).lower())
+    if not match:
+        return 0
+    return int(float(match.group(1)) * _MEMORY_UNITS[match.group(2)])
+
+
+def _memory_estimate(container: bool) -> int:
+    if container:
+        return _parse_memory(settings.SANDBOX_MEMORY_LIMIT)
+    return SESSION_HOST_MEMORY_ESTIMATE_MB * 1024 * 1024
+
+
+def _runs_container(session: AgentSession) -> bool:
+    return bool(session.container_id) and not session.hibernated
+
+
+def estimated_memory(session: AgentSession) -> int:
+    """Rough bytes held by *session*: its sandbox limit, or the host-side estimate."""
+    return _memory_estimate(_runs_container(session))
+
+
+class SessionReaper:
+    """Background task that expires idle sessions and enforces the node budget."""
+
+    def __init__(
+        self,
+        *,
+        idle_timeout: float,
+        hibernate_after: float,
+        interval: float,
+        max_sessions: int,
+        max_containers: int,
+        memory_budget: int,
+    ) -> None:
+        self.idle_timeout = idle_timeout
+        self.hibernate_after = hibernate_after   # 0 → never hibernate
+        self.interval = interval
+        # 0 disables a cap
+        self.max_sessions = max_sessions
+        self.max_containers = max_containers
+        self.memory_budget = memory_budget
+        self._task: Optional[asyncio.Task] = None
+        # Sessions being brought up → whether they will run a container
+        self._reserved: dict[str, bool] = {}
+        self._room_lock = asyncio.Lock()
+
+        self.reaped_idle = 0
+        self.hibernated = 0
+        self.evicted = 0
+        self.rejected = 0
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception as exc:
+                logger.error("Session reaper sweep failed: %s", exc, exc_info=True)
+
+    # ── Policy ───────────────────────────────────────────────
+
+    async def sweep(self) -> None:
+        """Reap or hibernate idle sessions, then free LRU sessions while over budget."""
+        now = time.monotonic()
+        for session in store.list_all():
+            if _is_busy(session):
+                continue
+            idle = now - session.last_active
+            if idle > self.idle_timeout:
+                self.reaped_idle += 1
+                await self._evict(session, "idle for too long")
+            elif self.hibernate_after and idle > self.hibernate_after:
+                if await hibernate_session(session):
+                    self.hibernated += 1
+
+        await self._free(self._over_budget() or [])
+
+    async def make_room(self, session_id: str, *, container: bool) -> None:
+        """Hibernate or evict LRU sessions so *session_id* fits the budget, and reserve its room.
+
+        Raises ``NodeCapacityError`` if only busy sessions could be freed.
+        The caller must ``release_room`` once the session is in the store
+        or its bring-up failed.
+        """
+        async with self._room_lock:
+            victims = self._over_budget(new_session=True, new_container=container)
+            if victims is None:
+                self.rejected += 1
+                raise NodeCapacityError("This node is at capacity. Try again later.")
+            await self._free(victims)
+            self._reserved[session_id] = container
+
+    def release_room(self, session_id: str) -> None:
+        self._reserved.pop(session_id, None)
+
+    async def _free(self, victims: list[tuple[AgentSession, bool]]) -> None:
+        for session, destroy in victims:
+            if _is_busy(session):
+                continue  # A run started meanwhile
+            if not destroy and await hibernate_session(session):
+                self.hibernated += 1
+            else:
+                self.evicted += 1
+                await self._evict(session, "node capacity reached")
+
+    def _over_budget(
+        self,
+        *,
+        new_session: bool = False,
+        new_container: bool = False,
+    ) -> Optional[list[tuple[AgentSession, bool]]]:
+        """LRU non-busy sessions to free so the node (plus a new session) fits.
+
+        Each comes with ``True`` if it must be destroyed (session cap) or
+        ``False`` if hibernating it is enough.  ``None`` if freeing all of
+        them would not be enough.
+        """
+        sessions = store.list_all()
+        count = len(sessions)
+        containers = sum(1 for s in sessions if _runs_container(s))
+        memory = sum(estimated_memory(s) for s in sessions)
+        for session_id, container in self._reserved.items():
+            if store.get_or_none(session_id) is None:   # Not counted above yet
+                count += 1
+                containers += 1 if container else 0
+                memory += _memory_estimate(container)
+        if new_session:
+            count += 1
+            containers += 1 if new_container else 0
+            memory += _memory_estimate(new_container)
+
+        def fits() -> bool:
+            return (
+                (not self.max_sessions or count <= self.max_sessions)
+                and (not self.max_containers or containers <= self.max_containers)
+                and (not self.memory_budget or memory <= self.memory_budget)
+            )
+
+        victims: list[tuple[AgentSession, bool]] = []
+        candidates = sorted(
+            (s for s in sessions if not _is_busy(s)),
+            key=lambda s: s.last_active,
+        )
+        for session in candidates:
+            if fits():
+                break
+            destroy = bool(self.max_sessions) and count > self.max_sessions
+            if not destroy and not _runs_container(session):
+                # Hibernating frees its sandbox only — without one it gains
+                # nothing and throws away the SDK state
+                continue
+            if not destroy and session.conversation is None:
+                # Nothing left to hibernate — only destroying frees more
+                destroy = True
+            victims.append((session, destroy))
+            if destroy:
+                count -= 1
+                memory -= estimated_memory(session)
+            else:
+                memory -= estimated_memory(session) - _memory_estimate(False)
+            containers -= 1 if _runs_container(session) else 0
+        return victims if fits() else None
+
+    async def _evict(self, session: AgentSession, reason: str) -> None:
+        if not session.is_alive or store.get_or_none(session.session_id) is not session:
+            return
+        logger.info("Reaping session %s — %s", session.session_id, reason)
+        session.publish({
+            "type": "status",
+            "status": "expired",
+            "sessionId": session.session_id,
+            "message": f"Session closed: {reason}.",
+        })
+        await destroy_session(session.session_id)
+
+        if session.chat_session_id:
+            try:
+                await ChatService.deactivate_session(
+                    session.chat_session_id, user_id=session.user_id, user_jwt=session.user_jwt,
+                )
+            except Exception as exc:
+                logger.warning("Failed to mark chat session inactive: %s", exc)
+
+    def stats(self) -> dict:
+        """Counters for health/metrics endpoints."""
+        sessions = store.list_all()
+        return {
+            "reapedIdle": self.reaped_idle,
+            "hibernatedTotal": self.hibernated,
+            "evicted": self.evicted,
+            "rejected": self.rejected,
+            "reserved": len(self._reserved),
+            "hibernatedNow": sum(1 for s in sessions if s.hibernated),
+            "containers": sum(1 for s in sessions if _runs_container(s)),
+            "estimatedMemoryMb": sum(estimated_memory(s) for s in sessions) // (1024 * 1024),
+        }
+
+
+def _is_busy(session: AgentSession) -> bool:
+    """An agent run is in progress — never evicted."""
+    return session.run_lock.locked()
+
+
+# Module-level singleton — started and closed by the app lifespan
+session_reaper = SessionReaper(
+    idle_timeout=settings.CONVERSATION_TIMEOUT,
+    hibernate_after=settings.SESSION_HIBERNATE_AFTER_SECONDS,
+    interval=SESSION_REAPER_INTERVAL_SECONDS,
+    max_sessions=settings.MAX_SESSIONS_PER_NODE,
+    max_containers=settings.MAX_CONTAINERS_PER_NODE,
+    memory_budget=settings.NODE_MEMORY_BUDGET_MB * 1024 * 1024,
+)
@@ -0,0 +1,297 @@
+"""Shared registry of which worker owns which session.
+
+A session's SDK objects, threads and event hub live in the worker process
+that created it and cannot move.  When the engine runs several workers
+(``ENGINE_WORKERS``) or nodes, each records its live sessions here so any
+worker can tell where a session lives and forward requests for it — see
+``app.services.routing``.
+
+Backends, chosen by ``SESSION_REGISTRY_URL``:
+
+- ``""`` — ``LocalSessionRegistry``: plain dicts, one process only.
+- ``sqlite:///<path>`` — ``SqliteSessionRegistry``: one SQLite file
+  shared by the workers of one host.  It must be on a local filesystem:
+  SQLite's locking is not reliable over NFS and similar network mounts,
+  so it cannot coordinate several nodes.
+
+Workers refresh a heartbeat; sessions of a worker whose heartbeat is older
+than ``WORKER_STALE_AFTER_SECONDS`` count as gone.  Backend methods are
+blocking where ``blocking`` is ``True`` and are then called through
+``asyncio.to_thread``.
+"""
+
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, NamedTuple, Optional
+
+from app.config import logger
+
+
+class SessionOwner(NamedTuple):
+    """Where a live session runs."""
+
+    session_id: str
+    user_id: str
+    worker_id: str
+    worker_url: str
+    task: str
+    created_at: str
+
+
+class SessionRegistry:
+    """Interface of the registry backends."""
+
+    # Methods do blocking I/O — call them off the event loop
+    blocking = False
+
+    def register_worker(self, worker_id: str, url: str) -> None:
+        raise NotImplementedError
+
+    def heartbeat(self, worker_id: str) -> bool:
+        """Refresh *worker_id*; ``False`` if it was dropped as stale meanwhile."""
+        raise NotImplementedError
+
+    def remove_worker(self, worker_id: str) -> None:
+        """Drop a worker and every session it owned."""
+        raise NotImplementedError
+
+    def reap_stale(self, stale_before: float) -> list[tuple[str, str]]:
+        """Remove workers silent since *stale_before*; returns their ``(session_id, worker_id)``s."""
+        raise NotImplementedError
+
+    def claim(
+        self,
+        session_id: str,
+        user_id: str,
+        worker_id: str,
+        *,
+        task: str,
+        created_at: str,
+    ) -> None:
+        raise NotImplementedError
+
+    def release(self, session_id: str) -> None:
+        raise NotImplementedError
+
+    def lookup(self, session_id: str, *, live_after: float) -> Optional[SessionOwner]:
+        """Owner of *session_id*, or ``None`` if unknown or its worker is stale."""
+        raise NotImplementedError
+
+    def list_for_user(self, user_id: str, *, live_after: float) -> list[SessionOwner]:
+        raise NotImplementedError
+
+    def live_session_ids(self, *, live_after: float) -> set[str]:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class LocalSessionRegistry(SessionRegistry):
+    """In-process registry — every session is this worker's own."""
+
+    def __init__(self) -> None:
+        self._workers: dict[str, tuple[str, float]] = {}   # worker_id → (url, heartbeat)
+        self._sessions: dict[str, tuple[str, str, str, str]] = {}   # → (user, worker, task, created)
+
+    def register_worker(self, worker_id: str, url: str) -> None:
+        self._workers[worker_id] = (url, time.time())
+
+    def heartbeat(self, worker_id: str) -> bool:
+        if worker_id not in self._workers:
+            return False
+        self._workers[worker_id] = (self._workers[worker_id][0], time.time())
+        return True
+
+    def remove_worker(self, worker_id: str) -> None:
+        self._workers.pop(worker_id, None)
+        for session_id, record in list(self._sessions.items()):
+            if record[1] == worker_id:
+                del self._sessions[session_id]
+
+    def reap_stale(self, stale_before: float) -> list[tuple[str, str]]:
+        return []   # The only worker is this one
+
+    def claim(self, session_id, user_id, worker_id, *, task, created_at) -> None:
+        self._sessions[session_id] = (user_id, worker_id, task, created_at)
+
+    def release(self, session_id: str) -> None:
+        self._sessions.pop(session_id, None)
+
+    def lookup(self, session_id: str, *, live_after: float) -> Optional[SessionOwner]:
+        record = self._sessions.get(session_id)
+        if record is None:
+            return None
+        return self._owner(session_id, record, live_after)
+
+    def list_for_user(self, user_id: str, *, live_after: float) -> list[SessionOwner]:
+        owners = (
+            self._owner(session_id, record, live_after)
+            for session_id, record in self._sessions.items()
+            if record[0] == user_id
+        )
+        return [owner for owner in owners if owner is not None]
+
+    def live_session_ids(self, *, live_after: float) -> set[str]:
+        return {
+            session_id for session_id, record in self._sessions.items()
+            if self._owner(session_id, record, live_after) is not None
+        }
+
+    def _owner(self, session_id: str, record: tuple, live_after: float) -> Optional[SessionOwner]:
+        user_id, worker_id, task, created_at = record
+        worker = self._workers.get(worker_id)
+        if worker is None or worker[1] < live_after:
+            return None
+        return SessionOwner(session_id, user_id, worker_id, worker[0], task, created_at)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS workers (
+    worker_id  TEXT PRIMARY KEY,
+    url        TEXT NOT NULL,
+    heartbeat  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    user_id    TEXT NOT NULL,
+    worker_id  TEXT NOT NULL,
+    task       TEXT NOT NULL DEFAULT '',
+    created_at TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS sessions_by_user ON sessions (user_id);
+CREATE INDEX IF NOT EXISTS sessions_by_worker ON sessions (worker_id);
+"""
+
+_OWNER_QUERY = """
+SELECT s.session_id, s.user_id, s.worker_id, w.url, s.task, s.created_at
+FROM sessions s JOIN workers w ON w.worker_id = s.worker_id
+WHERE w.heartbeat >= ?
+"""
+
+
+class SqliteSessionRegistry(SessionRegistry):
+    """Registry in a SQLite file shared by the workers that open it.
+
+    WAL journaling lets readers proceed during a write; writers from
+    other processes wait up to the busy timeout.  One connection per
+    process, serialised by a lock.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=10.0, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+
+    def register_worker(self, worker_id: str, url: str) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO workers (worker_id, url, heartbeat) VALUES (?, ?, ?)",
+                (worker_id, url, time.time()),
+            )
+
+    def heartbeat(self, worker_id: str) -> bool:
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE workers SET heartbeat = ? WHERE worker_id = ?", (time.time(), worker_id),
+            )
+        return cursor.rowcount > 0
+
+    def remove_worker(self, worker_id: str) -> None:
+        with self._transaction():
+            self._db.execute("DELETE FROM sessions WHERE worker_id = ?", (worker_id,))
+            self._db.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+
+    def reap_stale(self, stale_before: float) -> list[tuple[str, str]]:
+        with self._transaction():
+            stale = [
+                row[0] for row in self._db.execute(
+                    "SELECT worker_id FROM workers WHERE heartbeat < ?", (stale_before,),
+                )
+            ]
+            if not stale:
+                return []
+            marks = ",".join("?" * len(stale))
+            sessions = [
+                (row[0], row[1]) for row in self._db.execute(
+                    f"SELECT session_id, worker_id FROM sessions WHERE worker_id IN ({marks})", stale,
+                )
+            ]
+            self._db.execute(f"DELETE FROM sessions WHERE worker_id IN ({marks})", stale)
+            self._db.execute(f"DELETE FROM workers WHERE worker_id IN ({marks})", stale)
+        logger.warning(
+            "Registry: dropped %d stale worker(s) and their %d session(s)",
+            len(stale), len(sessions),
+        )
+        return sessions
+
+    def claim(self, session_id, user_id, worker_id, *, task, created_at) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, user_id, worker_id, task, created_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (session_id, user_id, worker_id, task, created_at),
+            )
+
+    def release(self, session_id: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def lookup(self, session_id: str, *, live_after: float) -> Optional[SessionOwner]:
+        with self._lock:
+            row = self._db.execute(
+                _OWNER_QUERY + " AND s.session_id = ?", (live_after, session_id),
+            ).fetchone()
+        return SessionOwner(*row) if row else None
+
+    def list_for_user(self, user_id: str, *, live_after: float) -> list[SessionOwner]:
+        with self._lock:
+            rows = self._db.execute(
+                _OWNER_QUERY + " AND s.user_id = ? ORDER BY s.created_at", (live_after, user_id),
+            ).fetchall()
+        return [SessionOwner(*row) for row in rows]
+
+    def live_session_ids(self, *, live_after: float) -> set[str]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT s.session_id FROM sessions s JOIN workers w ON w.worker_id = s.worker_id"
+                " WHERE w.heartbeat >= ?",
+                (live_after,),
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+
+def create_registry(url: str) -> SessionRegistry:
+    """Backend for a ``SESSION_REGISTRY_URL``."""
+    if not url:
+        return LocalSessionRegistry()
+    if url.startswith("sqlite:///"):
+        return SqliteSessionRegistry(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported SESSION_REGISTRY_URL: {url!r} (expected '' or 'sqlite:///<path>')")
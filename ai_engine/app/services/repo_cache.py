@@ -0,0 +1,376 @@
+"""Engine-side cache of bare repository mirrors for workspace provisioning.
+
+A session started with a ``repoUrl`` gets the repository checked out in
+its workspace before the agent starts.  Cloning from the remote every
+time is the slowest part of session start for large repositories, so the
+engine keeps one bare mirror (branches and tags) per repository under
+``REPO_CACHE_DIR``:
+
+- the first session for a repository clones the mirror; later ones only
+  fetch what changed, at most every ``REPO_CACHE_FETCH_INTERVAL_SECONDS``;
+- the mirror is shared by everyone who starts a session on the repository,
+  so every checkout first proves the caller can read it with their own
+  credentials: the clone or fetch itself, else ``git ls-remote``.  Nobody
+  gets a private repository from the cache that the remote would refuse
+  them, and a mirror whose fetch failed is only used once that check passed;
+- the workspace is a local clone of the mirror: its objects are copied
+  from disk rather than downloaded.  They are copied, not hardlinked —
+  the workspace is mounted read-write into the sandbox, and an agent
+  rewriting a hardlinked object would corrupt the mirror for everyone.
+  Unlike ``--reference`` / alternates, the workspace has no pointer back
+  to the cache: it works inside the sandbox, where only the workspace is
+  mounted, and survives the mirror being evicted;
+- mirrors beyond ``REPO_CACHE_BUDGET_MB`` are removed, least recently
+  used first.
+
+Credentials never touch the mirror: the token is passed to each git
+command as an ``Authorization`` header through the environment (not the
+command line).  The workspace keeps it in its own git config so the agent
+can push.  Mirrors are locked with ``flock``, so every worker of a host
+can share the cache.  All methods are blocking.
+"""
+
+from __future__ import annotations
+
+import base64
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Iterator, Optional
+from urllib.parse import urlsplit
+
+from app.config import (
+    logger,
+    settings,
+    REPO_CACHE_DIR,
+    REPO_CACHE_FETCH_INTERVAL_SECONDS,
+    GIT_COMMAND_TIMEOUT_SECONDS,
+)
+from app.exceptions import RepoProvisionError
+
+
+# Branches and tags only — not pull-request refs and the like
+_MIRROR_REFSPECS = ("+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*")
+
+
+class RepoCache:
+    """Bare mirrors under *root*, evicted LRU beyond *max_bytes* (0 = no limit)."""
+
+    def __init__(self, root: str, *, max_bytes: int, fetch_interval: float) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.fetch_interval = fetch_interval
+        # Size of the mirrors as of the last eviction pass
+        self._bytes = 0
+        self._mirrors = 0
+
+        self.clones = 0
+        self.fetches = 0
+        self.hits = 0
+        self.stale = 0
+        self.denied = 0
+        self.evictions = 0
+
+    def provision(
+        self,
+        repo_url: str,
+        dest: str,
+        *,
+        token: Optional[str] = None,
+        branch: Optional[str] = None,
+        user_name: Optional[str] = None,
+        user_email: Optional[str] = None,
+    ) -> None:
+        """Check *repo_url* out into the empty directory *dest*.
+
+        Checks out *branch* if the repository has it, else creates it from
+        the default branch.  Raises ``RepoProvisionError``.
+        """
+        remote, key = _parse_repo_url(repo_url)
+        if branch:
+            _git(["check-ref-format", "--branch", branch])
+        env = _git_env(remote, token)
+        mirror = os.path.join(self.root, f"{key}.git")
+        os.makedirs(self.root, exist_ok=True)
+
+        with self._locked(key, fcntl.LOCK_EX):
+            authorized = self._update(key, mirror, remote, env)
+        if not authorized:
+            self._check_access(remote, env)
+        # Shared: other sessions may clone at the same time, eviction may not
+        with self._locked(key, fcntl.LOCK_SH):
+            self._checkout(mirror, remote, dest, env, branch)
+        _configure_workspace(dest, remote, token, user_name, user_email)
+        self._evict(keep=key)
+
+    def stats(self) -> dict:
+        """Counters for health/metrics endpoints."""
+        return {
+            "mirrors": self._mirrors,
+            "bytes": self._bytes,
+            "budgetBytes": self.max_bytes,
+            "clones": self.clones,
+            "fetches": self.fetches,
+            "hits": self.hits,
+            "stale": self.stale,
+            "denied": self.denied,
+            "evictions": self.evictions,
+        }
+
+    # ── Mirrors ──────────────────────────────────────────────
+
+    def _update(self, key: str, mirror: str, remote: str, env: dict) -> bool:
+        """Clone the mirror, or fetch into it if it is older than the fetch interval.
+
+        Returns whether the remote served the caller (*env*'s credentials)
+        along the way — if not, their access still has to be checked.
+        """
+        authorized = False
+        meta = self._read_meta(key)
+        now = time.time()
+        if not os.path.isdir(mirror):
+            tmp = f"{mirror}.tmp-{uuid.uuid4().hex[:8]}"
+            try:
+                _git(["clone", "--bare", "--quiet", "--", remote, tmp], env=env)
+                os.rename(tmp, mirror)
+            finally:
+                shutil.rmtree(tmp, ignore_errors=True)
+            self.clones += 1
+            authorized = True
+            logger.info("Repo cache: mirrored %s", remote)
+        elif meta is None or now - meta.get("fetchedAt", 0) >= self.fetch_interval:
+            try:
+                # From the URL the caller asked for, so success proves their access
+                _git(["fetch", "--prune", "--quiet", "--", remote, *_MIRROR_REFSPECS], cwd=mirror, env=env)
+                self.fetches += 1
+                authorized = True
+            except RepoProvisionError as exc:
+                # An outdated checkout beats none — if the caller may read it
+                logger.warning("Repo cache: fetching %s failed, using the mirror as is if access checks out: %s", remote, exc)
+                self.stale += 1
+                now = meta.get("fetchedAt", 0) if meta else 0
+        else:
+            self.hits += 1
+        self._write_meta(key, {
+            "url": remote,
+            "fetchedAt": now,
+            "lastUsed": time.time(),
+            "bytes": _dir_size(mirror),
+        })
+        return authorized
+
+    def _check_access(self, remote: str, env: dict) -> None:
+        """Raise ``RepoProvisionError`` unless *env*'s credentials can read *remote*."""
+        try:
+            _git(["ls-remote", "--quiet", "--", remote, "HEAD"], env=env)
+        except RepoProvisionError as exc:
+            self.denied += 1
+            raise RepoProvisionError(f"Cannot access {remote}: {exc}") from exc
+
+    def _checkout(self, mirror: str, remote: str, dest: str, env: dict, branch: Optional[str]) -> None:
+        has_branch = bool(branch) and _git_ok(
+            ["rev-parse", "--verify", "--quiet", f"refs/heads/{branch}"], cwd=mirror,
+        )
+        # --no-hardlinks: the sandbox can write to the workspace's objects
+        args = ["clone", "--quiet", "--local", "--no-hardlinks"]
+        if has_branch:
+            args += ["--branch", branch]
+        _git(args + ["--", mirror, dest])
+        # The workspace tracks the real remote, not the cache
+        _git(["remote", "set-url", "origin", remote], cwd=dest)
+        if branch and not has_branch:
+            _git(["checkout", "--quiet", "-b", branch], cwd=dest)
+
+    def _evict(self, *, keep: str) -> None:
+        """Remove least recently used mirrors until the cache fits its budget."""
+        entries = []
+        for name in os.listdir(self.root):
+            if name.endswith(".json"):
+                key = name[:-len(".json")]
+                meta = self._read_meta(key)
+                if meta is not None:
+                    entries.append((meta.get("lastUsed", 0), key, meta.get("bytes", 0)))
+        total = sum(size for _used, _key, size in entries)
+        count = len(entries)
+        if self.max_bytes:
+            for _used, key, size in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                # Skip mirrors a session is cloning from right now
+                with self._locked(key, fcntl.LOCK_EX | fcntl.LOCK_NB) as locked:
+                    if not locked:
+                        continue
+                    shutil.rmtree(os.path.join(self.root, f"{key}.git"), ignore_errors=True)
+                    os.remove(self._meta_path(key))
+                total -= size
+                count -= 1
+                self.evictions += 1
+                logger.info("Repo cache: evicted mirror %s (%d MB)", key, size // (1024 * 1024))
+        self._bytes = total
+        self._mirrors = count
+
+    # ── Locking and metadata ─────────────────────────────────
+
+    @contextmanager
+    def _locked(self, key: str, flags: int) -> Iterator[bool]:
+        """Hold *key*'s lock file with ``flock`` *flags*; yields whether it was acquired."""
+        fd = os.open(os.path.join(self.root, f"{key}.lock"), os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, flags)
+                acquired = True
+            except BlockingIOError:
+                acquired = False
+            yield acquired
+        finally:
+            os.close(fd)   # Releases the lock
+
+    def _meta_path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.json")
+
+    def _read_meta(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._meta_path(key), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, key: str, meta: dict) -> None:
+        path = self._meta_path(key)
+        tmp = f"{path}.tmp-{uuid.uuid4().hex[:8]}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, path)
+
+
+# ── Git helpers ──────────────────────────────────────────────
+
+def _parse_repo_url(repo_url: str) -> tuple[str, str]:
+    """``(remote, key)``: the URL without credentials, and its cache key.
+
+    Only http(s) URLs are accepted — a local path or ``file://`` URL would
+    let a session clone whatever the engine can read.
+    """
+    parts = urlsplit(repo_url.strip())
+    if parts.scheme not in ("https", "http") or not parts.hostname:
+        raise RepoProvisionError(f"Unsupported repository URL: {repo_url!r} (expected https://…)")
+    host = parts.hostname.lower()
+    if parts.port:
+        host = f"{host}:{parts.port}"
+    path = parts.path.rstrip("/")
+    remote = f"{parts.scheme}://{host}{path}"
+    if path.endswith(".git"):
+        path = path[:-len(".git")]
+    # Same repository, same mirror — whatever the spelling
+    key = hashlib.sha256(f"{host}{path.lower()}".encode("utf-8")).hexdigest()[:32]
+    return remote, key
+
+
+def _auth_header(remote: str, token: str) -> str:
+    # GitLab takes a token as the password of "oauth2"; GitHub of any user
+    user = "oauth2" if "gitlab" in (urlsplit(remote).hostname or "") else "x-access-token"
+    credentials = base64.b64encode(f"{user}:{token}".encode("utf-8")).decode("ascii")
+    return f"Authorization: Basic {credentials}"
+
+
+def _git_env(remote: str, token: Optional[str]) -> dict:
+    env = {**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+    if token:
+        # Config through the environment keeps the token out of `ps` and off disk
+        env.update(
+            GIT_CONFIG_COUNT="1",
+            GIT_CONFIG_KEY_0="http.extraHeader",
+            GIT_CONFIG_VALUE_0=_auth_header(remote, token),
+        )
+    return env
+
+
+def _configure_workspace(
+    dest: str,
+    remote: str,
+    token: Optional[str],
+    user_name: Optional[str],
+    user_email: Optional[str],
+) -> None:
+    if user_name:
+        _git(["config", "user.name", user_name], cwd=dest)
+    if user_email:
+        _git(["config", "user.email", user_email], cwd=dest)
+    if token:
+        # Lets the agent push from the sandbox — scoped to this remote
+        _git(["config", f"http.{remote}.extraHeader", _auth_header(remote, token)], cwd=dest)
+
+
+def strip_credentials(git_config: str) -> None:
+    """Remove auth headers and URL credentials from the git config file *git_config*.
+
+    For copies of a workspace that outlive it (templates): the token
+    ``_configure_workspace`` leaves there is the session owner's.
+    """
+    result = subprocess.run(
+        ["git", "config", "--file", git_config, "--get-regexp",
+         r"^http\.(.+\.)?extraheader$|^remote\..+\.(push)?url$"],
+        capture_output=True,
+        text=True,
+    )
+    for line in result.stdout.splitlines():
+        key, _, value = line.partition(" ")
+        if key.endswith(".extraheader"):
+            _git(["config", "--file", git_config, "--unset-all", key])
+            continue
+        parts = urlsplit(value)
+        if parts.username or parts.password:
+            host = parts.hostname or ""
+            if parts.port:
+                host = f"{host}:{parts.port}"
+            _git(["config", "--file", git_config, key, parts._replace(netloc=host).geturl()])
+
+
+def _git(args: list[str], *, cwd: Optional[str] = None, env: Optional[dict] = None) -> None:
+    try:
+        result = subprocess.run(
+            ["git", *args],
+            cwd=cwd,
+            env=env,
+            capture_output=True,
+            text=True,
+            timeout=GIT_COMMAND_TIMEOUT_SECONDS,
+        )
+    except FileNotFoundError as exc:
+        raise RepoProvisionError("git is not installed on the engine host") from exc
+    except subprocess.TimeoutExpired as exc:
+        raise RepoProvisionError(f"git {args[0]} timed out after {GIT_COMMAND_TIMEOUT_SECONDS}s") from exc
+    if result.returncode != 0:
+        message = result.stderr.strip().splitlines()[-1:] or [f"exit code {result.returncode}"]
+        raise RepoProvisionError(f"git {args[0]} failed: {message[0]}")
+
+
+def _git_ok(args: list[str], *, cwd: str) -> bool:
+    return subprocess.run(["git", *args], cwd=cwd, capture_output=True).returncode == 0
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for dirpath, _dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+# Module-level singleton — used by session bring-up
+repo_cache = RepoCache(
+    REPO_CACHE_DIR,
+    max_bytes=settings.REPO_CACHE_BUDGET_MB * 1024 * 1024,
+    fetch_interval=REPO_CACHE_FETCH_INTERVAL_SECONDS,
+)
@@ -0,0 +1,388 @@
+"""Routing requests to the worker that owns a session.
+
+With ``ENGINE_WORKERS`` > 1 (or several nodes sharing a registry), a
+request may land on a worker that doesn't hold the session it names.
+``SessionRouter`` registers this worker and its sessions in the shared
+``SessionRegistry`` and sends such requests on:
+
+- REST calls naming a session (``/api/v1/sessions/{id}…`` or a
+  ``session_id`` query parameter) are forwarded over HTTP by the
+  ``forward_to_owner`` middleware, and the owner's response is returned
+  as is;
+- a WebSocket that resumes or observes another worker's session is
+  relayed frame by frame to the owner (``relay_websocket``).
+
+Each worker is reachable at ``ENGINE_ADVERTISE_HOST`` on its own port
+(``ENGINE_INTERNAL_PORT_BASE`` + worker index, or ``PORT`` when it runs
+alone).  Forwarded requests carry the caller's credentials and are
+authenticated by the owner; the ``X-Lucid-Forwarded-By`` header keeps
+them from being forwarded again.  With the in-process registry nothing
+is ever forwarded and the middleware costs one dict lookup.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import re
+import secrets
+import socket
+import time
+from typing import Any, Callable, Optional
+
+import httpx
+from fastapi import Request, WebSocket
+from fastapi.responses import JSONResponse, Response
+from starlette.datastructures import Headers
+from websockets.asyncio.client import connect as ws_connect
+from websockets.exceptions import ConnectionClosed, WebSocketException
+
+from app.config import (
+    logger,
+    settings,
+    SESSION_REGISTRY_DEFAULT_PATH,
+    WORKER_HEARTBEAT_SECONDS,
+    WORKER_STALE_AFTER_SECONDS,
+    WORKER_DEAD_AFTER_SECONDS,
+    SESSION_FORWARD_TIMEOUT_SECONDS,
+)
+from app.services.docker_workspace import docker_manager
+from app.services.registry import (
+    LocalSessionRegistry,
+    SessionOwner,
+    SessionRegistry,
+    create_registry,
+)
+
+FORWARDED_HEADER = "x-lucid-forwarded-by"
+
+# Not passed on when forwarding: hop-by-hop, recomputed, or added by our
+# own CORS middleware
+_SKIP_HEADERS = frozenset({
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "transfer-encoding", "upgrade", "host", "content-length",
+    "content-encoding", "origin",
+})
+
+_SESSION_PATH_RE = re.compile(r"^/api/v1/sessions/([0-9a-fA-F-]{36})(?:/|$)")
+
+
+class SessionRouter:
+    """This worker's membership in the registry, and forwarding to its peers."""
+
+    def __init__(
+        self,
+        registry: SessionRegistry,
+        *,
+        worker_id: str,
+        url: str,
+        heartbeat: float,
+        stale_after: float,
+    ) -> None:
+        self.registry = registry
+        self.worker_id = worker_id
+        self.url = url
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        # session_id → claim kwargs, to claim again if we were dropped as stale
+        self._claims: dict[str, dict] = {}
+        # Sessions of workers dropped as stale → (worker_id, when): their
+        # sandboxes go once the worker is known dead, not merely stalled
+        self._orphans: dict[str, tuple[str, float]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._http: Optional[httpx.AsyncClient] = None
+
+        self.forwarded = 0
+        self.relayed = 0
+        self.forward_errors = 0
+
+    @property
+    def shared(self) -> bool:
+        """Other workers may own sessions."""
+        return not isinstance(self.registry, LocalSessionRegistry)
+
+    async def start(self) -> None:
+        await self._call(self.registry.register_worker, self.worker_id, self.url)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        if self.shared:
+            logger.info("Worker %s registered at %s", self.worker_id, self.url)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self._call(self.registry.remove_worker, self.worker_id)
+        except Exception as exc:
+            logger.warning("Could not deregister worker %s: %s", self.worker_id, exc)
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+        self.registry.close()
+
+    # ── Ownership ────────────────────────────────────────────
+
+    async def claim(self, session: Any) -> None:
+        """Record that this worker owns *session*."""
+        claim = {
+            "task": session.task[:200],
+            "created_at": session.created_at.isoformat(),
+        }
+        self._claims[session.session_id] = {"user_id": session.user_id, **claim}
+        await self._call(
+            self.registry.claim, session.session_id, session.user_id, self.worker_id, **claim,
+        )
+
+    async def release(self, session_id: str) -> None:
+        if self._claims.pop(session_id, None) is None:
+            return
+        try:
+            await self._call(self.registry.release, session_id)
+        except Exception as exc:
+            logger.warning("Could not release session %s in the registry: %s", session_id, exc)
+
+    async def remote_owner(self, session_id: str, headers: Headers) -> Optional[SessionOwner]:
+        """The other worker owning *session_id*, if a request should go there."""
+        if not self.shared or FORWARDED_HEADER in headers:
+            return None
+        owner = await self._call(self.registry.lookup, session_id, live_after=self._live_after())
+        if owner is None or owner.worker_id == self.worker_id:
+            return None
+        return owner
+
+    async def remote_sessions_for_user(self, user_id: str) -> list[SessionOwner]:
+        """Sessions of *user_id* held by other workers."""
+        if not self.shared:
+            return []
+        owners = await self._call(self.registry.list_for_user, user_id, live_after=self._live_after())
+        return [owner for owner in owners if owner.worker_id != self.worker_id]
+
+    async def live_session_ids(self) -> set[str]:
+        """Sessions some live worker owns — their sandboxes are not orphans."""
+        return await self._call(self.registry.live_session_ids, live_after=self._live_after())
+
+    # ── Forwarding ───────────────────────────────────────────
+
+    async def forward(self, request: Request, owner: SessionOwner) -> Response:
+        """Send *request* to the worker owning its session and return its response."""
+        if self._http is None:
+            self._http = httpx.AsyncClient(timeout=SESSION_FORWARD_TIMEOUT_SECONDS)
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in _SKIP_HEADERS}
+        headers[FORWARDED_HEADER] = self.worker_id
+        url = owner.worker_url + request.url.path
+        if request.url.query:
+            url += "?" + request.url.query
+        try:
+            upstream = await self._http.request(
+                request.method, url, headers=headers, content=await request.body(),
+            )
+        except httpx.HTTPError as exc:
+            self.forward_errors += 1
+            logger.warning("Forwarding to worker %s failed: %s", owner.worker_id, exc)
+            return JSONResponse(
+                status_code=503,
+                content={"detail": {
+                    "status": "error",
+                    "message": "The worker running this session is unreachable.",
+                }},
+            )
+        self.forwarded += 1
+        return Response(
+            content=upstream.content,
+            status_code=upstream.status_code,
+            headers={k: v for k, v in upstream.headers.items() if k.lower() not in _SKIP_HEADERS},
+        )
+
+    async def relay_websocket(
+        self,
+        websocket: WebSocket,
+        owner: SessionOwner,
+        first_message: dict,
+    ) -> None:
+        """Connect *websocket* through to the worker owning its session.
+
+        *first_message* is the handshake already read from the client.
+        Returns once either side closes; the owner's close code is passed on.
+        """
+        url = "ws" + owner.worker_url[len("http"):] + websocket.url.path
+        if websocket.url.query:
+            url += "?" + websocket.url.query
+        self.relayed += 1
+        try:
+            async with ws_connect(
+                url, additional_headers={FORWARDED_HEADER: self.worker_id}, max_size=None,
+            ) as upstream:
+                await upstream.send(json.dumps(first_message))
+
+                async def owner_to_client() -> None:
+                    try:
+                        async for message in upstream:
+                            if isinstance(message, bytes):
+                                await websocket.send_bytes(message)
+                            else:
+                                await websocket.send_text(message)
+                    except ConnectionClosed:
+                        pass
+
+                async def client_to_owner() -> None:
+                    while True:
+                        message = await websocket.receive()
+                        if message["type"] == "websocket.disconnect":
+                            return
+                        if message.get("bytes") is not None:
+                            await upstream.send(message["bytes"])
+                        elif message.get("text") is not None:
+                            await upstream.send(message["text"])
+
+                tasks = [
+                    asyncio.create_task(owner_to_client()),
+                    asyncio.create_task(client_to_owner()),
+                ]
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                if tasks[0] not in done:
+                    return   # The client left; closing upstream detaches it at the owner
+                code, reason = upstream.close_code or 1000, upstream.close_reason or ""
+        except (OSError, WebSocketException) as exc:
+            self.forward_errors += 1
+            logger.warning("Relaying WebSocket to worker %s failed: %s", owner.worker_id, exc)
+            code, reason = 4503, "Session owner unreachable"
+            try:
+                await websocket.send_json({
+                    "type": "error",
+                    "message": "The worker running this session is unreachable.",
+                })
+            except Exception:
+                return
+        try:
+            await websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        """Counters for health/metrics endpoints."""
+        return {
+            "workerId": self.worker_id,
+            "url": self.url,
+            "shared": self.shared,
+            "claimed": len(self._claims),
+            "forwarded": self.forwarded,
+            "relayed": self.relayed,
+            "forwardErrors": self.forward_errors,
+        }
+
+    # ── Internals ────────────────────────────────────────────
+
+    def _live_after(self) -> float:
+        return time.time() - self.stale_after
+
+    async def _call(self, func: Callable, *args: Any, **kwargs: Any) -> Any:
+        if self.registry.blocking:
+            return await asyncio.to_thread(func, *args, **kwargs)
+        return func(*args, **kwargs)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            try:
+                await self._beat()
+            except Exception as exc:
+                logger.error("Registry heartbeat failed: %s", exc)
+
+    async def _beat(self) -> None:
+        if not await self._call(self.registry.heartbeat, self.worker_id):
+            # Presumed dead by a peer (a long stall) — take our sessions back
+            logger.warning("Worker %s was dropped from the registry — re-registering", self.worker_id)
+            await self._call(self.registry.register_worker, self.worker_id, self.url)
+            for session_id, claim in list(self._claims.items()):
+                user_id = claim["user_id"]
+                await self._call(
+                    self.registry.claim, session_id, user_id, self.worker_id,
+                    task=claim["task"], created_at=claim["created_at"],
+                )
+        now = time.monotonic()
+        for session_id, worker_id in await self._call(self.registry.reap_stale, self._live_after()):
+            self._orphans.setdefault(session_id, (worker_id, now))
+        for session_id, (worker_id, since) in list(self._orphans.items()):
+            alive = _worker_alive(worker_id)
+            if alive is None and now - since < WORKER_DEAD_AFTER_SECONDS:
+                continue   # On another host — give a stalled worker time to come back
+            del self._orphans[session_id]
+            if alive:
+                continue   # Stalled, not dead — it re-registers and keeps its sandboxes
+            if session_id in self._claims or await self._call(
+                self.registry.lookup, session_id, live_after=self._live_after(),
+            ) is not None:
+                continue   # Claimed again meanwhile
+            # Sandboxes of a dead worker on this host would otherwise linger
+            try:
+                await asyncio.to_thread(docker_manager.remove_session_container, session_id)
+            except Exception as exc:
+                logger.debug("No sandbox removed for orphaned session %s: %s", session_id, exc)
+
+
+def _worker_alive(worker_id: str) -> Optional[bool]:
+    """Whether the process behind *worker_id* still runs; ``None`` if it is on another host."""
+    host, _, rest = worker_id.rpartition("-")[0].rpartition("-")
+    if host != socket.gethostname() or not rest.isdigit():
+        return None
+    try:
+        os.kill(int(rest), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass   # Exists, just not ours to signal
+    return True
+
+
+async def forward_to_owner(request: Request, call_next: Callable) -> Response:
+    """HTTP middleware: hand requests for another worker's session to that worker."""
+    from app.services.sessions import store   # sessions imports this module
+
+    session_id = _session_id_of(request)
+    if session_id and not store.contains(session_id):
+        owner = await session_router.remote_owner(session_id, request.headers)
+        if owner is not None:
+            return await session_router.forward(request, owner)
+    return await call_next(request)
+
+
+def _session_id_of(request: Request) -> Optional[str]:
+    match = _SESSION_PATH_RE.match(request.url.path)
+    if match:
+        return match.group(1)
+    return request.query_params.get("session_id")
+
+
+def _registry_url() -> str:
+    if settings.SESSION_REGISTRY_URL:
+        return settings.SESSION_REGISTRY_URL
+    if settings.ENGINE_WORKERS > 1:
+        return f"sqlite:///{SESSION_REGISTRY_DEFAULT_PATH}"
+    return ""
+
+
+def _worker_url() -> str:
+    if settings.ENGINE_WORKER_INDEX is None:
+        port = settings.PORT
+    else:
+        port = settings.ENGINE_INTERNAL_PORT_BASE + settings.ENGINE_WORKER_INDEX
+    return f"http://{settings.ENGINE_ADVERTISE_HOST}:{port}"
+
+
+# Module-level singleton — started and closed by the app lifespan
+session_router = SessionRouter(
+    create_registry(_registry_url()),
+    worker_id=f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(3)}",
+    url=_worker_url(),
+    heartbeat=WORKER_HEARTBEAT_SECONDS,
+    stale_after=WORKER_STALE_AFTER_SECONDS,
+)
@@ -1,24 +1,52 @@
 """Agent session lifecycle — store, create, destroy.
 
 The ``AgentSession`` dataclass holds per-session SDK objects.
-``SessionStore`` manages the in-memory dict and the asyncio lock.
+``SessionStore`` manages the in-memory registry and its per-user index;
+each session is also claimed in the shared registry (``app.services.routing``)
+so other workers can route requests for it here.
 This is the *only* module that touches the global session state.
 """
 
 from __future__ import annotations
 
 import asyncio
+import json
 import os
+import secrets
 import shutil
+import time
 import uuid
 from datetime import datetime, timezone
 from typing import Any, Optional
 
-from app.config import logger, settings, EVENT_BUFFER_MAX_SIZE
+from app.config import (
+    logger,
+    settings,
+    EVENT_BUFFER_MAX_SIZE,
+    EVENT_SPILL_DIR,
+    REPLAY_BUFFER_SIZE,
+    BLOB_STORE_DIR,
+    BLOB_STORE_MAX_BYTES,
+    CONVERSATION_STATE_DIR,
+    AGENT_PROCESS_KILL_AFTER_SECONDS,
+    AGENT_RUN_STOP_GRACE_SECONDS,
+    SESSION_TEARDOWN_CONCURRENCY,
+)
 from app import sdk
-from app.exceptions import SessionNotFoundError
+from app.exceptions import EngineDrainingError, SessionNotFoundError, WorkspaceTemplateError
 from app.services.llm import resolve_llm
+from app.services.agent_process import ConversationSpec, ProcessConversation, agent_processes
+from app.services.blob_store import SessionBlobStore
+from app.services.bringup import BringUpPlan, PhaseCallback
 from app.services.docker_workspace import docker_manager
+from app.services.event_buffer import EventReplayLog
+from app.services.event_hub import SessionEventHub
+from app.services.integrations import token_for_repo
+from app.services.repo_cache import repo_cache
+from app.services.routing import session_router
+from app.services.file_tree import FileTreeRefreshScheduler, FileTreeSnapshot
+from app.services.workspace_templates import workspace_templates
+from app.services.workspace_watcher import WATCHFILES_AVAILABLE, WorkspaceWatcher
 
 
 # ── Session dataclass ───────────────────────────────────────
@@ -30,7 +58,12 @@ class AgentSession:
         "session_id", "user_id", "task", "repo_url",
         "created_at", "is_alive",
         "conversation", "workspace", "agent", "llm",
-        "event_buffer", "container_id",
+        "events", "container_id", "file_tree", "watcher",
+        "tree_refresher", "replay", "run_lock",
+        "chat_session_id", "connection_id", "stream_task", "detach_handle",
+        "user_jwt", "persist_task", "share_token", "blobs", "deltas",
+        "last_active", "hibernated", "llm_config", "startup_timings",
+        "stop_requested",
     )
 
     def __init__(
@@ -46,6 +79,8 @@ class AgentSession:
         self.repo_url = repo_url
         self.created_at = datetime.now(timezone.utc)
         self.is_alive = True
+        # time.monotonic() of the last event or client message — see app.services.reaper
+        self.last_active = time.monotonic()
 
         # SDK objects — populated by create_session()
         self.conversation: Any = None
@@ -56,53 +91,142 @@ class AgentSession:
         # Docker sandbox container ID — set when a container is created
         self.container_id: str | None = None
 
-        # Queue for streaming events to the WebSocket handler
-        self.event_buffer: asyncio.Queue = asyncio.Queue(maxsize=EVENT_BUFFER_MAX_SIZE)
+        # Conversation released and sandbox stopped until the next turn or
+        # attach — see hibernate_session().  llm_config rebuilds the LLM.
+        self.hibernated = False
+        self.llm_config: tuple[str, str | None, bool] | None = None
+        # Seconds per bring-up step — see create_session()
+        self.startup_timings: dict[str, float] = {}
+
+        # Last file tree sent to the client — set when a workspace dir exists
+        self.file_tree: FileTreeSnapshot | None = None
+        # Filesystem watcher keeping file_tree current (None → heuristic)
+        self.watcher: WorkspaceWatcher | None = None
+        # Coalesces refresh requests from the watcher / heuristic
+        self.tree_refresher: FileTreeRefreshScheduler | None = None
+
+        # Sequence numbers + recent agent events for resumable streams
+        self.replay = EventReplayLog(maxlen=REPLAY_BUFFER_SIZE)
+        # Serialises conversation turns across reconnecting WebSockets
+        self.run_lock = asyncio.Lock()
+        # Set to stop the run in progress — see stop_conversation()
+        self.stop_requested = asyncio.Event()
+
+        # WebSocket attachment — managed by the ws router
+        self.chat_session_id: str | None = None
+        self.connection_id: str | None = None
+        self.stream_task: asyncio.Task | None = None
+        # Pending destroy while no WebSocket is attached
+        self.detach_handle: asyncio.TimerHandle | None = None
+        # JWT of the latest attached connection — used for RLS-scoped writes
+        self.user_jwt: str | None = None
+        # Lets the owner invite read-only observers of this session
+        self.share_token = secrets.token_urlsafe(24)
+
+        # Fan-out of formatted events to every subscriber (owning WebSocket,
+        # observers, chat persister).  Published from the SDK worker thread;
+        # each subscriber has its own buffer and overflow policy.
+        self.events = SessionEventHub(
+            self.replay,
+            maxsize=EVENT_BUFFER_MAX_SIZE,
+            spill_prefix=os.path.join(EVENT_SPILL_DIR, session_id),
+        )
+        # Session-level consumer that persists events — see app.events
+        self.persist_task: asyncio.Task | None = None
+        # Full text of event fields too large to send inline
+        self.blobs = SessionBlobStore(
+            os.path.join(BLOB_STORE_DIR, session_id),
+            max_bytes=BLOB_STORE_MAX_BYTES,
+        )
+        # Streams partial LLM output as agent_delta frames (opt-in)
+        self.deltas: Any = None
+
+    def publish(self, event_data: dict) -> bool:
+        """Number an agent event and fan it out to subscribers.  Thread-safe."""
+        self.last_active = time.monotonic()
+        return self.events.publish(event_data)
+
+    def touch(self) -> None:
+        """Record client activity, postponing idle reaping."""
+        self.last_active = time.monotonic()
 
 
 # ── In-memory session store ─────────────────────────────────
 
 class SessionStore:
-    """Thread-safe, in-memory session registry."""
+    """In-memory session registry with a per-user index.
+
+    Only the event loop touches the store and no method awaits, so every
+    operation is atomic with respect to other coroutines — no lock is
+    needed.  Reads are plain dict lookups; listing one user's sessions
+    walks only that user's entries.
+    """
 
     def __init__(self) -> None:
         self._sessions: dict[str, AgentSession] = {}
-        self._lock = asyncio.Lock()
+        # user_id → {session_id: session}, in creation order
+        self._by_user: dict[str, dict[str, AgentSession]] = {}
+        self.created = 0
+        self.destroyed = 0
+        self.peak = 0
+        # Shutting down: no new sessions or turns — see drain_sessions()
+        self.draining = False
+
+    def add(self, session: AgentSession) -> None:
+        self._sessions[session.session_id] = session
+        self._by_user.setdefault(session.user_id, {})[session.session_id] = session
+        self.created += 1
+        self.peak = max(self.peak, len(self._sessions))
+
+    def get(self, session_id: str) -> AgentSession:
+        session = self._sessions.get(session_id)
+        if session is None:
+            raise SessionNotFoundError(session_id)
+        return session
 
-    async def add(self, session: AgentSession) -> None:
-        async with self._lock:
-            self._sessions[session.session_id] = session
+    def get_or_none(self, session_id: str) -> AgentSession | None:
+        return self._sessions.get(session_id)
 
-    async def get(self, session_id: str) -> AgentSession:
-        async with self._lock:
-            session = self._sessions.get(session_id)
+    def pop(self, session_id: str) -> AgentSession | None:
+        session = self._sessions.pop(session_id, None)
         if session is None:
-            raise SessionNotFoundError(session_id)
+            return None
+        user_sessions = self._by_user.get(session.user_id)
+        if user_sessions is not None:
+            user_sessions.pop(session_id, None)
+            if not user_sessions:
+                del self._by_user[session.user_id]
+        self.destroyed += 1
         return session
 
-    async def get_or_none(self, session_id: str) -> AgentSession | None:
-        async with self._lock:
-            return self._sessions.get(session_id)
+    def contains(self, session_id: str) -> bool:
+        return session_id in self._sessions
+
+    def list_all(self) -> list[AgentSession]:
+        return list(self._sessions.values())
 
-    async def pop(self, session_id: str) -> AgentSession | None:
-        async with self._lock:
-            return self._sessions.pop(session_id, None)
+    def list_for_user(self, user_id: str) -> list[AgentSession]:
+        return list(self._by_user.get(user_id, {}).values())
 
-    async def contains(self, session_id: str) -> bool:
-        async with self._lock:
-            return session_id in self._sessions
+    def count(self) -> int:
+        return len(self._sessions)
 
-    async def list_all(self) -> list[AgentSession]:
-        async with self._lock:
-            return list(self._sessions.values())
+    def count_for_user(self, user_id: str) -> int:
+        return len(self._by_user.get(user_id, ()))
 
-    async def count(self) -> int:
-        async with self._lock:
-            return len(self._sessions)
+    def snapshot_ids(self) -> list[str]:
+        return list(self._sessions.keys())
 
-    async def snapshot_ids(self) -> list[str]:
-        async with self._lock:
-            return list(self._sessions.keys())
+    def stats(self) -> dict:
+        """Counters for health/metrics endpoints."""
+        return {
+            "active": len(self._sessions),
+            "users": len(self._by_user),
+            "peak": self.peak,
+            "created": self.created,
+            "destroyed": self.destroyed,
+            "draining": self.draining,
+        }
 
 
 # Module-level singleton — imported by routers and app factory
@@ -120,23 +244,46 @@ async def create_session(
     branch: str | None = None,
     git_user_name: str | None = None,
     git_user_email: str | None = None,
+    user_jwt: str | None = None,
+    template: str | None = None,
     model_provider: str | None = None,
     api_key: str | None = None,
     project_id: str | None = None,
+    stream_tokens: bool = False,
+    session_id: str | None = None,
+    on_phase: PhaseCallback | None = None,
 ) -> AgentSession:
     """Create and register a fully-initialised agent session.
 
     Two modes:
     1. Real mode (SDK installed): LocalConversation with a local workspace dir
     2. Mock mode (no SDK): Simulated agent responses
+
+    With ``stream_tokens`` the LLM streams its output and partial text is
+    published as ``agent_delta`` frames ahead of each complete event.
+
+    Real-mode bring-up runs as a ``BringUpPlan``; ``on_phase`` is told as
+    each step starts and finishes, and the step timings end up in
+    ``session.startup_timings``.  Pass ``session_id`` to choose the id, so
+    the caller can start work keyed on it (the chat record) concurrently.
+
+    With ``repo_url`` the repository is checked out into the workspace from
+    the engine's mirror cache, authenticated with ``git_token`` or else the
+    user's stored integration token (read with ``user_jwt``).  With
+    ``template`` the workspace is then seeded from that workspace template.
     """
-    from app.events import format_sdk_event
+    from app.events import AgentDeltaCoalescer, persist_session_events
+    from app.services.reaper import session_reaper
 
-    session_id = str(uuid.uuid4())
+    session_id = session_id or str(uuid.uuid4())
     provider = (model_provider or settings.DEFAULT_PROVIDER).lower()
 
     if not user_id:
         raise ValueError("create_session requires a non-empty user_id")
+    if store.draining:
+        raise EngineDrainingError("This server is shutting down. Try again in a moment.")
+    if template and await asyncio.to_thread(workspace_templates.path_for, user_id, template) is None:
+        raise WorkspaceTemplateError(f"Workspace template {template!r} not found.")
 
     # ── Mock path ────────────────────────────────────────────
     if not sdk.OPENHANDS_AVAILABLE:
@@ -146,18 +293,17 @@ async def create_session(
             task=task,
             repo_url=repo_url,
         )
-        await store.add(session)
+        await session_reaper.make_room(session_id, container=False)
+        store.add(session)
+        session_reaper.release_room(session_id)
+        await session_router.claim(session)
         return session
 
     # ── Real path ────────────────────────────────────────────
-    llm = resolve_llm(provider, api_key)
+    llm = resolve_llm(provider, api_key, stream=stream_tokens)
 
-    # get_default_agent registers all tools before creating the agent
-    agent = sdk.get_default_agent(llm=llm, cli_mode=True, max_iterations=settings.MAX_ITERATIONS)
-
-    # Create the workspace directory on the host
+    # Workspace directory on the host
     workspace_dir = os.path.join(settings.WORKSPACE_BASE_PATH, user_id, session_id)
-    os.makedirs(workspace_dir, exist_ok=True)
 
     session = AgentSession(
         session_id=session_id,
@@ -165,73 +311,340 @@ async def create_session(
         task=task,
         repo_url=repo_url,
     )
-    session.llm = llm
-    session.agent = agent
+    session.llm_config = (provider, api_key, stream_tokens)
     session.workspace = workspace_dir
+    session.file_tree = FileTreeSnapshot(workspace_dir)
+    session.tree_refresher = FileTreeRefreshScheduler(
+        session.file_tree,
+        session.publish,
+        window=settings.FILE_TREE_REFRESH_WINDOW_MS / 1000,
+    )
+    if stream_tokens:
+        session.deltas = AgentDeltaCoalescer(session.publish, session.replay)
+
+    async def start_watcher() -> None:
+        # The baseline every viewer's file tree and deltas are relative to
+        await asyncio.to_thread(session.file_tree.reset)
+        # Watch the workspace for exact file changes (inotify where available)
+        if WATCHFILES_AVAILABLE:
+            session.watcher = WorkspaceWatcher(session.file_tree, session.tree_refresher.request)
+            session.watcher.start()
+
+    async def start_sandbox() -> None:
+        # Spin up an isolated Docker sandbox for this session.
+        # The workspace directory is bind-mounted into the container at
+        # WORKSPACE_MOUNT_PATH so the agent operates inside the sandbox.
+        # Falls back gracefully if Docker is unavailable.
+        try:
+            container_id = await asyncio.to_thread(
+                docker_manager.create_sandbox,
+                session_id=session_id,
+                user_id=user_id,
+                workspace_dir=workspace_dir,
+            )
+            session.container_id = container_id
+            logger.info("Sandbox container %s ready for session %s", container_id[:12], session_id)
+        except Exception as exc:
+            logger.warning(
+                "Docker sandbox unavailable — agent runs without container isolation: %s", exc
+            )
 
-    # Spin up an isolated Docker sandbox for this session.
-    # The workspace directory is bind-mounted into the container at
-    # WORKSPACE_MOUNT_PATH so the agent operates inside the sandbox.
-    # Falls back gracefully if Docker is unavailable.
-    try:
-        container_id = await asyncio.to_thread(
-            docker_manager.create_sandbox,
-            session_id=session_id,
-            user_id=user_id,
-            workspace_dir=workspace_dir,
+    async def checkout_repo() -> None:
+        token = git_token or await token_for_repo(
+            user_id=user_id, repo_url=repo_url, user_jwt=user_jwt,
+        )
+        await asyncio.to_thread(
+            repo_cache.provision,
+            repo_url,
+            workspace_dir,
+            token=token or None,
+            branch=branch or None,
+            user_name=git_user_name or None,
+            user_email=git_user_email or None,
         )
-        session.container_id = container_id
-        logger.info("Sandbox container %s ready for session %s", container_id[:12], session_id)
-    except Exception as exc:
-        logger.warning(
-            "Docker sandbox unavailable — agent runs without container isolation: %s", exc
+
+    # Independent steps overlap: the agent is built while the sandbox starts
+    plan = BringUpPlan(on_phase)
+    plan.step("workspace", lambda: asyncio.to_thread(os.makedirs, workspace_dir, exist_ok=True))
+    files_ready: tuple[str, ...] = ("workspace",)
+    if repo_url:
+        plan.step("repo", checkout_repo, after=("workspace",))
+        files_ready = ("repo",)
+    if template:
+        # After the checkout: a clone needs an empty directory, and the
+        # template's files (installed dependencies) go on top of the repo
+        plan.step(
+            "template",
+            lambda: asyncio.to_thread(
+                workspace_templates.materialize, user_id, template, workspace_dir,
+            ),
+            after=files_ready,
         )
+        files_ready = ("template",)
+    conversation_after: tuple[str, ...] = ("sandbox", *files_ready)
+    if settings.AGENT_RUNNER_MODE == "thread":
+        # In "process" mode each agent process builds its own agent
+        plan.step("agent", lambda: asyncio.to_thread(build_agent, llm))
+        conversation_after = ("agent", *conversation_after)
+    plan.step("watcher", start_watcher, after=files_ready)
+    plan.step("sandbox", start_sandbox, after=("workspace",))
+    plan.step(
+        "conversation",
+        lambda: asyncio.to_thread(_start_conversation, session, llm, plan.results.get("agent")),
+        after=conversation_after,
+    )
+    # Evict least recently used sessions if the node is full; the room
+    # stays reserved for this session until it is in the store
+    await session_reaper.make_room(session_id, container=True)
+    try:
+        # Claimed before the sandbox exists: a worker starting up meanwhile
+        # spares containers of claimed sessions when it cleans up orphans
+        await session_router.claim(session)
+        await plan.run()
+    except BaseException:
+        # Don't leak what the steps that did finish set up
+        session_reaper.release_room(session_id)
+        await session_router.release(session_id)
+        session.is_alive = False
+        await _teardown(session)
+        raise
+    session.startup_timings = plan.timings
+
+    # Persist the chat history independently of attached WebSockets
+    session.persist_task = asyncio.create_task(
+        persist_session_events(
+            session,
+            session.events.subscribe(
+                "persist", policy="spill", after_seq=0, types=frozenset({"agent_event"}),
+            ),
+        ),
+    )
+
+    store.add(session)
+    session_reaper.release_room(session_id)
+    logger.info("Session %s created — task: %s", session_id, task[:60])
+    return session
+
 
+def build_agent(llm: Any) -> Any:
+    # get_default_agent registers all tools before creating the agent
+    return sdk.get_default_agent(llm=llm, cli_mode=True, max_iterations=settings.MAX_ITERATIONS)
+
+
+def build_conversation(
+    session_id: str,
+    *,
+    workspace: str,
+    container_id: str | None,
+    agent: Any,
+    callbacks: list,
+    token_callbacks: list | None = None,
+) -> Any:
+    """Build the SDK workspace and conversation of a real-mode session.
+
+    The conversation persists its state under ``CONVERSATION_STATE_DIR``, so
+    building it again for the same session (after hibernation, or in
+    another agent process) resumes it.  Blocking.
+    """
     # Build the SDK workspace object (LocalWorkspace wraps the directory path).
     # If the SDK also exports DockerWorkspace and a container was created,
     # prefer DockerWorkspace for full in-container command execution.
-    if sdk.DockerWorkspace is not None and session.container_id:
+    if sdk.DockerWorkspace is not None and container_id:
         workspace_obj = sdk.DockerWorkspace(
-            container_id=session.container_id,
+            container_id=container_id,
             path=settings.WORKSPACE_MOUNT_PATH,
         )
         logger.info("Using DockerWorkspace for session %s", session_id)
     else:
-        workspace_obj = sdk.LocalWorkspace(path=workspace_dir)
+        workspace_obj = sdk.LocalWorkspace(path=workspace)
         logger.info("Using LocalWorkspace for session %s", session_id)
 
+    conversation_kwargs: dict = {}
+    if token_callbacks:
+        conversation_kwargs["token_callbacks"] = token_callbacks
+
+    return sdk.LocalConversation(
+        agent=agent,
+        workspace=workspace_obj,
+        callbacks=callbacks,
+        persistence_dir=os.path.join(CONVERSATION_STATE_DIR, session_id),
+        conversation_id=uuid.UUID(session_id),
+        **conversation_kwargs,
+    )
+
+
+def _start_conversation(session: AgentSession, llm: Any, agent: Any = None) -> None:
+    """Set ``session.conversation`` up for a real-mode session.
+
+    In "process" runner mode the conversation lives in an agent process
+    and the session gets a ``ProcessConversation`` standing in for it.
+    Blocking — runs in a worker thread.
+    """
+    from app.events import format_sdk_event
+
+    session.llm = llm
+    if settings.AGENT_RUNNER_MODE == "process":
+        provider, api_key, stream_tokens = session.llm_config
+        session.conversation = ProcessConversation(
+            agent_processes,
+            ConversationSpec(
+                session.session_id, session.workspace, session.container_id,
+                provider, api_key, stream_tokens,
+            ),
+            session,
+        )
+        return
+
+    if agent is None:
+        agent = build_agent(llm)
+
     def on_event(event):
+        # Runs on the conversation.run worker thread — publish() is the
+        # only thread-safe way onto the loop-owned buffer.
         try:
-            event_data = format_sdk_event(event)
+            if session.deltas is not None:
+                session.deltas.flush()  # Partial text first, then the event
+            event_data = format_sdk_event(event, session.blobs)
             if event_data:
-                try:
-                    session.event_buffer.put_nowait(event_data)
-                except asyncio.QueueFull:
-                    pass
+                session.publish(event_data)
         except Exception as exc:
             logger.error("Event callback error: %s", exc)
 
-    conversation = sdk.LocalConversation(
+    session.conversation = build_conversation(
+        session.session_id,
+        workspace=session.workspace,
+        container_id=session.container_id,
         agent=agent,
-        workspace=workspace_obj,
         callbacks=[on_event],
+        token_callbacks=[session.deltas.feed] if session.deltas is not None else None,
+    )
+    session.agent = agent
+
+
+def stop_conversation(session: AgentSession) -> None:
+    """Make a running ``conversation.run()`` return as soon as it can.
+
+    The conversation is paused, so the agent stops at its next step
+    boundary, and the commands it is running in the sandbox are killed so
+    the current step doesn't block on them.  Without a sandbox only the
+    pause applies.  A conversation in an agent process that still hasn't
+    returned ``AGENT_PROCESS_KILL_AFTER_SECONDS`` later has its process
+    killed.  Blocking — called by the agent runner in a thread.
+    """
+    conversation = session.conversation
+    if conversation is not None and hasattr(conversation, "pause"):
+        try:
+            conversation.pause()
+        except Exception as exc:
+            logger.warning("Could not pause conversation of session %s: %s", session.session_id, exc)
+    if session.container_id and not session.hibernated:
+        try:
+            docker_manager.interrupt_processes(session.container_id)
+        except Exception as exc:
+            logger.warning("Could not interrupt sandbox of session %s: %s", session.session_id, exc)
+    if isinstance(conversation, ProcessConversation):
+        conversation.terminate(AGENT_PROCESS_KILL_AFTER_SECONDS)
+
+
+# ── Hibernation ─────────────────────────────────────────────
+
+async def hibernate_session(session: AgentSession) -> bool:
+    """Release an idle session's SDK objects and stop its sandbox.
+
+    The conversation state is already on disk (``persistence_dir``); a
+    ``session.json`` snapshot of the session's metadata is written next to
+    it.  The event hub, replay ring, workspace and chat record stay, so
+    attached clients notice nothing.  Returns ``False`` if the session is
+    running, hibernated already, or has no conversation (mock mode).
+    """
+    if session.hibernated or session.conversation is None or session.run_lock.locked():
+        return False
+    async with session.run_lock:
+        conversation = session.conversation
+        await asyncio.to_thread(_write_snapshot, session)
+        session.conversation = session.agent = session.llm = None
+        session.hibernated = True
+        if hasattr(conversation, "close"):
+            try:
+                await asyncio.to_thread(conversation.close)
+            except Exception as exc:
+                logger.warning("Error closing conversation of session %s: %s", session.session_id, exc)
+        if session.container_id:
+            try:
+                await docker_manager.stop_container(session.container_id, session.session_id)
+            except Exception as exc:
+                logger.warning("Could not stop sandbox of session %s: %s", session.session_id, exc)
+    logger.info("Session %s hibernated", session.session_id)
+    return True
+
+
+async def restore_session(session: AgentSession) -> None:
+    """Bring a hibernated session back: restart its sandbox, rebuild the conversation.
+
+    Call with ``session.run_lock`` held, so a run never races hibernation.
+    """
+    if not session.hibernated:
+        return
+    started = time.monotonic()
+    if session.container_id:
+        await docker_manager.start_container(session.container_id, session.session_id)
+    provider, api_key, stream_tokens = session.llm_config
+    llm = resolve_llm(provider, api_key, stream=stream_tokens)
+    # Reloads the persisted conversation state from disk
+    await asyncio.to_thread(_start_conversation, session, llm)
+    session.hibernated = False
+    session.touch()
+    logger.info(
+        "Session %s restored in %.2fs", session.session_id, time.monotonic() - started,
     )
-    session.conversation = conversation
 
-    await store.add(session)
-    logger.info("Session %s created — task: %s", session_id, task[:60])
-    return session
+
+def _write_snapshot(session: AgentSession) -> None:
+    state_dir = os.path.join(CONVERSATION_STATE_DIR, session.session_id)
+    os.makedirs(state_dir, exist_ok=True)
+    snapshot = {
+        "sessionId": session.session_id,
+        "userId": session.user_id,
+        "task": session.task,
+        "repoUrl": session.repo_url,
+        "createdAt": session.created_at.isoformat(),
+        "workspace": session.workspace,
+        "containerId": session.container_id,
+        "chatSessionId": session.chat_session_id,
+        "lastSeq": session.replay.last_seq,
+        "hibernatedAt": datetime.now(timezone.utc).isoformat(),
+    }
+    with open(os.path.join(state_dir, "session.json"), "w", encoding="utf-8") as f:
+        json.dump(snapshot, f)
 
 
 async def destroy_session(session_id: str) -> None:
     """Stop and clean up an agent session."""
-    session = await store.pop(session_id)
+    session = store.pop(session_id)
     if not session:
         return
+    await session_router.release(session_id)
 
     session.is_alive = False
+    session.stop_requested.set()   # a run still in progress winds down
+    if session.detach_handle is not None:
+        session.detach_handle.cancel()
+        session.detach_handle = None
+    for sub_stats in session.events.stats()["subscribers"]:
+        if sub_stats["dropped"] or sub_stats["spilled"]:
+            logger.warning(
+                "Session %s %s subscriber: %d spilled, %d coalesced, %d dropped",
+                session_id, sub_stats["kind"], sub_stats["spilled"],
+                sub_stats["coalesced"], sub_stats["dropped"],
+            )
     logger.info("Destroying session %s", session_id)
+    await _teardown(session)
+
 
+async def _teardown(session: AgentSession) -> None:
+    """Release everything *session* holds — a destroyed session or a failed bring-up."""
+    session_id = session.session_id
+    # Before the events close: a run winding down still publishes its last events
     if session.conversation and hasattr(session.conversation, "close"):
         try:
             await asyncio.to_thread(session.conversation.close)
@@ -239,6 +652,21 @@ async def destroy_session(session_id: str) -> None:
         except Exception as exc:
             logger.error("Error closing conversation: %s", exc)
 
+    session.events.close()
+    if session.deltas is not None:
+        session.deltas.close()
+    if session.watcher is not None:
+        await session.watcher.stop()
+    if session.tree_refresher is not None:
+        await session.tree_refresher.close()
+
+    # Let the persister flush what it still holds, spilled events included
+    if session.persist_task is not None:
+        try:
+            await session.persist_task
+        except Exception as exc:
+            logger.error("Event persister failed for session %s: %s", session_id, exc)
+
     # Destroy the Docker sandbox container
     if session.container_id:
         try:
@@ -246,6 +674,63 @@ async def destroy_session(session_id: str) -> None:
         except Exception as exc:
             logger.error("Error destroying sandbox for session %s: %s", session_id, exc)
 
-    # Clean up local workspace directory
+    # Clean up local workspace directory, large-payload blobs and conversation state
+    await asyncio.to_thread(_remove_session_files, session)
+
+
+def _remove_session_files(session: AgentSession) -> None:
     if isinstance(session.workspace, str) and os.path.isdir(session.workspace):
         shutil.rmtree(session.workspace, ignore_errors=True)
+    session.blobs.clear()
+    shutil.rmtree(os.path.join(CONVERSATION_STATE_DIR, session.session_id), ignore_errors=True)
+
+
+async def destroy_sessions(session_ids: list[str]) -> None:
+    """Destroy many sessions, ``SESSION_TEARDOWN_CONCURRENCY`` at a time."""
+    limit = asyncio.Semaphore(SESSION_TEARDOWN_CONCURRENCY)
+
+    async def destroy(session_id: str) -> None:
+        async with limit:
+            try:
+                await destroy_session(session_id)
+            except Exception as exc:
+                logger.error("Error destroying session %s: %s", session_id, exc)
+
+    await asyncio.gather(*(destroy(session_id) for session_id in session_ids))
+
+
+# ── Shutdown drain ──────────────────────────────────────────
+
+async def drain_sessions(timeout: float) -> int:
+    """Stop taking new sessions and turns, and let running turns finish.
+
+    Waits up to *timeout* seconds for the agent runs in progress; runs
+    still going after that are stopped (``stop_requested``) and waited for
+    through the runner's stop grace.  Sessions stay in the store — destroy
+    them afterwards.  Returns how many runs had to be stopped.
+    """
+    store.draining = True
+    busy = [session for session in store.list_all() if session.run_lock.locked()]
+    if not busy:
+        return 0
+    logger.info("Draining: waiting up to %ss for %d agent run(s)", timeout, len(busy))
+    still_running = await _wait_until_idle(busy, timeout)
+    if still_running:
+        logger.warning("Draining: stopping %d agent run(s) still in progress", len(still_running))
+        for session in still_running:
+            session.stop_requested.set()
+        await _wait_until_idle(still_running, AGENT_RUN_STOP_GRACE_SECONDS + 1)
+    return len(still_running)
+
+
+async def _wait_until_idle(sessions: list[AgentSession], timeout: float) -> list[AgentSession]:
+    """Wait for the sessions' turns to end; returns those still running at *timeout*."""
+    async def idle(session: AgentSession) -> None:
+        async with session.run_lock:
+            pass
+
+    waits = {asyncio.create_task(idle(session)): session for session in sessions}
+    _done, pending = await asyncio.wait(waits, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    return [waits[task] for task in pending]
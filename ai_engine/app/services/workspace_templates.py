@@ -0,0 +1,228 @@
+"""Named workspace templates, materialized copy-on-write.
+
+A template is a directory tree under ``WORKSPACE_TEMPLATES_DIR`` — a repo
+with its dependencies installed, a toolchain cache — that new sessions
+start from instead of redoing that setup.  Users save one from a session
+workspace (``{user_id}/{name}``); operators can drop shared ones into
+``shared/{name}``.  A user's own templates win over shared ones of the
+same name.
+
+Materializing a template must not cost a full copy of it:
+
+- files are reflinked (``FICLONE``) where the filesystem supports it
+  (btrfs, XFS, bcachefs) — a copy that shares extents until written;
+- elsewhere they fall back to a plain copy.
+
+Nothing is hardlinked, not even git objects: every file must get its own
+inode, since the workspace is mounted read-write into the sandbox and an
+agent rewriting a shared inode would change the template — and every
+session made from it.  Saving strips the git credentials the workspace
+holds (see ``repo_cache.strip_credentials``), so a template never carries
+its owner's token.  The result is an ordinary directory tree, so the
+sandbox bind mount and the files router see nothing special.  Overlay
+mounts are not used: they need ``CAP_SYS_ADMIN`` on the engine host and
+a mount to maintain across hibernation and restarts.
+
+Templates are replaced atomically (rename) under a ``flock``, so sessions
+materializing one never see it half-written.  All methods are blocking.
+"""
+
+from __future__ import annotations
+
+import errno
+import fcntl
+import os
+import re
+import shutil
+import uuid
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from app.config import logger, WORKSPACE_TEMPLATES_DIR
+from app.exceptions import WorkspaceTemplateError
+from app.services.repo_cache import strip_credentials
+
+# linux/fs.h: _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+# Errors meaning "this filesystem (pair) can't do that" rather than a real failure
+_UNSUPPORTED = frozenset({errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.EPERM})
+
+_NAME_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]{0,63}$")
+SHARED_OWNER = "shared"
+
+
+class WorkspaceTemplates:
+    """Templates stored under *root*; see the module docstring."""
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+        self.materialized = 0
+        self.saved = 0
+        self.reflinked = 0
+        self.copied = 0
+        self.copied_bytes = 0
+
+    def path_for(self, user_id: str, name: str) -> Optional[str]:
+        """Directory of template *name* as seen by *user_id*, or None."""
+        _check_name(name)
+        for owner in (user_id, SHARED_OWNER):
+            path = os.path.join(self.root, owner, name)
+            if os.path.isdir(path):
+                return path
+        return None
+
+    def list_for_user(self, user_id: str) -> list[dict]:
+        """The user's own and the shared templates, own ones first."""
+        seen: set[str] = set()
+        templates = []
+        for owner in (user_id, SHARED_OWNER):
+            owner_dir = os.path.join(self.root, owner)
+            try:
+                names = sorted(os.listdir(owner_dir))
+            except FileNotFoundError:
+                continue
+            for name in names:
+                if name in seen or not _NAME_RE.match(name):
+                    continue
+                if not os.path.isdir(os.path.join(owner_dir, name)):
+                    continue   # Lock files
+                seen.add(name)
+                templates.append({"name": name, "shared": owner == SHARED_OWNER})
+        return templates
+
+    def materialize(self, user_id: str, name: str, dest: str) -> None:
+        """Populate *dest* from template *name*.
+
+        Files that already exist in *dest* (a repository checkout) are kept.
+        Raises ``WorkspaceTemplateError`` for an unknown template.
+        """
+        src = self.path_for(user_id, name)
+        if src is None:
+            raise WorkspaceTemplateError(f"Workspace template {name!r} not found.")
+        with self._locked(src, fcntl.LOCK_SH):
+            counts = _clone_tree(src, dest, overwrite=False)
+        self._count(counts)
+        self.materialized += 1
+        logger.info(
+            "Workspace template %s materialized into %s (%d reflinked, %d copied)",
+            name, dest, counts["reflinked"], counts["copied"],
+        )
+
+    def save(self, user_id: str, name: str, src: str) -> None:
+        """Save the directory *src* as *user_id*'s template *name*, replacing any."""
+        _check_name(name)
+        owner_dir = os.path.join(self.root, user_id)
+        os.makedirs(owner_dir, exist_ok=True)
+        path = os.path.join(owner_dir, name)
+        tmp = os.path.join(owner_dir, f".{name}.tmp-{uuid.uuid4().hex[:8]}")
+        old = None
+        try:
+            counts = _clone_tree(src, tmp, overwrite=True)
+            _strip_credentials(tmp)
+            # Swap under the lock so no session copies from a half-replaced tree
+            with self._locked(path, fcntl.LOCK_EX):
+                if os.path.isdir(path):
+                    old = os.path.join(owner_dir, f".{name}.old-{uuid.uuid4().hex[:8]}")
+                    os.rename(path, old)
+                os.rename(tmp, path)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        if old:
+            shutil.rmtree(old, ignore_errors=True)
+        self._count(counts)
+        self.saved += 1
+        logger.info("Workspace template %s/%s saved from %s", user_id, name, src)
+
+    def stats(self) -> dict:
+        """Counters for health/metrics endpoints."""
+        return {
+            "materialized": self.materialized,
+            "saved": self.saved,
+            "reflinkedFiles": self.reflinked,
+            "copiedFiles": self.copied,
+            "copiedBytes": self.copied_bytes,
+        }
+
+    def _count(self, counts: dict) -> None:
+        self.reflinked += counts["reflinked"]
+        self.copied += counts["copied"]
+        self.copied_bytes += counts["copiedBytes"]
+
+    @contextmanager
+    def _locked(self, path: str, flags: int) -> Iterator[None]:
+        fd = os.open(f"{path}.lock", os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(fd, flags)
+            yield
+        finally:
+            os.close(fd)   # Releases the lock
+
+
+# ── Tree cloning ─────────────────────────────────────────────
+
+def _check_name(name: str) -> None:
+    if not _NAME_RE.match(name or ""):
+        raise WorkspaceTemplateError(
+            "Template names are 1-64 letters, digits, '.', '_' or '-', starting with a letter or digit."
+        )
+
+
+def _clone_tree(src: str, dest: str, *, overwrite: bool) -> dict:
+    """Copy *src* into *dest* sharing data where possible; returns per-method counts."""
+    counts = {"reflinked": 0, "copied": 0, "copiedBytes": 0}
+    # Set once the filesystem refuses: later files go straight to a copy
+    can = {"reflink": True}
+    os.makedirs(dest, exist_ok=True)
+    stack = [(src, dest)]
+    while stack:
+        src_dir, dest_dir = stack.pop()
+        with os.scandir(src_dir) as entries:
+            for entry in entries:
+                target = os.path.join(dest_dir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    os.makedirs(target, exist_ok=True)
+                    shutil.copymode(entry.path, target)
+                    stack.append((entry.path, target))
+                    continue
+                if os.path.lexists(target):
+                    if not overwrite:
+                        continue
+                    os.remove(target)
+                if entry.is_symlink():
+                    os.symlink(os.readlink(entry.path), target)
+                elif entry.is_file(follow_symlinks=False):
+                    _clone_file(entry.path, target, counts, can)
+                # Sockets, FIFOs and devices are not workspace content
+    return counts
+
+
+def _clone_file(src: str, dest: str, counts: dict, can: dict) -> None:
+    if can["reflink"]:
+        try:
+            with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+                fcntl.ioctl(fdest.fileno(), _FICLONE, fsrc.fileno())
+            shutil.copystat(src, dest)
+            counts["reflinked"] += 1
+            return
+        except OSError as exc:
+            if exc.errno not in _UNSUPPORTED:
+                raise
+            can["reflink"] = False
+    shutil.copy2(src, dest)
+    counts["copied"] += 1
+    counts["copiedBytes"] += os.path.getsize(dest)
+
+
+def _strip_credentials(tree: str) -> None:
+    """Strip git credentials from the repositories (and submodules) in *tree*."""
+    for dirpath, _dirnames, filenames in os.walk(tree):
+        if ".git-credentials" in filenames:
+            os.remove(os.path.join(dirpath, ".git-credentials"))
+        in_git_dir = os.path.basename(dirpath) == ".git" or f"{os.sep}.git{os.sep}modules{os.sep}" in dirpath
+        if in_git_dir and "config" in filenames:
+            strip_credentials(os.path.join(dirpath, "config"))
+
+
+# Module-level singleton — used by session bring-up and the sessions router
+workspace_templates = WorkspaceTemplates(WORKSPACE_TEMPLATES_DIR)
@@ -0,0 +1,153 @@
+"""Per-session filesystem watcher for workspace directories.
+
+Backed by ``watchfiles`` (inotify on Linux, FSEvents / ReadDirectoryChangesW
+elsewhere).  Raw notifications are debounced into batches of exact paths
+and handed to the session's ``FileTreeRefreshScheduler``, which applies
+them to the ``FileTreeSnapshot`` off the event loop and publishes the
+resulting ``file_tree_delta`` on the session's event buffer — so it
+reaches the client in order with the agent events that caused it.
+
+Only directories the tree shows are watched: ``node_modules``, ``.git``,
+``.venv`` and the rest of ``is_excluded_dir`` get no inotify watch at all,
+so large dependency trees don't exhaust ``fs.inotify.max_user_watches``.
+That means one non-recursive watch per shown directory; when a new one
+appears the watch set is rebuilt, and what landed in it meanwhile is
+picked up by walking it once.
+
+Writes made inside the sandbox container land on the same bind-mounted
+directory, so they are seen here too.  When ``watchfiles`` is not installed
+``WATCHFILES_AVAILABLE`` is ``False`` and the caller falls back to the
+command heuristic in ``app.routers.files``.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+from typing import Callable, Optional
+
+from app.config import logger, WORKSPACE_WATCH_DEBOUNCE_MS
+from app.services.file_tree import FileTreeSnapshot, is_excluded_dir
+
+# ── Optional dependency ─────────────────────────────────────
+
+WATCHFILES_AVAILABLE: bool = False
+awatch = None
+
+try:
+    from watchfiles import Change, awatch  # noqa: F811
+
+    WATCHFILES_AVAILABLE = True
+except ImportError:
+    pass
+
+
+class WorkspaceWatcher:
+    """Watch one workspace directory and request exact-path refreshes."""
+
+    def __init__(
+        self,
+        snapshot: FileTreeSnapshot,
+        request_refresh: Callable[[set[str]], None],
+    ) -> None:
+        self._snapshot = snapshot
+        self._request_refresh = request_refresh
+        self._stop_event = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.batches_seen = 0
+
+    def start(self) -> None:
+        self._snapshot.watched = True
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._stop_event.set()
+        self._snapshot.watched = False
+        if self._task is not None:
+            try:
+                await self._task
+            except Exception:
+                pass
+            self._task = None
+
+    def _watch_filter(self, _change, path: str) -> bool:
+        rel = os.path.relpath(path, self._snapshot.root_dir)
+        parents = rel.split(os.sep)[:-1]
+        return not any(is_excluded_dir(part) for part in parents)
+
+    async def _run(self) -> None:
+        root = self._snapshot.root_dir
+        new_dirs: set[str] = set()
+        try:
+            while not self._stop_event.is_set():
+                dirs = await asyncio.to_thread(_shown_dirs, root)
+                changes = awatch(
+                    *dirs,
+                    watch_filter=self._watch_filter,
+                    debounce=WORKSPACE_WATCH_DEBOUNCE_MS,
+                    stop_event=self._stop_event,
+                    recursive=False,
+                )
+                batch = asyncio.ensure_future(changes.__anext__())
+                await asyncio.sleep(0)   # awatch adds its watches before it first waits
+                if new_dirs:
+                    # Whatever landed in the new directories before they were watched
+                    self._request_refresh(await asyncio.to_thread(_paths_under, root, new_dirs))
+                new_dirs = set()
+                try:
+                    while not new_dirs:
+                        new_dirs = self._handle(root, await batch)
+                        if not new_dirs:
+                            batch = asyncio.ensure_future(changes.__anext__())
+                except StopAsyncIteration:
+                    break   # stop_event set
+                except FileNotFoundError:
+                    continue   # A directory vanished before it was watched — list them again
+                finally:
+                    await changes.aclose()
+        except Exception as exc:
+            logger.warning("Workspace watcher stopped for %s: %s", root, exc)
+        finally:
+            # Fall back to the command heuristic if the watcher dies
+            self._snapshot.watched = False
+
+    def _handle(self, root: str, changes: set) -> set[str]:
+        """Request refreshes for a batch; returns the new directories in it to watch."""
+        self.batches_seen += 1
+        rel_paths = set()
+        new_dirs = set()
+        for change, path in changes:
+            if os.path.normpath(path) == os.path.normpath(root):
+                continue
+            rel_paths.add("/" + os.path.relpath(path, root).replace(os.sep, "/"))
+            if (
+                change == Change.added
+                and not is_excluded_dir(os.path.basename(path))
+                and os.path.isdir(path)
+                and not os.path.islink(path)
+            ):
+                new_dirs.add(path)
+        if rel_paths:
+            self._request_refresh(rel_paths)
+        return new_dirs
+
+
+def _shown_dirs(root: str) -> list[str]:
+    """*root* and every directory under it the tree shows (blocking)."""
+    dirs = [root]
+    for dirpath, dirnames, _filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if not is_excluded_dir(name)]
+        dirs.extend(os.path.join(dirpath, name) for name in dirnames)
+    return dirs
+
+
+def _paths_under(root: str, dirs: set[str]) -> set[str]:
+    """Tree paths (``/a/b.py`` form) of everything shown under *dirs* (blocking)."""
+    paths = set()
+    for top in dirs:
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames[:] = [name for name in dirnames if not is_excluded_dir(name)]
+            for name in (*dirnames, *filenames):
+                rel = os.path.relpath(os.path.join(dirpath, name), root)
+                paths.add("/" + rel.replace(os.sep, "/"))
+    return paths
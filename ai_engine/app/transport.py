@@ -0,0 +1,266 @@
+"""Outbound WebSocket channel — one ``WSEventWriter`` per connection.
+
+Every server → client message goes through the writer so that:
+
+- sends from the handler coroutine and the streaming task are serialised
+  (Starlette WebSockets are not safe for concurrent ``send_*`` calls),
+- agent events can be micro-batched when the client opts in, and
+- each message is encoded once, in the wire format the client asked for.
+
+Framing and encoding are negotiated in the initial handshake message::
+
+    { "task": "...", "framing": "batch", "encoding": "msgpack", "compression": "deflate" }
+
+``"single"`` (default) sends one ``agent_event`` frame per event, exactly as
+before.  ``"batch"`` collects events arriving within
+``WS_BATCH_WINDOW_SECONDS`` (or until ``WS_BATCH_MAX_EVENTS``) into one
+frame::
+
+    { "type": "agent_events", "firstSeq": 12, "lastSeq": 14,
+      "events": [ { "type": "agent_event", "seq": 12, ... }, ... ] }
+
+Every agent event carries the session's ``seq`` (from its replay log) in
+both modes so the client can order and de-duplicate after unpacking.
+Non-event messages (status, file tree, errors) flush any pending batch
+first, so ordering is preserved.
+
+Encodings
+---------
+``json``     stdlib encoder, text frames (default — unchanged behaviour)
+``orjson``   the same JSON, produced by the much faster ``orjson``, in
+             binary frames — its UTF-8 output goes out as is instead of
+             being decoded to ``str`` for a text frame and encoded again
+``msgpack``  binary MessagePack frames
+
+With ``"compression": "deflate"`` any payload of at least
+``WS_COMPRESS_MIN_BYTES`` is zlib-compressed.  Wire rule for clients:
+a *text* frame is always plain JSON; a *binary* frame is one flag byte
+(bit 0 = zlib-deflated) followed by the payload in the negotiated encoding.
+App-level deflate is meant for clients or proxies that do not negotiate
+WebSocket permessage-deflate; there is no point asking for both.
+
+Optional encoders that are not installed fall back to ``json``; the
+options actually in effect are echoed back in the ``initializing`` status,
+which is always sent as plain JSON text.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import zlib
+from typing import Optional
+
+from fastapi import WebSocket
+
+from app.config import (
+    logger,
+    WS_BATCH_WINDOW_SECONDS,
+    WS_BATCH_MAX_EVENTS,
+    WS_COMPRESS_MIN_BYTES,
+    WS_COMPRESS_LEVEL,
+)
+
+# ── Optional encoders ───────────────────────────────────────
+
+orjson = None
+msgpack = None
+
+try:
+    import orjson  # noqa: F811
+except ImportError:
+    pass
+
+try:
+    import msgpack  # noqa: F811
+except ImportError:
+    pass
+
+
+FRAMING_MODES = ("single", "batch")
+ENCODINGS = ("json", "orjson", "msgpack")
+COMPRESSIONS = ("none", "deflate")
+
+_FLAG_DEFLATE = 0x01
+
+
+def available_encodings() -> list[str]:
+    """Encodings this process can actually produce."""
+    return [
+        e for e in ENCODINGS
+        if e == "json"
+        or (e == "orjson" and orjson is not None)
+        or (e == "msgpack" and msgpack is not None)
+    ]
+
+
+def _negotiate(requested: object, supported: list[str] | tuple[str, ...], default: str) -> str:
+    value = str(requested or default).lower()
+    return value if value in supported else default
+
+
+class WSEventWriter:
+    """Serialised, optionally batching sender for one WebSocket."""
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        *,
+        framing: str = "single",
+        encoding: str = "json",
+        compression: str = "none",
+    ) -> None:
+        self._ws = websocket
+        self.framing = _negotiate(framing, FRAMING_MODES, "single")
+        self.encoding = _negotiate(encoding, available_encodings(), "json")
+        self.compression = _negotiate(compression, COMPRESSIONS, "none")
+        self._lock = asyncio.Lock()
+        self._pending: list[dict] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._error: Optional[BaseException] = None
+        self.frames_sent = 0
+        self.bytes_sent = 0
+
+    @classmethod
+    def from_handshake(cls, websocket: WebSocket, raw: dict) -> "WSEventWriter":
+        """Build a writer using the options in the client's initial message."""
+        return cls(
+            websocket,
+            framing=raw.get("framing"),
+            encoding=raw.get("encoding"),
+            compression=raw.get("compression"),
+        )
+
+    def describe(self) -> dict:
+        """Negotiated protocol options, echoed back to the client."""
+        return {
+            "framing": self.framing,
+            "encoding": self.encoding,
+            "compression": self.compression,
+        }
+
+    # ── Sending ──────────────────────────────────────────────
+
+    async def send_plain(self, message: dict) -> None:
+        """Send *message* as plain JSON text regardless of the negotiated encoding.
+
+        Used for the status that announces the protocol, which the client
+        must be able to read before it knows what was negotiated.
+        """
+        self._raise_if_broken()
+        async with self._lock:
+            await self._flush_locked()
+            text = json.dumps(message, separators=(",", ":"), ensure_ascii=False, default=str)
+            await self._ws.send_text(text)
+            self.frames_sent += 1
+            self.bytes_sent += len(text)
+
+    async def send(self, message: dict) -> None:
+        """Send a control message immediately, after any pending batch."""
+        self._raise_if_broken()
+        async with self._lock:
+            await self._flush_locked()
+            await self._send_frame(message)
+
+    async def send_event(self, event: dict) -> None:
+        """Send an agent event — immediately, or via the current batch.
+
+        *event* is the dict every subscriber of the session shares, already
+        stamped with its ``seq`` by the session's replay log; it is sent
+        as is, never modified.
+        """
+        self._raise_if_broken()
+        if self.framing != "batch":
+            async with self._lock:
+                await self._send_frame(event)
+            return
+
+        self._pending.append(event)
+        if len(self._pending) >= WS_BATCH_MAX_EVENTS:
+            await self.flush()
+        elif self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(
+                WS_BATCH_WINDOW_SECONDS, self._on_window_elapsed,
+            )
+
+    async def flush(self) -> None:
+        """Send the pending batch now, if there is one."""
+        async with self._lock:
+            await self._flush_locked()
+
+    async def close(self) -> None:
+        """Flush what is left and stop the batch timer."""
+        try:
+            await self.flush()
+        except Exception:
+            pass  # Client already gone — nothing left to deliver
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+    # ── Internals ────────────────────────────────────────────
+
+    def _on_window_elapsed(self) -> None:
+        self._flush_handle = None
+        self._flush_task = asyncio.ensure_future(self._flush_in_background())
+
+    async def _flush_in_background(self) -> None:
+        try:
+            await self.flush()
+        except Exception as exc:
+            # Surface on the next send so the caller's loop exits as usual
+            self._error = exc
+            logger.debug("Batched WS flush failed: %s", exc)
+
+    async def _flush_locked(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        events, self._pending = self._pending, []
+        await self._send_frame({
+            "type": "agent_events",
+            "firstSeq": events[0].get("seq"),
+            "lastSeq": events[-1].get("seq"),
+            "events": events,
+        })
+
+    async def _send_frame(self, message: dict) -> None:
+        text, data = self._encode(message)
+        if data is not None:
+            await self._ws.send_bytes(data)
+            self.bytes_sent += len(data)
+        else:
+            await self._ws.send_text(text)
+            self.bytes_sent += len(text)
+        self.frames_sent += 1
+
+    def _encode(self, message: dict) -> tuple[Optional[str], Optional[bytes]]:
+        """Encode *message* once — returns ``(text, None)`` or ``(None, binary)``."""
+        if self.encoding == "msgpack":
+            payload = msgpack.packb(message, default=str, use_bin_type=True)
+            return None, self._binary_frame(payload)
+
+        if self.encoding == "orjson":
+            return None, self._binary_frame(orjson.dumps(message, default=str))
+
+        text = json.dumps(message, separators=(",", ":"), ensure_ascii=False, default=str)
+        if self.compression != "deflate" or len(text) < WS_COMPRESS_MIN_BYTES:
+            return text, None
+        payload = text.encode("utf-8")
+        if len(payload) >= WS_COMPRESS_MIN_BYTES:
+            return None, self._binary_frame(payload)
+        return text, None
+
+    def _binary_frame(self, payload: bytes) -> bytes:
+        """Flag byte + payload, deflated when compression applies."""
+        if self.compression == "deflate" and len(payload) >= WS_COMPRESS_MIN_BYTES:
+            return bytes((_FLAG_DEFLATE,)) + zlib.compress(payload, WS_COMPRESS_LEVEL)
+        return b"\x00" + payload
+
+    def _raise_if_broken(self) -> None:
+        if self._error is not None:
+            raise self._error
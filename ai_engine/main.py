@@ -1,15 +1,124 @@
-"""Entry point — kept slim so ``uvicorn main:app`` works unchanged."""
+"""Entry point — kept slim so ``uvicorn main:app`` works unchanged.
+
+``python main.py`` starts ``ENGINE_WORKERS`` worker processes.  They all
+accept connections on ``PORT`` (``SO_REUSEPORT`` — the kernel spreads new
+connections across them); worker N also listens on
+``ENGINE_INTERNAL_BIND_HOST``:``ENGINE_INTERNAL_PORT_BASE`` + N (loopback
+by default), where its peers forward requests for the sessions it owns
+(see ``app.services.routing``).  A worker that dies is restarted.
+
+On SIGTERM a worker stops accepting connections and drains: agent runs in
+progress get ``SHUTDOWN_DRAIN_SECONDS`` to finish while their clients are
+still attached, then everything is torn down.
+"""
+
+import os
+import socket
+
+import uvicorn
 
 from app import app  # noqa: F401
 
-if __name__ == "__main__":
-    import uvicorn
+
+class _DrainingServer(uvicorn.Server):
+    """uvicorn server that drains sessions before closing connections."""
+
+    async def shutdown(self, sockets: list[socket.socket] | None = None) -> None:
+        from app.config import settings
+        from app.services.sessions import drain_sessions
+
+        # New connections go to other workers / the next deployment; turns
+        # already running keep streaming to their clients
+        for server in self.servers:
+            server.close()
+        for sock in sockets or []:
+            sock.close()
+        await drain_sessions(settings.SHUTDOWN_DRAIN_SECONDS)
+        await super().shutdown(sockets)
+
+
+def _bind(host: str, port: int, *, reuse_port: bool = False) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def _serve_worker(index: int) -> None:
+    """Run one worker: the shared public port plus its own internal port."""
     from app.config import settings
 
-    uvicorn.run(
-        "main:app",
-        host="0.0.0.0",
-        port=settings.PORT,
+    sockets = [
+        _bind("0.0.0.0", settings.PORT, reuse_port=True),
+        # Forwarded requests skip the public edge — keep the port off it
+        _bind(settings.ENGINE_INTERNAL_BIND_HOST, settings.ENGINE_INTERNAL_PORT_BASE + index),
+    ]
+    _DrainingServer(uvicorn.Config(app, log_level="info")).run(sockets=sockets)
+
+
+def _supervise(workers: int) -> None:
+    """Start the workers, restart any that exit, stop them all on SIGTERM/SIGINT."""
+    import multiprocessing
+    import signal
+    import time
+    from app.config import logger, settings
+
+    context = multiprocessing.get_context("spawn")
+    processes: dict[int, multiprocessing.process.BaseProcess] = {}
+
+    def start(index: int) -> None:
+        # Spawned workers read their settings (and index) from the environment
+        os.environ["ENGINE_WORKER_INDEX"] = str(index)
+        try:
+            process = context.Process(
+                target=_serve_worker, args=(index,), name=f"engine-worker-{index}",
+            )
+            process.start()
+        finally:
+            del os.environ["ENGINE_WORKER_INDEX"]
+        processes[index] = process
+
+    stopping = False
+
+    def stop(_signum, _frame) -> None:
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for index in range(workers):
+        start(index)
+    logger.info("Started %d engine workers", workers)
+
+    while not stopping:
+        time.sleep(1.0)
+        for index, process in list(processes.items()):
+            if not stopping and not process.is_alive():
+                logger.warning(
+                    "Engine worker %d exited (code %s) — restarting", index, process.exitcode,
+                )
+                start(index)
+
+    # SIGTERM lets each worker run its shutdown (sessions, sandboxes, WAL)
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        process.join(timeout=settings.SHUTDOWN_DRAIN_SECONDS + 60)
+
+
+if __name__ == "__main__":
+    from app.config import settings
 
-        log_level="info",
-    )
+    if settings.ENGINE_WORKERS > 1:
+        _supervise(settings.ENGINE_WORKERS)
+    else:
+        _DrainingServer(uvicorn.Config(
+            "main:app",
+            host="0.0.0.0",
+            port=settings.PORT,
+            log_level="info",
+        )).run()